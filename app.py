@@ -4,28 +4,55 @@ Backend Flask Application with spotDL integration
 """
 
 import os
+import re
 import sys
 import json
 import shutil
-import tempfile
 import subprocess
 import threading
+import signal
 import time
 import random
+import hashlib
+import queue
+import socket
+import importlib.util
+import shlex
+import io
+from collections import deque
 from pathlib import Path
 from datetime import datetime, timedelta
+from contextlib import contextmanager
 from concurrent.futures import ThreadPoolExecutor
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Response, render_template, request, jsonify, send_file
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from werkzeug.middleware.proxy_fix import ProxyFix
 import zipfile
 from dotenv import load_dotenv
 import logging
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs, urlencode, quote
 import secrets
+from spotdl_engine import EnginePool
+from metadata_cache import MetadataCache, track_ref
+from metrics import MetricsRegistry
+from storage import sqlite_connection
+from job_queue import JobScheduler, SQLiteJobQueue, QueueFull, LeaseLost
+from track_cache import TrackCache
+from disk_usage import DiskUsageIndex, unshared_size
+from limits import TokenBucketLimiter, AdaptiveConcurrency
+from archive import ZipLayout, index_files, load_index, save_index
+
+try:
+    import fcntl
+except ImportError:  # Windows: no file locks, every process runs its own cleanup
+    fcntl = None
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', secrets.token_urlsafe(32))
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
@@ -39,23 +66,25 @@ if os.getenv('FLASK_ENV') == 'production':
         PERMANENT_SESSION_LIFETIME=timedelta(hours=1)
     )
     
-    # Rate limiting for production
-    try:
-        from flask_limiter import Limiter
-        from flask_limiter.util import get_remote_address
-        
-        limiter = Limiter(
-            app,
-            key_func=get_remote_address,
-            default_limits=["200 per day", "50 per hour"],
-            storage_uri="memory://"
-        )
-        logger.info("Rate limiting enabled for production")
-    except ImportError:
-        app.logger.warning("flask-limiter not installed, rate limiting disabled")
-        limiter = None
-else:
-    limiter = None
+
+# Reverse proxies in front of the app. Their X-Forwarded-For hops are trusted to set the
+# client address used for per-client scheduling and rate limits; 0 trusts none (direct traffic)
+TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', '0'))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+
+# Rate limiting for production, set up by create_app(). Only job submissions are limited:
+# status polls, event streams, health checks and file downloads never are.
+SUBMIT_RATE_LIMIT = os.getenv('SUBMIT_RATE_LIMIT', '5 per minute')
+limiter = None
+rate_limited_views = {}  # endpoint -> limit, applied by init_rate_limiting()
+
+def rate_limit(limit):
+    """Per-client limit for a view, enforced once init_rate_limiting() has run"""
+    def decorator(view):
+        rate_limited_views[view.__name__] = limit
+        return view
+    return decorator
 
 # Track app start time for metrics
 app.start_time = time.time()
@@ -71,35 +100,199 @@ def add_security_headers(response):
         response.headers['Referrer-Policy'] = 'strict-origin-when-cross-origin'
     return response
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('app.log'),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger(__name__)
+# Per-task spans go to their own log as one JSON object per line ('-' for stderr)
+TIMELINE_LOG = os.getenv('TIMELINE_LOG', 'timeline.log')
+timeline_logger = logging.getLogger('timeline')
+timeline_logger.propagate = False
+timeline_logger.setLevel(logging.INFO)
+
+def configure_logging():
+    """Log to app.log and stderr, and per-task spans to TIMELINE_LOG"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('app.log'),
+            logging.StreamHandler()
+        ]
+    )
+    handler = logging.StreamHandler() if TIMELINE_LOG == '-' else logging.FileHandler(TIMELINE_LOG)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    timeline_logger.addHandler(handler)
+
+def init_rate_limiting():
+    """Per-client request limits in production (needs flask-limiter)"""
+    global limiter
+    try:
+        from flask_limiter import Limiter
+        from flask_limiter.util import get_remote_address
+    except ImportError:
+        logger.warning("flask-limiter not installed, rate limiting disabled")
+        return
+    limiter = Limiter(
+        get_remote_address,
+        app=app,
+        storage_uri="memory://"
+    )
+    for endpoint, view in list(app.view_functions.items()):
+        if endpoint in rate_limited_views:
+            app.view_functions[endpoint] = limiter.limit(rate_limited_views[endpoint])(view)
+        else:
+            limiter.exempt(view)
+    logger.info(f"Rate limiting enabled for production: {', '.join(sorted(rate_limited_views))}")
 
 # Configuration
 DOWNLOADS_DIR = Path('downloads')
 TEMP_DIR = Path('temp')
 OUTPUT_DIR = Path('output')
+DATA_DIR = Path('data')
+# Nothing is created at import: directories and databases appear on first use, so importing
+# the app (e.g. gunicorn --preload) has no side effects
 
-# Create directories if they don't exist
-for directory in [DOWNLOADS_DIR, TEMP_DIR, OUTPUT_DIR]:
-    directory.mkdir(exist_ok=True)
+# Task store backend: 'sqlite' is shared by all gunicorn workers, 'memory' is per-process (dev only)
+TASK_STORE_BACKEND = os.getenv('TASK_STORE', 'sqlite').lower()
+TASK_STORE_PATH = Path(os.getenv('TASK_STORE_PATH', str(DATA_DIR / 'tasks.db')))
+TASK_STORE_FLUSH_INTERVAL = float(os.getenv('TASK_STORE_FLUSH_INTERVAL', '0.25'))
 
-# Thread pool for handling downloads
-executor = ThreadPoolExecutor(max_workers=3)
+# Identical URL+format requests attach to a running task or reuse a recent result
+RESULT_REUSE_TTL = int(os.getenv('RESULT_REUSE_TTL', '600'))
 
-# Store download tasks
-download_tasks = {}
+# Per-track cache shared by all jobs, keyed by provider track ID + format + bitrate
+CACHE_DIR = Path(os.getenv('TRACK_CACHE_DIR', 'cache'))
+TRACK_CACHE_MAX_BYTES = int(os.getenv('TRACK_CACHE_MAX_BYTES', str(10 * 1024 ** 3)))  # 10GB
+DOWNLOAD_BITRATE = '320k'
+AUDIO_EXTENSIONS = ['.mp3', '.wav', '.flac', '.m4a', '.ogg']
+
+# Multi-format jobs fetch each track once in SOURCE_FORMAT and transcode it locally with ffmpeg,
+# at most TRANSCODE_WORKERS conversions at a time per process. spotDL copies opus sources as they
+# are but re-encodes m4a ones, so a transcode can be a third generation of lossy audio: transcodes
+# are cached as their own variant, and single-format jobs only ever get the files spotDL produced
+SOURCE_FORMAT = 'opus'
+TRANSCODE_VARIANT = f'{DOWNLOAD_BITRATE}:transcoded-from-{SOURCE_FORMAT}'
+FFMPEG_BINARY = os.getenv('FFMPEG_BINARY', 'ffmpeg')
+TRANSCODE_WORKERS = int(os.getenv('TRANSCODE_WORKERS', str(os.cpu_count() or 2)))
+TRANSCODE_ARGS = {
+    # ffmpeg reads the Ogg cover art as an attached picture stream, mp3 and flac carry it across
+    'mp3': ['-map', '0:v?', '-c:v', 'copy', '-disposition:v', 'attached_pic', '-id3v2_version', '3',
+            '-c:a', 'libmp3lame', '-b:a', DOWNLOAD_BITRATE],
+    'flac': ['-map', '0:v?', '-c:v', 'copy', '-disposition:v', 'attached_pic', '-c:a', 'flac'],
+    'wav': ['-c:a', 'pcm_s16le'],
+}
+
+# Job outputs (downloads/<job>/, output/<job>.zip) are removed OUTPUT_TTL seconds after they
+# were produced or last reused; above DISK_BUDGET_BYTES the oldest ones are removed early
+OUTPUT_TTL = int(os.getenv('OUTPUT_TTL', '3600'))
+DISK_BUDGET_BYTES = int(os.getenv('DISK_BUDGET_BYTES', str(20 * 1024 ** 3)))  # 20GB
+DISK_INDEX_PATH = Path(os.getenv('DISK_INDEX_PATH', str(DATA_DIR / 'disk.db')))
+CLEANUP_INTERVAL = int(os.getenv('CLEANUP_INTERVAL', '3600'))  # longest sleep between cleanup passes
+DISK_MIN_RETENTION = 300  # outputs are kept at least this long, even over budget
+DISK_RECONCILE_INTERVAL = 86400  # walk the directories for files nothing registered (crashed workers)
+# Cleanup runs in one process at a time: whichever holds the lock file; the others stand by
+CLEANUP_LOCK_PATH = DATA_DIR / 'cleanup.lock'
+CLEANUP_STANDBY_INTERVAL = 60  # how often a standby process tries to take over
 
-# Rate limiting for Spotify API
-last_request_time = 0
-min_request_interval = 1.0  # 1 second between requests
+# Metadata cache shared by all workers: resolved track lists, track -> audio source
+# matches and lyrics. TTLs in seconds, override with METADATA_TTLS="playlist=600,lyrics=86400"
+METADATA_CACHE_PATH = Path(os.getenv('METADATA_CACHE_PATH', str(DATA_DIR / 'metadata.db')))
+METADATA_CACHE_MAX_BYTES = int(os.getenv('METADATA_CACHE_MAX_BYTES', str(256 * 1024 ** 2)))  # 256MB
+METADATA_TTLS = {
+    'playlist': 3600,  # playlists change, albums and single tracks do not
+    'album': 7 * 86400,
+    'match': 30 * 86400,
+    'lyrics': 30 * 86400,
+}
+for ttl in filter(None, os.getenv('METADATA_TTLS', '').split(',')):
+    name, _, seconds = ttl.partition('=')
+    METADATA_TTLS[name.strip()] = int(seconds)
+
+METRICS_PATH = Path(os.getenv('METRICS_PATH', str(DATA_DIR / 'metrics.db')))  # shared by all processes
+
+# Opt-in cProfile of download jobs: a fraction of all tasks, or single tasks started with an
+# X-Profile-Token header matching PROFILE_TOKEN. Stats are kept in PROFILE_DIR for PROFILE_TTL
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN')
+PROFILE_DIR = Path(os.getenv('PROFILE_DIR', str(DATA_DIR / 'profiles')))
+PROFILE_TTL = 86400
+
+# spotDL watchdogs: kill a run when no track finishes within SPOTDL_TRACK_TIMEOUT seconds
+SPOTDL_TRACK_TIMEOUT = int(os.getenv('SPOTDL_TRACK_TIMEOUT', '300'))
+SPOTDL_TIMEOUT = int(os.getenv('SPOTDL_TIMEOUT', '1800'))
+SPOTDL_LOG_LEVEL = os.getenv('SPOTDL_LOG_LEVEL', 'INFO')
+
+# Command line that starts spotDL; the benchmark points it at a local stub (bench/fake_spotdl.py)
+SPOTDL_COMMAND = shlex.split(os.getenv('SPOTDL_COMMAND', '')) or [sys.executable, '-m', 'spotdl']
+
+# 'subprocess' starts SPOTDL_COMMAND per run, 'pool' keeps warm spotDL engines (spotdl_engine.py)
+SPOTDL_ENGINE = os.getenv('SPOTDL_ENGINE', 'subprocess').lower()
+SPOTDL_ENGINE_PROCESSES = int(os.getenv('SPOTDL_ENGINE_PROCESSES', os.getenv('MAX_CONCURRENT_DOWNLOADS', '6')))
+
+# Server-Sent Events progress streams. They are held open only on gevent workers; a sync or
+# gthread worker would give a whole worker or thread to every viewer, so there each connection
+# gets the current state and the browser reconnects after the SSE retry delay (short polling)
+SSE_POLL_INTERVAL = float(os.getenv('SSE_POLL_INTERVAL', '0.5'))
+SSE_KEEPALIVE_INTERVAL = 15
+SSE_MAX_DURATION = int(os.getenv('SSE_MAX_DURATION', '600'))  # clients reconnect after this
+SSE_MAX_TASKS = 50
+
+# '' serves archives from Flask, 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache, lighttpd)
+# hand the file to the proxy; nginx maps DOWNLOAD_ACCEL_PREFIX to OUTPUT_DIR as an internal location
+DOWNLOAD_OFFLOAD = os.getenv('DOWNLOAD_OFFLOAD', '').lower()
+DOWNLOAD_ACCEL_PREFIX = os.getenv('DOWNLOAD_ACCEL_PREFIX', '/protected-archives/')
+# 'stream' indexes a completed job's files and streams its ZIP from them, resumable with Range/ETag;
+# 'file' also writes output/<job>.zip, which a proxy needs to serve it, so it is the default with offload
+DOWNLOAD_ARCHIVE = os.getenv('DOWNLOAD_ARCHIVE', 'file' if DOWNLOAD_OFFLOAD else 'stream').lower()
+app.config['USE_X_SENDFILE'] = DOWNLOAD_OFFLOAD == 'x-sendfile'
+
+# Adaptive concurrency bounds (min, initial, max) for jobs per worker and spotDL threads per job
+JOB_CONCURRENCY = (1, int(os.getenv('JOB_CONCURRENCY_INITIAL', '3')), int(os.getenv('MAX_CONCURRENT_DOWNLOADS', '6')))
+TRACK_THREADS = (1, int(os.getenv('TRACK_THREADS_INITIAL', '2')), int(os.getenv('TRACK_THREADS_MAX', '8')))
+TRACK_LATENCY_TARGET = float(os.getenv('TRACK_LATENCY_TARGET', '45'))  # seconds per track
+RATE_LIMIT_KEYWORDS = ['rate limit', '429', 'too many requests']
+ERROR_CLASSES = [
+    ('rate_limit', RATE_LIMIT_KEYWORDS),
+    ('not_found', ['404', 'not found', 'no results found', 'invalid']),
+    ('network', ['network', 'connection', 'timeout']),
+]
+
+def classify_error(message):
+    """Failure class of a spotDL error: rate_limit, not_found, network or other"""
+    message = message.lower()
+    return next((name for name, keywords in ERROR_CLASSES if any(keyword in message for keyword in keywords)), 'other')
+
+# Job queue admission control and fairness
+MAX_QUEUE_DEPTH = int(os.getenv('MAX_QUEUE_DEPTH', '100'))
+MAX_QUEUED_PER_CLIENT = int(os.getenv('MAX_QUEUED_PER_CLIENT', '10'))
+QUEUE_AGING_SECONDS = int(os.getenv('QUEUE_AGING_SECONDS', '300'))  # waiting this long promotes a job one size class
+# Playlists per POST /batch; a batch takes one place in the queue and feeds its playlists in one by one
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', '50'))
+
+# Job queue backend: 'sqlite' is durable and shared by web and worker processes, 'memory' is per-process.
+# DOWNLOAD_MODE 'inline' runs downloads inside the web workers, 'external' leaves them to `python app.py worker`
+JOB_QUEUE_BACKEND = os.getenv('JOB_QUEUE', TASK_STORE_BACKEND).lower()
+JOB_QUEUE_PATH = Path(os.getenv('JOB_QUEUE_PATH', str(TASK_STORE_PATH)))
+DOWNLOAD_MODE = os.getenv('DOWNLOAD_MODE', 'inline').lower()
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', '60'))  # a job whose worker stops heartbeating is re-queued after this
+MAX_JOB_ATTEMPTS = int(os.getenv('MAX_JOB_ATTEMPTS', '3'))
+WORKER_SHUTDOWN_TIMEOUT = int(os.getenv('WORKER_SHUTDOWN_TIMEOUT', '300'))
+
+# Token buckets per upstream: (tokens per second, burst). Override with
+# RATE_LIMITS="youtube=1:5,lyrics=0.5:2"
+RATE_LIMITS = {
+    'spotify': (5.0, 10),
+    'spotify-anon': (0.5, 1),  # unauthenticated Spotify access is throttled much harder
+    'youtube': (2.0, 10),
+    'youtube-music': (2.0, 10),
+    'lyrics': (2.0, 10),
+}
+for limit in filter(None, os.getenv('RATE_LIMITS', '').split(',')):
+    name, _, spec = limit.partition('=')
+    rate, _, burst = spec.partition(':')
+    RATE_LIMITS[name.strip()] = (float(rate), float(burst or rate))
+RATE_LIMIT_PATH = Path(os.getenv('RATE_LIMIT_PATH', str(DATA_DIR / 'ratelimit.db')))
+
+# Missing tracks are handed to spotDL in chunks so provider tokens can be taken per chunk
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', '10'))
+SHARED_TRACK_POLL_INTERVAL = 1.0  # how often a job checks on tracks another job is downloading
 
 class DownloadTask:
     """Class to track download progress and status"""
@@ -112,8 +305,427 @@ class DownloadTask:
         self.message = 'Initializing download...'
         self.error = None
         self.output_file = None
+        self.output_dir = None  # directory whose files are streamed as the ZIP archive
+        self.tracks = []  # per-track {'name', 'status', 'error'}; status: queued, downloading, converted, cached, failed
+        self.tracks_total = 0
+        self.tracks_done = 0
+        self.tracks_failed = 0
+        self.bytes_downloaded = 0
+        self.owner = worker_id()  # host:pid of the worker process running the task
+        self.dedupe_key = None  # normalized URL + format, shared by identical requests
+        self.snapshot = None  # hash of the resolved track list (playlist version)
+        self.finished_at = None  # when the task completed or failed; outputs and the task expire from here
+        self.queue_position = None  # 1-based position while waiting in the job queue
+        self.timeline = []  # finished spans {'name', 'start', 'duration', ...} of every run
+        self.profile = False  # run the download under cProfile
+        self.archive = True  # with DOWNLOAD_ARCHIVE=file, write output/<job>.zip; combined batch playlists are not zipped alone
         self.created_at = datetime.now()
 
+    def to_dict(self):
+        """Serialize the task for the task store"""
+        data = {key: value for key, value in vars(self).items() if not key.startswith('_')}
+        data['created_at'] = self.created_at.isoformat()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a task from its serialized form"""
+        task = cls(data['task_id'], data['url'], data['format_type'])
+        for key, value in data.items():
+            setattr(task, key, value)
+        task.created_at = datetime.fromisoformat(data['created_at'])
+        return task
+
+class DownloadBatch:
+    """Many playlists submitted together; progress is aggregated from the member tasks"""
+    def __init__(self, batch_id, format_type, archive, playlists):
+        self.batch_id = batch_id
+        self.format_type = format_type
+        self.archive = archive  # 'combined': one ZIP of every playlist, 'playlist': one ZIP each
+        self.playlists = playlists  # [{'url', 'task_id'}] in request order, identical URLs share a task
+        self.created_at = datetime.now()
+
+    def task_ids(self):
+        return list(dict.fromkeys(playlist['task_id'] for playlist in self.playlists))
+
+    def to_dict(self):
+        data = dict(vars(self))
+        data['created_at'] = self.created_at.isoformat()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        batch = cls(data['batch_id'], data['format_type'], data['archive'], data['playlists'])
+        batch.created_at = datetime.fromisoformat(data['created_at'])
+        return batch
+
+ACTIVE_STATUSES = ('pending', 'downloading', 'processing')
+
+def worker_id():
+    """Identify this worker process; changes after gunicorn forks"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def is_orphaned(owner):
+    """True if owner names a process on this host that no longer exists"""
+    host, _, pid = (owner or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+def is_reusable(task, reuse_ttl):
+    """True if a task can serve an identical request: still running, or completed recently"""
+    if task.status in ACTIVE_STATUSES:
+        return True
+    if task.status != 'completed' or not task.output_dir or not Path(task.output_dir).exists():
+        return False
+    return time.time() - (task.finished_at or 0) < reuse_ttl
+
+class MemoryTaskStore:
+    """Process-local task store, only suitable for a single worker (development)"""
+    def __init__(self):
+        self._tasks = {}
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def add(self, task):
+        self._tasks[task.task_id] = task
+
+    def get(self, task_id):
+        return self._tasks.get(task_id)
+
+    def version(self, task_id):
+        """Tasks are live objects here, there is no cheaper check than reading them"""
+        return None
+
+    def values(self):
+        return list(self._tasks.values())
+
+    def count(self, *statuses):
+        if not statuses:
+            return len(self._tasks)
+        return sum(1 for task in list(self._tasks.values()) if task.status in statuses)
+
+    def flush(self):
+        pass
+
+    def prune(self, max_age):
+        """Forget tasks that finished more than max_age seconds ago; running and queued ones stay"""
+        cutoff = time.time() - max_age
+        for task_id, task in list(self._tasks.items()):
+            if task.status not in ACTIVE_STATUSES and (task.finished_at or time.time()) < cutoff:
+                self._tasks.pop(task_id, None)
+        for batch_id, batch in list(self._batches.items()):
+            if batch.created_at.timestamp() < cutoff and not any(task_id in self._tasks for task_id in batch.task_ids()):
+                self._batches.pop(batch_id, None)
+
+    def add_batch(self, batch):
+        self._batches[batch.batch_id] = batch
+
+    def get_batch(self, batch_id):
+        return self._batches.get(batch_id)
+
+    def add_or_attach(self, task, reuse_ttl):
+        """Add task unless an identical one is running or recently completed; return the task to use"""
+        with self._lock:
+            for existing in reversed(list(self._tasks.values())):
+                if existing.dedupe_key == task.dedupe_key and is_reusable(existing, reuse_ttl):
+                    return existing
+            self.add(task)
+            return task
+
+    def find_snapshot(self, dedupe_key, snapshot):
+        for task in reversed(list(self._tasks.values())):
+            if (task.dedupe_key, task.snapshot) == (dedupe_key, snapshot) and task.status == 'completed' \
+                    and task.output_dir and Path(task.output_dir).exists():
+                return task
+        return None
+
+    def find_orphans(self):
+        # Every task lives in this process, nothing can be orphaned
+        return []
+
+    def adopt(self, task, owner):
+        task.owner = owner
+        return True
+
+    def release(self, task):
+        pass
+
+class SQLiteTaskStore:
+    """Task store shared by all worker processes through a SQLite database in WAL mode.
+
+    Tasks created by this process stay "owned" as live objects, so the download
+    thread just mutates attributes. A background writer diffs the owned tasks and
+    writes the changed ones in a single transaction every flush interval, so progress
+    updates never wait on the database. Other workers read the last flushed state.
+    """
+    def __init__(self, path, flush_interval=0.25):
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self._owned = {}
+        self._written = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._writer = None
+        self._writer_pid = None
+
+    def _create_tables(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                data TEXT NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_dedupe ON tasks (json_extract(data, '$.dedupe_key'))")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS batches (
+                batch_id TEXT PRIMARY KEY,
+                created_at REAL NOT NULL,
+                data TEXT NOT NULL
+            )
+        """)
+
+    def _connect(self):
+        return sqlite_connection(self._local, self.path, self._create_tables)
+
+    def _ensure_writer(self):
+        if self._writer_pid == os.getpid() and self._writer.is_alive():
+            return
+        with self._lock:
+            if self._writer_pid != os.getpid() or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, daemon=True)
+                self._writer_pid = os.getpid()
+                self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing task store: {e}")
+
+    def _row(self, task):
+        # Status column and data come from one snapshot, the download thread may change the task meanwhile
+        data = task.to_dict()
+        return (task.task_id, data['status'], task.created_at.timestamp(), time.time(), json.dumps(data))
+
+    def add(self, task):
+        row = self._row(task)
+        self._connect().execute("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?)", row)
+        self._owned[task.task_id] = task
+        self._written[task.task_id] = row[4]
+        self._ensure_writer()
+
+    def get(self, task_id):
+        task = self._owned.get(task_id)
+        if task is not None:
+            return task
+        row = self._connect().execute("SELECT data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return DownloadTask.from_dict(json.loads(row[0])) if row else None
+
+    def version(self, task_id):
+        """When a task was last written by its owner; None for tasks this process owns (read them live)"""
+        if task_id in self._owned:
+            return None
+        row = self._connect().execute("SELECT updated_at FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return row[0] if row else None
+
+    def values(self):
+        self.flush()
+        rows = self._connect().execute("SELECT data FROM tasks ORDER BY created_at").fetchall()
+        return [self._owned.get(task['task_id']) or DownloadTask.from_dict(task)
+                for task in (json.loads(row[0]) for row in rows)]
+
+    def count(self, *statuses):
+        self.flush()
+        if not statuses:
+            return self._connect().execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+        placeholders = ', '.join('?' for _ in statuses)
+        return self._connect().execute(
+            f"SELECT COUNT(*) FROM tasks WHERE status IN ({placeholders})", statuses
+        ).fetchone()[0]
+
+    def flush(self):
+        """Write every owned task that changed since the last flush in one transaction"""
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        rows = []
+        finished = []
+        for task_id, task in list(self._owned.items()):
+            row = self._row(task)
+            if row[4] != self._written.get(task_id):
+                rows.append(row)
+            # Decided on the written snapshot: a task that finishes after it is flushed once more
+            if row[1] not in ACTIVE_STATUSES:
+                finished.append(task_id)
+        if rows:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?)", rows)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            for row in rows:
+                self._written[row[0]] = row[4]
+        # Finished tasks no longer change, other readers can go through the database
+        for task_id in finished:
+            self._owned.pop(task_id, None)
+            self._written.pop(task_id, None)
+
+    def prune(self, max_age):
+        """Forget tasks that finished more than max_age seconds ago; running and queued ones stay.
+
+        Tasks written before finished_at was recorded for failures fall back to their last write.
+        """
+        placeholders = ', '.join('?' for _ in ACTIVE_STATUSES)
+        self._connect().execute(
+            f"DELETE FROM tasks WHERE status NOT IN ({placeholders}) "
+            "AND COALESCE(json_extract(data, '$.finished_at'), updated_at) < ?",
+            (*ACTIVE_STATUSES, time.time() - max_age)
+        )
+        # Batches go once none of their tasks is left
+        self._connect().execute(
+            "DELETE FROM batches WHERE created_at < ? AND NOT EXISTS ("
+            "SELECT 1 FROM json_each(batches.data, '$.playlists') AS playlist "
+            "JOIN tasks ON tasks.task_id = json_extract(playlist.value, '$.task_id'))",
+            (time.time() - max_age,)
+        )
+
+    def add_batch(self, batch):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO batches VALUES (?, ?, ?)",
+            (batch.batch_id, batch.created_at.timestamp(), json.dumps(batch.to_dict()))
+        )
+
+    def get_batch(self, batch_id):
+        row = self._connect().execute("SELECT data FROM batches WHERE batch_id = ?", (batch_id,)).fetchone()
+        return DownloadBatch.from_dict(json.loads(row[0])) if row else None
+
+    def add_or_attach(self, task, reuse_ttl):
+        """Add task unless an identical one is running or recently completed; return the task to use.
+
+        The lookup and insert share one write transaction, so concurrent requests in
+        different workers cannot both start the same download.
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT data FROM tasks WHERE json_extract(data, '$.dedupe_key') = ? ORDER BY created_at DESC LIMIT 5",
+                (task.dedupe_key,)
+            ).fetchall()
+            candidates = [self._owned.get(t['task_id']) or DownloadTask.from_dict(t) for t in (json.loads(r[0]) for r in rows)]
+            existing = next((t for t in candidates if is_reusable(t, reuse_ttl)), None)
+            if existing is None:
+                row = self._row(task)
+                conn.execute("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?)", row)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if existing is not None:
+            return existing
+        self._owned[task.task_id] = task
+        self._written[task.task_id] = row[4]
+        self._ensure_writer()
+        return task
+
+    def find_snapshot(self, dedupe_key, snapshot):
+        """Most recent completed task with the same request and resolved track list"""
+        rows = self._connect().execute(
+            "SELECT data FROM tasks WHERE json_extract(data, '$.dedupe_key') = ? AND status = 'completed' "
+            "AND json_extract(data, '$.snapshot') = ? ORDER BY created_at DESC LIMIT 5",
+            (dedupe_key, snapshot)
+        ).fetchall()
+        for row in rows:
+            task = DownloadTask.from_dict(json.loads(row[0]))
+            if task.output_dir and Path(task.output_dir).exists():
+                return task
+        return None
+
+    def find_orphans(self):
+        """Unfinished tasks whose worker process on this host has died"""
+        placeholders = ', '.join('?' for _ in ACTIVE_STATUSES)
+        rows = self._connect().execute(
+            f"SELECT data FROM tasks WHERE status IN ({placeholders}) AND json_extract(data, '$.owner') LIKE ?",
+            (*ACTIVE_STATUSES, f"{socket.gethostname()}:%")
+        ).fetchall()
+        tasks = [DownloadTask.from_dict(json.loads(row[0])) for row in rows]
+        return [task for task in tasks if task.task_id not in self._owned and is_orphaned(task.owner)]
+
+    def adopt(self, task, owner):
+        """Atomically take over an orphaned task; False if another worker got it first"""
+        cursor = self._connect().execute(
+            "UPDATE tasks SET data = json_set(data, '$.owner', ?) WHERE task_id = ? AND json_extract(data, '$.owner') = ?",
+            (owner, task.task_id, task.owner)
+        )
+        if cursor.rowcount != 1:
+            return False
+        task.owner = owner
+        self._owned[task.task_id] = task
+        self._written[task.task_id] = None
+        self._ensure_writer()
+        return True
+
+    def disown(self, task_id):
+        """Stop owning a task without writing it, e.g. after another worker took over its job"""
+        with self._flush_lock:
+            self._owned.pop(task_id, None)
+            self._written.pop(task_id, None)
+
+    def release(self, task):
+        """Write out an owned task and stop owning it, so another process can adopt it"""
+        with self._flush_lock:
+            self._flush()
+            if self._owned.get(task.task_id) is task:
+                self._owned.pop(task.task_id)
+                self._written.pop(task.task_id, None)
+
+def create_task_store():
+    """Build the task store selected by the TASK_STORE environment variable"""
+    if TASK_STORE_BACKEND == 'memory':
+        return MemoryTaskStore()
+    if TASK_STORE_BACKEND == 'sqlite':
+        return SQLiteTaskStore(TASK_STORE_PATH, TASK_STORE_FLUSH_INTERVAL)
+    raise ValueError(f"Unknown TASK_STORE backend: {TASK_STORE_BACKEND}")
+
+# Store download tasks
+task_store = create_task_store()
+
+track_cache = TrackCache(CACHE_DIR, TRACK_CACHE_MAX_BYTES)
+metadata_cache = MetadataCache(METADATA_CACHE_PATH, METADATA_CACHE_MAX_BYTES)
+disk_usage = DiskUsageIndex(DISK_INDEX_PATH)
+
+# Prometheus metrics, recorded at state transitions so a scrape never looks at tasks
+metrics_registry = MetricsRegistry(METRICS_PATH, 'playlist_downloader')
+metrics_registry.counter('jobs_submitted_total', 'Download jobs accepted into the queue')
+metrics_registry.counter('batches_submitted_total', 'Batches accepted through POST /batch')
+metrics_registry.counter('jobs_completed_total', 'Download jobs that completed')
+metrics_registry.counter('jobs_failed_total', 'Download jobs that failed, by error class')
+metrics_registry.histogram('queue_wait_seconds', 'Time from submission until a worker started the job')
+metrics_registry.histogram('resolve_seconds', 'Time to resolve the track list of a job')
+metrics_registry.histogram('download_seconds', 'Time spent in spotDL per job, retries and backoff included')
+metrics_registry.histogram('transcode_seconds', 'Time per ffmpeg transcode')
+metrics_registry.histogram('archive_seconds', 'Time to build the ZIP archive of a job')
+metrics_registry.histogram('track_download_seconds', 'Time from the start of a spotDL run until one of its tracks was converted',
+                           buckets=(1, 2, 5, 10, 20, 30, 60, 120, 300))
+
 def validate_url(url):
     """Validate if the URL is from supported platforms"""
     if not url or not isinstance(url, str):
@@ -138,6 +750,22 @@ def validate_url(url):
     
     return any(domain in url for domain in supported_domains) and url.startswith('http')
 
+def normalize_url(url):
+    """Canonical form of a playlist/track URL so identical requests share one download"""
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower()
+    if host.startswith('www.') or host.startswith('m.'):
+        host = host.split('.', 1)[1]
+    path = parsed.path.rstrip('/')
+    if 'spotify.com' in host:
+        # Drop locale prefixes (/intl-de/) and share tracking parameters (?si=...)
+        path = re.sub(r'^/intl-[a-z]{2}(-[a-z]{2})?', '', path, flags=re.IGNORECASE)
+        return f"https://{host}{path}"
+    # YouTube: only the video and playlist parameters identify the content
+    params = parse_qs(parsed.query)
+    query = urlencode(sorted((key, params[key][0]) for key in ('v', 'list') if key in params))
+    return f"https://{host}{path}" + (f"?{query}" if query else '')
+
 def is_spotify_url(url):
     """Check if URL is from Spotify"""
     return 'spotify.com' in url.lower()
@@ -152,49 +780,623 @@ def exponential_backoff(attempt, base_delay=1, max_delay=60):
     delay = base_delay * (2 ** attempt) + random.uniform(0, 1)
     return min(delay, max_delay)
 
-def rate_limit():
-    """Implement rate limiting for API calls"""
-    global last_request_time
-    current_time = time.time()
-    time_since_last = current_time - last_request_time
-    
-    if time_since_last < min_request_interval:
-        sleep_time = min_request_interval - time_since_last
-        time.sleep(sleep_time)
-    
-    last_request_time = time.time()
+concurrency = AdaptiveConcurrency(JOB_CONCURRENCY, TRACK_THREADS, TRACK_LATENCY_TARGET)
+
+def metadata_bucket(url):
+    """Upstream that resolves playlist/track metadata for a URL"""
+    if is_spotify_url(url):
+        return 'spotify' if spotify_auth_args() else 'spotify-anon'
+    return 'youtube-music'
+
+def download_buckets(url):
+    """Upstreams hit once per downloaded track: the first audio provider and, for Spotify, lyrics"""
+    if is_spotify_url(url):
+        return ('youtube', 'lyrics')
+    return ('youtube-music',)
+
+rate_limiter = TokenBucketLimiter(RATE_LIMIT_PATH, RATE_LIMITS)
 
 def validate_format(format_type):
     """Validate if the format is supported"""
     return format_type in ['wav', 'flac', 'mp3']
 
+def parse_formats(data):
+    """Requested formats from a download request body: 'formats' (list or comma string) or 'format'"""
+    formats = data.get('formats') or data.get('format') or 'mp3'
+    if isinstance(formats, str):
+        formats = formats.split(',')
+    if not isinstance(formats, list):
+        return []
+    return sorted({str(fmt).strip().lower() for fmt in formats})
+
+DISK_AREAS = {'downloads': DOWNLOADS_DIR, 'output': OUTPUT_DIR, 'temp': TEMP_DIR}
+
+def in_progress(path):
+    """True for job files a running task still writes: its work dir, job dir or partial archive"""
+    match = re.match(r'(?:task|download)_([0-9]+_[0-9a-f]+)', path.name)
+    task = task_store.get(match.group(1)) if match else None
+    return task is not None and task.status in ACTIVE_STATUSES
+
 def clean_old_files():
-    """Clean up old downloads and temporary files"""
+    """Remove expired job outputs and keep disk usage within DISK_BUDGET_BYTES"""
     try:
-        current_time = time.time()
-        cleanup_age = 3600  # 1 hour in seconds
-        
-        for directory in [DOWNLOADS_DIR, TEMP_DIR, OUTPUT_DIR]:
-            if directory.exists():
-                for file_path in directory.glob('*'):
-                    if file_path.is_file():
-                        file_age = current_time - file_path.stat().st_mtime
-                        if file_age > cleanup_age:
-                            file_path.unlink()
-                            app.logger.info(f"Cleaned up old file: {file_path}")
-                    elif file_path.is_dir():
-                        dir_age = current_time - file_path.stat().st_mtime
-                        if dir_age > cleanup_age:
-                            shutil.rmtree(file_path)
-                            app.logger.info(f"Cleaned up old directory: {file_path}")
+        expired = disk_usage.pop_expired()
+        evicted = disk_usage.enforce_budget(DISK_BUDGET_BYTES, DISK_MIN_RETENTION)
+        if expired or evicted:
+            app.logger.info(f"Cleaned up {expired} expired and {evicted} outputs over the disk budget")
+        
+        # Forget finished tasks whose files have just been removed
+        task_store.prune(OUTPUT_TTL)
+        
+        # Keep the shared track and metadata caches within their budgets
+        track_cache.evict()
+        metadata_cache.evict()
     except Exception as e:
         app.logger.error(f"Error during cleanup: {e}")
 
+def spotify_auth_args():
+    """spotDL arguments for Spotify API authentication, if credentials are configured"""
+    client_id = os.getenv('SPOTIFY_CLIENT_ID')
+    client_secret = os.getenv('SPOTIFY_CLIENT_SECRET')
+    if client_id and client_secret:
+        return ['--client-id', client_id, '--client-secret', client_secret]
+    return []
+
+def song_display_name(song):
+    """'Artists - Title', as in spotDL's default output template"""
+    artists = ', '.join(song.get('artists') or [song.get('artist') or 'Unknown Artist'])
+    return f"{artists} - {song.get('name') or 'Unknown'}"
+
+def spotdl_display_name(song):
+    """'Artist - Title' with only the main artist, the name spotDL prints in its track lines"""
+    artist = song.get('artist') or (song.get('artists') or ['Unknown Artist'])[0]
+    return f"{artist} - {song.get('name') or 'Unknown'}"
+
+def track_filename(song, extension):
+    """Archive file name for a resolved song"""
+    name = re.sub(r'[\\/:*?"<>|]', '', song_display_name(song)).strip()
+    return f"{name}{extension}"
+
+def link_track(source, target_dir, filename):
+    """Hard-link a cached track into a job directory (copying across filesystems)"""
+    target = target_dir / filename
+    counter = 2
+    while target.exists():
+        target = target_dir / f"{Path(filename).stem} ({counter}){Path(filename).suffix}"
+        counter += 1
+    try:
+        os.link(source, target)
+    except FileNotFoundError:
+        # Evicted between lookup and link
+        return None
+    except OSError:
+        shutil.copy2(source, target)
+    return target
+
+def transcode(source, target, format_type):
+    """Convert an audio file with ffmpeg on a single core, keeping its tags and cover art"""
+    partial = target.with_name(f"{target.name}.part")
+    cmd = [
+        FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y',
+        '-i', str(source),
+        '-map', '0:a', '-map_metadata', '0',
+        '-metadata', 'METADATA_BLOCK_PICTURE=',  # the cover is mapped as a picture, not copied as a text tag
+        '-threads', '1',
+        *TRANSCODE_ARGS[format_type],
+        '-f', format_type, str(partial)
+    ]
+    with metrics_registry.timer('transcode_seconds'):
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
+    if result.returncode != 0:
+        partial.unlink(missing_ok=True)
+        raise RuntimeError(result.stderr.strip()[-500:] or f"ffmpeg exited with {result.returncode}")
+    os.replace(partial, target)
+
+_transcode_pool = {'pid': None, 'executor': None}
+
+def transcode_pool():
+    """Executor shared by all jobs of this process; each slot runs one ffmpeg process"""
+    if _transcode_pool['pid'] != os.getpid():
+        _transcode_pool['executor'] = ThreadPoolExecutor(TRANSCODE_WORKERS, thread_name_prefix='transcode')
+        _transcode_pool['pid'] = os.getpid()
+    return _transcode_pool['executor']
+
+def load_manifest(path):
+    """Per-task manifest of resolved songs and finished tracks ({} if there is none yet)"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_manifest(path, manifest):
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+def check_ffmpeg():
+    """Log at start-up when ffmpeg is missing; multi-format downloads fail without it"""
+    if shutil.which(FFMPEG_BINARY) is None:
+        logger.error(f"ffmpeg not found ({FFMPEG_BINARY}), multi-format downloads will fail")
+
+class JobFiles:
+    """The output of one job: cached tracks linked into its download directory and the
+    transcodes that produce the extra formats of multi-format jobs.
+
+    Every linked file is recorded in the task manifest, so a resumed job keeps it.
+    Multi-format jobs get a folder per format; their transcodes run on the shared pool
+    and overlap with further downloads until wait_transcodes() collects them.
+    """
+    def __init__(self, download_dir, work_dir, formats, manifest):
+        self.download_dir = download_dir
+        self.staging_dir = work_dir / 'staging'
+        self.formats = formats
+        self.multi = len(formats) > 1
+        self.manifest = manifest
+        self.manifest_path = work_dir / 'manifest.json'
+        self.done = manifest.setdefault('done', {})  # cache key -> file path relative to download_dir
+        self.tracks = None  # TrackProgress of the job, told about every file as it is linked
+        self.transcodes = []  # (song, future) for outputs being produced on the transcode pool
+        self._lock = threading.Lock()  # transcodes finish on pool threads
+
+    def save(self):
+        with self._lock:
+            save_manifest(self.manifest_path, self.manifest)
+
+    def deliver(self, song, fmt, cached):
+        """Link a cached track into the job directory; None if it was evicted meanwhile"""
+        target_dir = self.download_dir / fmt if self.multi else self.download_dir
+        target_dir.mkdir(exist_ok=True)
+        linked = link_track(cached, target_dir, track_filename(song, cached.suffix))
+        if linked is None:
+            return None
+        with self._lock:
+            self.done[TrackCache.key(song, fmt, DOWNLOAD_BITRATE)] = str(linked.relative_to(self.download_dir))
+            save_manifest(self.manifest_path, self.manifest)
+        self.tracks.add_file(song, linked.relative_to(self.download_dir).as_posix())
+        return linked
+
+    def delivered(self, song, fmt):
+        path = self.done.get(TrackCache.key(song, fmt, DOWNLOAD_BITRATE))
+        return self.download_dir / path if path and (self.download_dir / path).exists() else None
+
+    def delivered_files(self, song):
+        """Files of a song already in the job directory, relative to it"""
+        paths = (self.delivered(song, fmt) for fmt in self.formats)
+        return [path.relative_to(self.download_dir).as_posix() for path in paths if path]
+
+    def missing_formats(self, song):
+        """Requested formats of a song that are not in the job yet, after linking cached ones"""
+        missing = []
+        for fmt in self.formats:
+            if self.delivered(song, fmt):
+                continue
+            # A transcode is only used where another one would be made: in multi-format jobs
+            variants = (DOWNLOAD_BITRATE, TRANSCODE_VARIANT) if self.multi else (DOWNLOAD_BITRATE,)
+            cached = next(filter(None, (track_cache.lookup(TrackCache.key(song, fmt, v)) for v in variants)), None)
+            if not (cached and self.deliver(song, fmt, cached)):
+                missing.append(fmt)
+        return missing
+
+    def fan_out(self, song, source, missing):
+        """Queue the transcodes of a fetched source into the missing formats"""
+        for fmt in missing:
+            self.transcodes.append((song, transcode_pool().submit(self._transcode_track, song, source, fmt)))
+
+    def _transcode_track(self, song, source, fmt):
+        self.staging_dir.mkdir(parents=True, exist_ok=True)
+        staged = self.staging_dir / f"{song.get('song_id')}.{fmt}"
+        transcode(source, staged, fmt)
+        cached = track_cache.store(TrackCache.key(song, fmt, TRANSCODE_VARIANT), staged)
+        if self.deliver(song, fmt, cached) is None:
+            raise RuntimeError('transcoded track was evicted before it could be linked')
+
+    def transcode_sources(self, source_dir):
+        """Without a track list, transcode every fetched file straight into the job"""
+        for source in sorted(source_dir.glob('*')):
+            for fmt in self.formats:
+                (self.download_dir / fmt).mkdir(exist_ok=True)
+                target = self.download_dir / fmt / f"{source.stem}.{fmt}"
+                self.transcodes.append(({'name': source.stem}, transcode_pool().submit(transcode, source, target, fmt)))
+
+    def wait_transcodes(self, task, timeline):
+        """Wait for the queued transcodes; a track with a failed one is marked failed"""
+        if not self.transcodes:
+            return
+        task.message = f'Transcoding {len(self.transcodes)} files...'
+        # Most transcodes overlap with the download, this span is only the wait for the rest
+        with timeline.span('transcode', files=len(self.transcodes)) as span:
+            for song, future in self.transcodes:
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.warning(f"Transcoding failed for {song_display_name(song)}: {e}")
+                    self.tracks.mark_failed(song_display_name(song), f'Transcoding failed: {e}')
+                    span['failed'] = span.get('failed', 0) + 1
+
+def tracklist_ttl(url):
+    """How long a resolved track list stays cached: playlists change, albums and tracks do not"""
+    lowered = url.lower()
+    if '/album/' in lowered or '/track/' in lowered or ('watch?v=' in lowered and 'list=' not in lowered):
+        return METADATA_TTLS['album']
+    return METADATA_TTLS['playlist']
+
+def resolve_playlist(url, work_dir, timeline=None):
+    """Resolve a URL into spotDL song dicts, from the metadata cache or with `spotdl save`; None if it cannot be resolved"""
+    cache_key = normalize_url(url)
+    songs = metadata_cache.get('tracks', cache_key)
+    if songs:
+        logger.info(f"Resolved {len(songs)} tracks for {url} from the metadata cache")
+        return songs
+    
+    # Wait for a metadata token before asking the provider
+    waited = rate_limiter.acquire(metadata_bucket(url))
+    if timeline:
+        timeline.waited('rate_limit_wait', waited, buckets=metadata_bucket(url))
+    save_file = work_dir / 'playlist.spotdl'
+    cmd = [*SPOTDL_COMMAND, 'save', url, '--save-file', str(save_file)]
+    if is_spotify_url(url):
+        cmd.extend(spotify_auth_args())
+    
+    try:
+        returncode, output = run_spotdl(cmd, lambda *event: None, track_timeout=300, timeout=300)
+    except subprocess.TimeoutExpired:
+        logger.warning(f"Timed out resolving tracks for {url}")
+        return None
+    
+    if returncode != 0 or not save_file.exists():
+        logger.warning(f"Could not resolve tracks for {url}: {output.strip()}")
+        return None
+    
+    with open(save_file) as f:
+        songs = json.load(f)
+    songs = [song for song in songs if song.get('song_id') or song.get('url')] or None
+    if songs:
+        metadata_cache.put('tracks', cache_key, songs, tracklist_ttl(url))
+    return songs
+
+# Lines spotDL prints at INFO, mapped to track events. A failing track only logs a bare
+# 'XError: message' while the run goes on; which track failed comes from the
+# '{song url} - XError: message' summary that --print-errors adds when the run ends
+SPOTDL_EVENT_PATTERNS = [
+    ('resolved', re.compile(r'Found (\d+) songs? in')),
+    ('converted', re.compile(r'Downloaded "(.+)": (\S+)')),
+    ('converted', re.compile(r'Skipping (.+?) \((?:file already exists|duplicate)')),
+    ('failed', re.compile(r'(https?://\S+) - (\w+Error: .+)')),
+    ('error', re.compile(r'(\w+Error): (.+)')),
+]
+
+def parse_spotdl_line(line):
+    """Return (event, name, detail) for a spotDL output line, or None"""
+    for event, pattern in SPOTDL_EVENT_PATTERNS:
+        match = pattern.search(line)
+        if match:
+            groups = match.groups()
+            return event, groups[0], groups[1] if len(groups) > 1 else None
+    return None
+
+class Timeline:
+    """Records the spans of a task run on the task and as JSON lines in the timeline log"""
+    def __init__(self, task):
+        self.task = task
+
+    def record(self, name, start, duration, **attrs):
+        span = {'name': name, 'start': round(start, 3), 'duration': round(duration, 3), **attrs}
+        self.task.timeline.append(span)
+        timeline_logger.info(json.dumps({'task_id': self.task.task_id, 'worker': worker_id(), **span}))
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """Time a block; the caller may add attributes to the yielded dict"""
+        started = time.time()
+        try:
+            yield attrs
+        except BaseException as e:
+            attrs['error'] = f"{type(e).__name__}: {e}"[:200]
+            raise
+        finally:
+            self.record(name, started, time.time() - started, **attrs)
+
+    def waited(self, name, seconds, **attrs):
+        """Record a wait that already happened, e.g. rate limiter sleeps (skipped when it was 0)"""
+        if seconds > 0:
+            self.record(name, time.time() - seconds, seconds, **attrs)
+
+    def sleep(self, seconds, reason):
+        """Back off for seconds, recorded as a 'backoff' span"""
+        with self.span('backoff', reason=reason):
+            time.sleep(seconds)
+
+class TrackProgress:
+    """Applies spotDL track events to a task's per-track status and counters"""
+    def __init__(self, task, on_converted=None):
+        self.task = task
+        self.on_converted = on_converted  # called with (key, song, source_url), returns the track's size in bytes
+        self._by_name = {}
+        self._aliases = {}  # spotDL's display name and the song URL, the keys its track lines carry
+        self.runs = 0
+        self.run_started = time.monotonic()
+
+    def start_run(self, songs=()):
+        """Called before each spotDL run with the songs it gets; they show as downloading until it reports them"""
+        self.runs += 1
+        self.run_started = time.monotonic()
+        for song in songs:
+            found = self._find(song_display_name(song))
+            if found is not None and found[0]['status'] == 'queued':
+                found[0]['status'] = 'downloading'
+
+    def end_run(self):
+        """Put tracks the finished run did not report back in the queue, for the retry or the final check"""
+        for entry, _, _ in self._by_name.values():
+            if entry['status'] == 'downloading':
+                entry['status'] = 'queued'
+
+    def add(self, song, status='queued', key=None, size=0, name=None, files=None):
+        entry = {'name': name or song_display_name(song), 'status': status, 'error': None, 'files': files or []}
+        self.task.tracks.append(entry)
+        self._by_name[entry['name'].lower()] = (entry, key, song)
+        if song:
+            self._aliases[spotdl_display_name(song).lower()] = self._by_name[entry['name'].lower()]
+            if song.get('url'):
+                self._aliases[song['url'].lower()] = self._by_name[entry['name'].lower()]
+        self.task.tracks_total = len(self.task.tracks)
+        if status in ('cached', 'converted'):
+            self.task.tracks_done += 1
+            self.task.bytes_downloaded += size
+        self._update_progress()
+
+    def _find(self, name):
+        return self._by_name.get(name.lower()) or self._aliases.get(name.lower())
+
+    def handle(self, event, name, detail):
+        if event == 'resolved':
+            if not self._by_name:
+                self.task.tracks_total = int(name)
+            return
+        if event == 'error':
+            # Which track it was is only known from the error summary at the end of the run
+            logger.warning(f"spotDL error for task {self.task.task_id}: {name}: {detail}")
+            return
+        
+        found = self._find(name)
+        if found is None:
+            per_track = event == 'converted' or (event == 'failed' and '://' in name)
+            if per_track and not self._by_name:
+                # spotDL resolved the URL itself (no track list up front): count the track only
+                if event == 'converted':
+                    self.task.tracks_done += 1
+                else:
+                    self.task.tracks_failed += 1
+                self._update_progress()
+            elif event == 'failed':
+                logger.warning(f"spotDL error for task {self.task.task_id} on an unknown track: {name}: {detail}")
+            return
+        
+        entry, key, song = found
+        if entry['status'] in ('converted', 'cached', 'failed'):
+            return
+        if event == 'converted':
+            size = self.on_converted(key, song, detail) if self.on_converted and key else 0
+            if size is None:
+                return
+            metrics_registry.observe('track_download_seconds', time.monotonic() - self.run_started)
+            entry['status'] = 'converted'
+            self.task.tracks_done += 1
+            self.task.bytes_downloaded += size
+        elif event == 'failed':
+            entry['status'] = 'failed'
+            entry['error'] = detail
+            self.task.tracks_failed += 1
+        self.task.tracks_total = max(self.task.tracks_total, len(self.task.tracks))
+        self._update_progress()
+
+    def retry_failed(self):
+        """Queue failed tracks again before another spotDL attempt; returns the keys of those that stay failed.
+
+        A track that was not found fails the same way every time, the others (rate limits,
+        provider and network errors) may get through on another attempt.
+        """
+        settled = set()
+        for entry, key, _ in self._by_name.values():
+            if entry['status'] != 'failed':
+                continue
+            if classify_error(entry['error'] or '') == 'not_found':
+                settled.add(key)
+                continue
+            entry['status'] = 'queued'
+            entry['error'] = None
+            self.task.tracks_failed -= 1
+        return settled
+
+    def retryable(self, keys):
+        """{key: error} of the given tracks that are not done and might be on another attempt"""
+        errors = {}
+        for entry, key, _ in self._by_name.values():
+            if key in keys and entry['status'] in ('queued', 'failed'):
+                error = entry['error'] or 'Track was not downloaded'
+                if classify_error(error) != 'not_found':
+                    errors[key] = error
+        return errors
+
+    def add_file(self, song, path):
+        """Publish a file of a track (relative to the job directory) as soon as it is in place"""
+        found = self._by_name.get(song_display_name(song).lower())
+        if found is not None and path not in found[0]['files']:
+            found[0]['files'].append(path)
+
+    def mark_cached(self, name, size):
+        """Complete a queued track from the cache, e.g. one another job just downloaded"""
+        found = self._find(name)
+        if found is None or found[0]['status'] in ('converted', 'cached', 'failed'):
+            return
+        found[0]['status'] = 'cached'
+        self.task.tracks_done += 1
+        self.task.bytes_downloaded += size
+        self._update_progress()
+
+    def mark_failed(self, name, error):
+        """Fail a track after the fact, e.g. when one of its transcodes failed"""
+        found = self._find(name)
+        if found is None or found[0]['status'] == 'failed':
+            return
+        entry = found[0]
+        if entry['status'] in ('converted', 'cached'):
+            self.task.tracks_done -= 1
+        entry['status'] = 'failed'
+        entry['error'] = error
+        self.task.tracks_failed += 1
+        self._update_progress()
+
+    def _update_progress(self):
+        if self.task.tracks_total:
+            finished = self.task.tracks_done + self.task.tracks_failed
+            self.task.progress = 10 + int(85 * finished / self.task.tracks_total)
+            self.task.message = f'Downloaded {self.task.tracks_done} of {self.task.tracks_total} tracks...'
+
+engine_pool = EnginePool(SPOTDL_ENGINE_PROCESSES, env={
+    'METADATA_CACHE_PATH': str(METADATA_CACHE_PATH.resolve()),
+    'METADATA_CACHE_MAX_BYTES': str(METADATA_CACHE_MAX_BYTES),
+    'METADATA_LYRICS_TTL': str(METADATA_TTLS['lyrics']),
+}) if SPOTDL_ENGINE == 'pool' else None
+
+def start_spotdl(cmd):
+    """Start a spotDL command line, in a warm engine process when SPOTDL_ENGINE=pool"""
+    if engine_pool is not None:
+        return engine_pool.submit(cmd[len(SPOTDL_COMMAND):])  # drop `python -m spotdl`
+    return subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1,
+        cwd=str(Path.cwd())
+    )
+
+def run_spotdl(cmd, on_event, track_timeout=SPOTDL_TRACK_TIMEOUT, timeout=SPOTDL_TIMEOUT, check=None):
+    """Run spotDL, reading its output as it is produced and reporting per-track events.
+
+    Returns (returncode, output) where output holds the last lines that were not track
+    events. Kills spotDL and raises subprocess.TimeoutExpired when no track event arrives
+    within track_timeout seconds or the whole run exceeds timeout. check is called at
+    least every second and kills spotDL by raising.
+    """
+    process = start_spotdl(cmd)
+    lines = queue.Queue()
+    
+    def pump():
+        for line in process.stdout:
+            lines.put(line)
+        lines.put(None)
+    
+    threading.Thread(target=pump, daemon=True).start()
+    output = deque(maxlen=200)
+    started = last_event = time.monotonic()
+    try:
+        while True:
+            now = time.monotonic()
+            wait = min(last_event + track_timeout, started + timeout) - now
+            if wait <= 0:
+                stalled = now - last_event >= track_timeout
+                logger.error(f"Killing spotDL: {'no track progress for %ds' % track_timeout if stalled else 'run exceeded %ds' % timeout}")
+                raise subprocess.TimeoutExpired(cmd, track_timeout if stalled else timeout)
+            if check:
+                check()
+            try:
+                line = lines.get(timeout=min(wait, 1))
+            except queue.Empty:
+                continue
+            if line is None:
+                break
+            line = line.rstrip()
+            event = parse_spotdl_line(line)
+            if event and event[0] not in ('failed', 'error'):
+                last_event = time.monotonic()
+                on_event(*event)
+                continue
+            output.append(line)
+            if event:
+                last_event = time.monotonic()
+                on_event(*event)
+        return process.wait(), '\n'.join(output)
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+def build_spotdl_command(query, output, url, format_type, threads, bitrate=DOWNLOAD_BITRATE):
+    """spotDL download command for a query (URL or .spotdl file) with options for the source URL"""
+    # Prepare spotDL command with enhanced options
+    cmd = [
+        *SPOTDL_COMMAND,
+        query,
+        '--format', format_type,
+        '--output', output,
+        '--threads', str(threads),  # Adjusted at runtime by the concurrency controller
+        '--bitrate', bitrate,
+        '--max-retries', '5',
+        '--sponsor-block',  # Skip sponsor segments in YouTube
+        '--simple-tui',  # Plain per-track lines we can parse as they arrive
+        '--print-errors',  # '{song url} - XError: message' per failed track when the run ends
+        '--log-level', SPOTDL_LOG_LEVEL,
+    ]
+    
+    # Add specific options based on URL type
+    if is_spotify_url(url):
+        # For Spotify URLs, use specific audio providers and retry settings
+        cmd.extend([
+            '--audio', 'youtube', 'youtube-music',
+            '--lyrics', 'genius', 'musixmatch',
+            '--dont-filter-results',  # Reduce API calls
+        ])
+        
+        # Add Spotify authentication if available
+        auth_args = spotify_auth_args()
+        if auth_args:
+            cmd.extend(auth_args)
+            logger.info("Using Spotify authentication")
+        else:
+            logger.warning("No Spotify credentials found. This may cause rate limiting.")
+    
+    elif is_youtube_url(url):
+        cmd.extend([
+            '--audio', 'youtube-music', 'youtube',
+            '--ytm-data',  # Use YouTube Music data when available
+        ])
+    
+    logger.info(f"Running command: {' '.join(cmd)}")
+    return cmd
+
+def fail_download(task, error, message, reason):
+    """Mark a task failed and remove its partial download and work directories"""
+    task.status = 'error'
+    task.error = error
+    task.message = message
+    task.output_dir = None
+    task.finished_at = time.time()
+    metrics_registry.inc('jobs_failed_total', reason=reason)
+    shutil.rmtree(DOWNLOADS_DIR / f"download_{task.task_id}", ignore_errors=True)
+    shutil.rmtree(TEMP_DIR / f"task_{task.task_id}", ignore_errors=True)
+
 def download_playlist(task_id, url, format_type):
-    """Download playlist using spotDL with enhanced error handling and retry logic"""
-    task = download_tasks[task_id]
+    """Download playlist using spotDL with enhanced error handling and retry logic.
+
+    format_type is one format or several joined by '+' (e.g. 'flac+mp3'). Multi-format
+    jobs fetch each track once in its source format and transcode it on the shared pool.
+    """
+    task = task_store.get(task_id)
     max_retries = 3
     base_delay = 5
+    formats = format_type.split('+')
+    multi = len(formats) > 1
+    # What spotDL fetches: the requested format directly, or the source audio to transcode from
+    fetch_format, fetch_bitrate = (SOURCE_FORMAT, 'disable') if multi else (format_type, DOWNLOAD_BITRATE)
+    timeline = Timeline(task)
+    job_started = time.time()
+    profiler = start_profiler(task)
+    check_lease = lambda: scheduler.check_lease(task_id)
+    lease_lost = False
     
     try:
         # Update task status
@@ -204,108 +1406,278 @@ def download_playlist(task_id, url, format_type):
         
         # Create unique directory for this download
         download_dir = DOWNLOADS_DIR / f"download_{task_id}"
-        download_dir.mkdir(exist_ok=True)
+        download_dir.mkdir(parents=True, exist_ok=True)
+        work_dir = TEMP_DIR / f"task_{task_id}"
+        work_dir.mkdir(parents=True, exist_ok=True)
+        task.output_dir = str(download_dir)  # finished tracks can be downloaded from here right away
+        
+        if multi and shutil.which(FFMPEG_BINARY) is None:
+            raise Exception(f"ffmpeg ({FFMPEG_BINARY}) is not installed, it is needed to download several formats")
+        
+        # The manifest survives worker restarts, so an interrupted task resumes where it stopped
+        manifest = load_manifest(work_dir / 'manifest.json')
+        files = JobFiles(download_dir, work_dir, formats, manifest)
+        task.tracks = []
+        task.tracks_total = task.tracks_done = task.tracks_failed = task.bytes_downloaded = 0
+        
+        # Resolve the track list first so tracks already in the cache are not downloaded again
+        task.message = 'Resolving tracks...'
+        songs = manifest.get('songs')
+        if not songs:
+            with timeline.span('resolve') as span, metrics_registry.timer('resolve_seconds'):
+                songs = resolve_playlist(url, work_dir, timeline)
+                span['tracks'] = len(songs) if songs else None
+        manifest['songs'] = songs
         
-        # Implement rate limiting
-        rate_limit()
+        # Another task already produced this exact playlist version: reuse its output
+        if songs:
+            task.snapshot = hashlib.sha256(
+                json.dumps([song.get('song_id') or song.get('url') for song in songs]).encode()
+            ).hexdigest()
+            previous = task_store.find_snapshot(task.dedupe_key, task.snapshot) if task.dedupe_key else None
+            if previous:
+                # Restart its cleanup clock
+                disk_usage.touch(previous.output_dir, OUTPUT_TTL)
+                disk_usage.touch(archive_path(previous.output_dir), OUTPUT_TTL)
+                disk_usage.touch(archive_index_path(previous.output_dir), OUTPUT_TTL)
+                shutil.rmtree(download_dir, ignore_errors=True)
+                shutil.rmtree(work_dir, ignore_errors=True)
+                task.tracks = previous.tracks
+                task.tracks_total, task.tracks_done = previous.tracks_total, previous.tracks_done
+                task.tracks_failed, task.bytes_downloaded = previous.tracks_failed, previous.bytes_downloaded
+                task.output_dir = previous.output_dir
+                task.progress = 100
+                task.message = f'Download completed! {previous.tracks_done} tracks downloaded.'
+                task.finished_at = time.time()
+                task.status = 'completed'
+                metrics_registry.inc('jobs_completed_total')
+                logger.info(f"Task {task_id} reused the output of task {previous.task_id} (same playlist version)")
+                return
+        pending = {}  # cache key -> song still to be downloaded
+        shared = {}  # cache key -> song another job is downloading right now
+        matched = set()  # pending tracks whose audio source came from the metadata cache
+        staging_dir = files.staging_dir
         
-        # Try different approaches based on URL type
-        success = False
-        for attempt in range(max_retries):
+        def ingest(key, song, source_url=None):
+            """Move a finished track from staging into the cache and this job; returns its size"""
+            staged = next(staging_dir.glob(f"{song.get('song_id')}.*"), None) if staging_dir.exists() else None
+            if staged is None:
+                return None
+            if source_url and source_url != song.get('download_url'):
+                # Remember the match so the next download of this track skips the search
+                metadata_cache.put('match', track_ref(song), source_url, METADATA_TTLS['match'])
+            cached = track_cache.store(key, staged)
+            if multi:
+                files.fan_out(song, cached, files.missing_formats(song))
+            elif files.deliver(song, format_type, cached) is None:
+                return None
+            pending.pop(key, None)
+            return cached.stat().st_size
+        
+        def collect_unreported():
+            """Take in pending tracks spotDL finished without reporting them"""
+            for key, song in list(pending.items()):
+                tracks.handle('converted', song_display_name(song), None)
+        
+        def collect_shared():
+            """Wait until shared tracks are cached or handed back; returns the (key, song) pairs to fetch here"""
+            while True:
+                handed_back = []
+                for key, song in list(shared.items()):
+                    source = track_cache.lookup(key)
+                    if source is not None and (multi or files.deliver(song, format_type, source)):
+                        del shared[key]
+                        if multi:
+                            files.fan_out(song, source, files.missing_formats(song))
+                        tracks.mark_cached(song_display_name(song), source.stat().st_size)
+                    elif track_cache.claim(key, task_id, SPOTDL_TIMEOUT):
+                        # The other job failed the track or died, download it here
+                        del shared[key]
+                        pending[key] = song
+                        handed_back.append((key, song))
+                if handed_back or not shared:
+                    return handed_back
+                check_lease()
+                time.sleep(SHARED_TRACK_POLL_INTERVAL)
+        
+        tracks = files.tracks = TrackProgress(task, on_converted=ingest)
+        if songs:
+            for song in songs:
+                resumed = all(files.delivered(song, fmt) for fmt in formats)
+                missing = files.missing_formats(song)
+                if not missing:
+                    size = sum(files.delivered(song, fmt).stat().st_size for fmt in formats)
+                    tracks.add(song, status='converted' if resumed else 'cached', size=size, files=files.delivered_files(song))
+                    continue
+                key = TrackCache.key(song, fetch_format, fetch_bitrate)
+                source = track_cache.lookup(key) if multi else None
+                if source:
+                    # Fetched before for another multi-format job, only the transcodes are left
+                    tracks.add(song, status='cached', size=source.stat().st_size, files=files.delivered_files(song))
+                    files.fan_out(song, source, missing)
+                else:
+                    tracks.add(song, key=key, files=files.delivered_files(song))
+                    if track_cache.claim(key, task_id, SPOTDL_TIMEOUT):
+                        pending[key] = song
+                    else:
+                        # Another job (e.g. a playlist of the same batch) is fetching it already
+                        shared[key] = song
+            files.save()
+            logger.info(f"{len(songs) - len(pending) - len(shared)} of {len(songs)} tracks already available, "
+                        f"{len(shared)} being downloaded by other jobs for task {task_id}")
+            
+            # A cached match lets spotDL skip the audio search for the track
+            for key, song in pending.items():
+                match = metadata_cache.get('match', track_ref(song))
+                if match:
+                    song['download_url'] = match
+                    matched.add(key)
+            
+            # Download only the missing tracks, named by track ID so they can be matched back
+            query = str(work_dir / 'pending.spotdl')
+            output = str(staging_dir / '{track-id}.{output-ext}')
+        else:
+            # Resolution failed, let spotDL handle the URL directly without caching
+            query = url
+            output = str(work_dir / 'source') if multi else str(download_dir)
+        
+        # Try different approaches based on URL type (nothing to do when every track was cached)
+        success = songs is not None and not pending and not shared
+        download_started = time.monotonic()
+        for attempt in range(0 if success else max_retries):
             try:
+                if songs and not pending and not shared:
+                    # An earlier attempt finished every track before it failed
+                    success = True
+                    break
+                
                 if attempt > 0:
                     delay = exponential_backoff(attempt, base_delay)
                     logger.info(f"Retrying download (attempt {attempt + 1}/{max_retries}) after {delay:.2f}s delay")
                     task.message = f'Retrying download (attempt {attempt + 1}/{max_retries})...'
-                    time.sleep(delay)
+                    timeline.sleep(delay, 'retry')
+                
+                settled = set()
+                if songs:
+                    # Each attempt only asks spotDL for the tracks that are still missing or may still succeed
+                    settled = tracks.retry_failed()
+                    if attempt > 0:
+                        # The cached match may be what failed, search again for these tracks
+                        for key in matched & pending.keys():
+                            metadata_cache.delete('match', track_ref(pending[key]))
+                            pending[key].pop('download_url', None)
+                        matched.clear()
+                    logger.info(f"Downloading {len(pending)} remaining tracks for task {task_id}")
                 
                 # Update progress
                 task.message = f'Downloading tracks... (attempt {attempt + 1}/{max_retries})'
-                task.progress = 25
-                
-                # Prepare spotDL command with enhanced options
-                cmd = [
-                    sys.executable, '-m', 'spotdl',
-                    url,
-                    '--format', format_type,
-                    '--output', str(download_dir),
-                    '--threads', '2',  # Reduced threads to avoid rate limiting
-                    '--bitrate', '320k',
-                    '--max-retries', '5',
-                    '--sponsor-block',  # Skip sponsor segments in YouTube
-                ]
+                task.progress = max(task.progress, 10)
                 
-                # Add specific options based on URL type
-                if is_spotify_url(url):
-                    # For Spotify URLs, use specific audio providers and retry settings
-                    cmd.extend([
-                        '--audio', 'youtube', 'youtube-music',
-                        '--lyrics', 'genius', 'musixmatch',
-                        '--dont-filter-results',  # Reduce API calls
-                    ])
-                    
-                    # Add Spotify authentication if available
-                    client_id = os.getenv('SPOTIFY_CLIENT_ID')
-                    client_secret = os.getenv('SPOTIFY_CLIENT_SECRET')
-                    if client_id and client_secret:
-                        cmd.extend(['--client-id', client_id, '--client-secret', client_secret])
-                        logger.info("Using Spotify authentication")
-                    else:
-                        logger.warning("No Spotify credentials found. This may cause rate limiting.")
-                        # Add longer delay for unauthenticated requests
-                        time.sleep(2)
-                
-                elif is_youtube_url(url):
-                    cmd.extend([
-                        '--audio', 'youtube-music', 'youtube',
-                        '--ytm-data',  # Use YouTube Music data when available
-                    ])
-                
-                logger.info(f"Running command: {' '.join(cmd)}")
-                
-                # Run spotDL with timeout and better error handling
-                process = subprocess.run(
-                    cmd,
-                    capture_output=True,
-                    text=True,
-                    timeout=1800,  # 30 minutes timeout
-                    cwd=str(Path.cwd())
-                )
+                # Run spotDL, following per-track progress with a stuck-track watchdog
+                if songs:
+                    # Chunk by chunk, taking one provider token per track before each chunk
+                    # and picking up the current adaptive thread count
+                    remaining = [(key, song) for key, song in pending.items() if key not in settled]
+                    returncode, spotdl_output = 0, ''
+                    while remaining or shared:
+                        check_lease()
+                        if not remaining:
+                            # Own tracks are done, wait for the ones other jobs are fetching
+                            with timeline.span('shared_wait', tracks=len(shared)):
+                                remaining = collect_shared()
+                            continue
+                        # Renew the claims; a track another job claimed meanwhile is left to it
+                        chunk, claimed = [], []
+                        for key, song in remaining[:DOWNLOAD_CHUNK_SIZE]:
+                            if track_cache.claim(key, task_id, SPOTDL_TIMEOUT):
+                                chunk.append(song)
+                                claimed.append(key)
+                            else:
+                                shared[key] = pending.pop(key)
+                        remaining = remaining[DOWNLOAD_CHUNK_SIZE:]
+                        if not chunk:
+                            continue
+                        waited = rate_limiter.acquire(*download_buckets(url), tokens=len(chunk))
+                        timeline.waited('rate_limit_wait', waited, buckets='/'.join(download_buckets(url)), tokens=len(chunk))
+                        with open(query, 'w') as f:
+                            json.dump(chunk, f)
+                        threads = concurrency.track_threads
+                        cmd = build_spotdl_command(query, output, url, fetch_format, threads, fetch_bitrate)
+                        chunk_started = time.monotonic()
+                        tracks.start_run(chunk)
+                        try:
+                            with timeline.span('spotdl', attempt=attempt + 1, tracks=len(chunk), threads=threads) as span:
+                                returncode, spotdl_output = run_spotdl(cmd, tracks.handle, check=check_lease)
+                                span['returncode'] = returncode
+                        finally:
+                            tracks.end_run()
+                        # Finished and failed tracks alike; failed ones are claimed again on retry
+                        track_cache.release(task_id, claimed)
+                        if any(keyword in spotdl_output.lower() for keyword in RATE_LIMIT_KEYWORDS):
+                            concurrency.on_rate_limited()
+                        elif returncode == 0:
+                            concurrency.on_chunk(len(chunk), time.monotonic() - chunk_started, threads)
+                        if returncode != 0:
+                            break
+                else:
+                    # spotDL resolves the URL itself, which costs a metadata token
+                    waited = rate_limiter.acquire(metadata_bucket(url))
+                    timeline.waited('rate_limit_wait', waited, buckets=metadata_bucket(url))
+                    cmd = build_spotdl_command(query, output, url, fetch_format, concurrency.track_threads, fetch_bitrate)
+                    tracks.start_run()
+                    with timeline.span('spotdl', attempt=attempt + 1, threads=concurrency.track_threads) as span:
+                        returncode, spotdl_output = run_spotdl(cmd, tracks.handle, check=check_lease)
+                        span['returncode'] = returncode
+                    if any(keyword in spotdl_output.lower() for keyword in RATE_LIMIT_KEYWORDS):
+                        concurrency.on_rate_limited()
                 
-                if process.returncode == 0:
+                retry = {}
+                if returncode == 0 and songs:
+                    # spotDL exits 0 even when tracks failed on a 429 or a provider error,
+                    # so another attempt is made for those tracks (the manifest keeps the rest)
+                    collect_unreported()
+                    retry = tracks.retryable(pending.keys())
+                if returncode == 0 and (not retry or attempt == max_retries - 1):
                     success = True
                     logger.info(f"Download successful for task {task_id}")
                     break
                 else:
-                    error_msg = process.stderr.strip()
-                    logger.error(f"spotDL failed (attempt {attempt + 1}): {error_msg}")
+                    if retry:
+                        error_msg = '\n'.join(dict.fromkeys(retry.values()))
+                        logger.warning(f"{len(retry)} tracks failed (attempt {attempt + 1}), retrying them: {error_msg}")
+                    else:
+                        error_msg = spotdl_output.strip()
+                        logger.error(f"spotDL failed (attempt {attempt + 1}): {error_msg}")
                     
                     # Check for specific error types
-                    if any(keyword in error_msg.lower() for keyword in ['rate limit', '429', 'too many requests']):
+                    error_class = classify_error(error_msg)
+                    if error_class == 'rate_limit':
                         if attempt < max_retries - 1:
                             delay = exponential_backoff(attempt + 1, base_delay * 2)  # Longer delay for rate limits
                             logger.info(f"Rate limit detected, waiting {delay:.2f}s before retry")
                             task.message = f'Rate limited, waiting {delay:.0f}s before retry...'
-                            time.sleep(delay)
+                            timeline.sleep(delay, 'rate_limit')
                             continue
-                    elif any(keyword in error_msg.lower() for keyword in ['404', 'not found', 'invalid']):
+                    elif error_class == 'not_found':
                         # Don't retry for 404 errors
                         raise Exception(f"Content not found or URL invalid: {error_msg}")
-                    elif any(keyword in error_msg.lower() for keyword in ['network', 'connection', 'timeout']):
+                    elif error_class == 'network':
                         # Network issues - retry with longer delay
                         if attempt < max_retries - 1:
                             delay = exponential_backoff(attempt + 1, base_delay)
                             logger.info(f"Network error detected, waiting {delay:.2f}s before retry")
-                            time.sleep(delay)
+                            timeline.sleep(delay, 'network')
                             continue
                     
                     if attempt == max_retries - 1:
                         raise Exception(f"Download failed after {max_retries} attempts: {error_msg}")
             
+            except LeaseLost:
+                raise
             except subprocess.TimeoutExpired:
                 logger.error(f"Download timeout for task {task_id} (attempt {attempt + 1})")
                 if attempt == max_retries - 1:
-                    raise Exception("Download timed out. The playlist might be too large or there are network issues.")
+                    raise
             except Exception as e:
                 logger.error(f"Download error for task {task_id} (attempt {attempt + 1}): {e}")
                 if attempt == max_retries - 1:
@@ -313,59 +1685,311 @@ def download_playlist(task_id, url, format_type):
         
         if not success:
             raise Exception("Download failed after all retry attempts")
+        if songs is None or tracks.runs:
+            metrics_registry.observe('download_seconds', time.monotonic() - download_started)
+        
+        # Pick up finished tracks spotDL did not report, then keep the cache within budget
+        if songs:
+            collect_unreported()
+            for key, song in pending.items():
+                logger.warning(f"Track missing after download: {song_display_name(song)}")
+                tracks.handle('failed', song_display_name(song), 'Track was not downloaded')
+                if key in matched:
+                    metadata_cache.delete('match', track_ref(song))
+        elif multi:
+            files.transcode_sources(work_dir / 'source')
+        files.wait_transcodes(task, timeline)
+        if songs:
+            track_cache.evict()
+        shutil.rmtree(work_dir, ignore_errors=True)
         
         # Check if any files were downloaded
         downloaded_files = list(download_dir.rglob('*'))
-        audio_files = [f for f in downloaded_files if f.is_file() and f.suffix.lower() in ['.mp3', '.wav', '.flac', '.m4a', '.ogg']]
+        audio_files = [f for f in downloaded_files if f.is_file() and f.suffix.lower() in AUDIO_EXTENSIONS]
         
         if not audio_files:
             raise Exception("No audio files were downloaded. The playlist might be empty or inaccessible.")
+        if songs and not task.tracks_done:
+            # Partial files of failed tracks (e.g. a source whose transcodes all failed) are not a download
+            raise Exception(f"None of the {len(songs)} tracks could be downloaded")
         
         logger.info(f"Downloaded {len(audio_files)} files for task {task_id}")
         
-        # Update progress
-        task.status = 'processing'
-        task.message = f'Creating archive ({len(audio_files)} files)...'
-        task.progress = 75
-        
-        # Create ZIP file
-        zip_filename = f"playlist_{task_id}_{format_type}.zip"
-        zip_path = OUTPUT_DIR / zip_filename
-        
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=6) as zipf:
-            for file_path in download_dir.rglob('*'):
-                if file_path.is_file():
-                    arcname = file_path.relative_to(download_dir)
-                    zipf.write(file_path, arcname)
-                    logger.debug(f"Added to ZIP: {arcname}")
-        
-        # Clean up download directory
-        shutil.rmtree(download_dir)
+        try:
+            # Every job is indexed, combined batch archives are streamed from the indexes of their playlists
+            with timeline.span('archive'), metrics_registry.timer('archive_seconds'):
+                entries = index_files(archive_files(download_dir))
+                index = save_index(entries, archive_index_path(download_dir))
+                disk_usage.add(index, 'output', OUTPUT_TTL, size=index.stat().st_size)
+                if DOWNLOAD_ARCHIVE == 'file' and task.archive:
+                    task.message = 'Packaging archive...'
+                    archive = write_archive(ZipLayout(entries), archive_path(download_dir))
+                    disk_usage.add(archive, 'output', OUTPUT_TTL, size=archive.stat().st_size)
+        except OSError as e:
+            # Still downloadable, the ZIP is then streamed from download_dir without resume support
+            logger.error(f"Could not build archive for task {task_id}: {e}")
+        disk_usage.add(download_dir, 'downloads', OUTPUT_TTL, size=unshared_size(audio_files))
+        disk_usage.enforce_budget(DISK_BUDGET_BYTES, DISK_MIN_RETENTION)
         
         # Update task completion
         task.status = 'completed'
-        task.message = f'Download completed! {len(audio_files)} tracks downloaded.'
+        task.message = f'Download completed! {task.tracks_done if songs else len(audio_files) // len(formats)} tracks downloaded.'
         task.progress = 100
-        task.output_file = str(zip_path)
+        task.finished_at = time.time()
+        metrics_registry.inc('jobs_completed_total')
         
-        logger.info(f"Download completed successfully: {zip_path}")
+        logger.info(f"Download completed successfully: {download_dir}")
         
+    except LeaseLost as e:
+        # Another worker resumes the job in the same directories, leave them and the task alone
+        lease_lost = True
+        logger.warning(f"Stopped task {task_id}: {e}")
     except subprocess.TimeoutExpired:
-        task.status = 'error'
-        task.error = 'Download timed out. The playlist might be too large or there are network issues.'
-        task.message = 'Download timed out'
         logger.error(f"Download timeout for task {task_id}")
+        fail_download(task, 'Download timed out. The playlist might be too large or there are network issues.',
+                      'Download timed out', 'timeout')
     except Exception as e:
-        error_msg = str(e)
-        task.status = 'error'
-        task.error = error_msg
-        task.message = f'Download failed: {error_msg}'
         logger.error(f"Download error for task {task_id}: {e}")
-        
-        # Clean up on error
-        download_dir = DOWNLOADS_DIR / f"download_{task_id}"
-        if download_dir.exists():
-            shutil.rmtree(download_dir)
+        error_msg = str(e)
+        fail_download(task, error_msg, f'Download failed: {error_msg}', classify_error(error_msg))
+    finally:
+        if not lease_lost:
+            track_cache.release(task_id)  # the claims are held under the task ID, which the new worker uses too
+        timeline.record('job', job_started, time.time() - job_started, status=task.status)
+        stop_profiler(profiler, task)
+
+def start_profiler(task):
+    """Start cProfile for this thread if the task asked for profiling"""
+    if not task.profile:
+        return None
+    import cProfile  # profiling is opt-in, keep it out of worker start-up
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Only one profiler can be active at a time on newer Pythons
+        logger.warning(f"Not profiling task {task.task_id}: {e}")
+        return None
+    return profiler
+
+def stop_profiler(profiler, task):
+    """Save the task's profile to PROFILE_DIR and log its hottest functions"""
+    if profiler is None:
+        return
+    profiler.disable()
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    path = PROFILE_DIR / f"task_{task.task_id}.prof"
+    profiler.dump_stats(path)
+    disk_usage.add(path, 'profiles', PROFILE_TTL)
+    import pstats
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(15)
+    logger.info(f"Profile of task {task.task_id} saved to {path}\n{summary.getvalue()}")
+
+def profile_token_valid():
+    """Whether the request carries an X-Profile-Token header matching PROFILE_TOKEN"""
+    token = request.headers.get('X-Profile-Token')
+    return bool(PROFILE_TOKEN and token and secrets.compare_digest(token, PROFILE_TOKEN))
+
+def profiling_requested():
+    """Whether the download being started should run under the profiler (sampled, or asked for with the token)"""
+    return profile_token_valid() or random.random() < PROFILE_SAMPLE_RATE
+
+def estimate_track_count(url):
+    """Playlist size before resolution, used to favour short jobs: the cached track list's, or a guess"""
+    cached = metadata_cache.count('tracks', normalize_url(url))
+    if cached:
+        return cached
+    url = url.lower()
+    if '/track/' in url or ('watch?v=' in url and 'list=' not in url) or 'youtu.be/' in url:
+        return 1
+    if '/album/' in url:
+        return 15
+    return 100
+
+def fail_abandoned_task(task_id, error):
+    """Fail a task whose job the durable queue dropped after MAX_JOB_ATTEMPTS leases"""
+    task = task_store.get(task_id)
+    if task is None or task.status not in ACTIVE_STATUSES or not task_store.adopt(task, worker_id()):
+        return
+    task.status = 'error'
+    task.error = error
+    task.message = f'Download failed: {error}'
+    task.finished_at = time.time()
+    metrics_registry.inc('jobs_failed_total', reason='other')
+
+def run_job(job):
+    download_playlist(job.task_id, job.url, job.format_type)
+
+def create_scheduler():
+    """Build the job queue selected by the JOB_QUEUE environment variable"""
+    if JOB_QUEUE_BACKEND == 'memory':
+        if DOWNLOAD_MODE == 'external':
+            raise ValueError("DOWNLOAD_MODE=external needs JOB_QUEUE=sqlite")
+        return JobScheduler(MAX_QUEUE_DEPTH, MAX_QUEUED_PER_CLIENT, JOB_CONCURRENCY[2], task_store, run_job,
+                            concurrency, metrics_registry, QUEUE_AGING_SECONDS)
+    if JOB_QUEUE_BACKEND == 'sqlite':
+        if TASK_STORE_BACKEND != 'sqlite':
+            raise ValueError("JOB_QUEUE=sqlite needs TASK_STORE=sqlite")
+        return SQLiteJobQueue(JOB_QUEUE_PATH, MAX_QUEUE_DEPTH, MAX_QUEUED_PER_CLIENT, JOB_CONCURRENCY[2], task_store,
+                              run_job, concurrency, metrics_registry, JOB_LEASE_SECONDS, MAX_JOB_ATTEMPTS,
+                              worker_id, fail_abandoned_task, QUEUE_AGING_SECONDS)
+    raise ValueError(f"Unknown JOB_QUEUE backend: {JOB_QUEUE_BACKEND}")
+
+scheduler = create_scheduler()
+
+def request_client():
+    """Client identity for fair scheduling: the peer address, or the one TRUSTED_PROXIES hops report"""
+    return request.remote_addr or 'unknown'
+
+RESUME_CHECK_INTERVAL = 60
+last_resume_check = {'pid': None, 'time': 0}
+
+def resume_interrupted_tasks():
+    """Take over tasks whose worker died (e.g. recycled by --max-requests) and resume them"""
+    for task in task_store.find_orphans():
+        if not task_store.adopt(task, worker_id()):
+            continue
+        logger.info(f"Resuming interrupted task {task.task_id}")
+        task.message = 'Resuming interrupted download...'
+        scheduler.submit(task, 'resumed', task.tracks_total or estimate_track_count(task.url), force=True)
+
+@app.before_request
+def start_download_dispatchers():
+    """Run downloads inside this web worker unless a separate worker tier does"""
+    if DOWNLOAD_MODE == 'inline':
+        if gevent_patched():
+            # Downloads, archive building and SQLite waits would block every stream on the event loop
+            raise RuntimeError("DOWNLOAD_MODE=inline cannot run in gevent workers, "
+                               "use gthread workers or DOWNLOAD_MODE=external with `python app.py worker`")
+        scheduler.start_dispatchers()
+
+def gevent_patched():
+    """Whether this process runs on gevent's event loop (e.g. gunicorn -k gevent)"""
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+@app.before_request
+def check_interrupted_tasks():
+    """Look for orphaned tasks on the first request of a worker and then once a minute"""
+    if scheduler.durable:
+        return  # job leases already re-queue work from dead workers
+    now = time.time()
+    if last_resume_check['pid'] == os.getpid() and now - last_resume_check['time'] < RESUME_CHECK_INTERVAL:
+        return
+    last_resume_check.update(pid=os.getpid(), time=now)
+    try:
+        resume_interrupted_tasks()
+    except Exception as e:
+        logger.error(f"Error resuming interrupted tasks: {e}")
+
+class ZipStreamBuffer:
+    """Write-only sink for zipfile; has no tell/seek so entries use data descriptors"""
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def stream_zip(files, chunk_size=1024 * 1024):
+    """Yield a stored (uncompressed) ZIP archive of (path, arcname) pairs in bounded memory.
+
+    Audio is already compressed, so entries are STORED. ZIP64 records are written
+    automatically for large entries and archives.
+    """
+    sink = ZipStreamBuffer()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED, allowZip64=True) as zipf:
+        for path, arcname in files:
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            info.compress_type = zipfile.ZIP_STORED
+            with open(path, 'rb') as src, zipf.open(info, 'w') as dst:
+                while True:
+                    chunk = src.read(chunk_size)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+def archive_files(output_dir):
+    """(path, arcname) pairs for every file in a completed task's output directory"""
+    output_dir = Path(output_dir)
+    return [(path, str(path.relative_to(output_dir))) for path in sorted(output_dir.rglob('*')) if path.is_file()]
+
+def archive_path(output_dir):
+    """Prebuilt archive of an output directory; tasks sharing an output share the archive"""
+    return OUTPUT_DIR / f"{Path(output_dir).name}.zip"
+
+def write_archive(layout, target):
+    """Write an indexed archive to target, atomically; the same bytes as it is streamed"""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    partial = target.with_name(f"{target.name}.{os.getpid()}.{threading.get_ident()}.part")
+    try:
+        with open(partial, 'wb') as f:
+            for chunk in layout.read():
+                f.write(chunk)
+        os.replace(partial, target)
+    finally:
+        partial.unlink(missing_ok=True)
+    return target
+
+def archive_index_path(output_dir):
+    """Index of an output directory's files (sizes and CRCs), the layout its ZIP is streamed from"""
+    return OUTPUT_DIR / f"{Path(output_dir).name}.index.json"
+
+def send_archive(archive, filename):
+    """Serve a prebuilt archive, resumable, or hand it to the reverse proxy"""
+    if DOWNLOAD_OFFLOAD == 'x-accel-redirect':
+        # nginx serves the bytes (including Range requests) from its internal location
+        return Response(mimetype='application/zip', headers={
+            'X-Accel-Redirect': f"{DOWNLOAD_ACCEL_PREFIX.rstrip('/')}/{archive.name}",
+            'Content-Disposition': f'attachment; filename={filename}'
+        })
+    # Conditional responses answer Range, If-Range and If-None-Match against the file's ETag
+    response = send_file(archive.resolve(), mimetype='application/zip', as_attachment=True,
+                         download_name=filename, conditional=True, etag=True)
+    response.headers['Accept-Ranges'] = 'bytes'  # tells browsers the download can be resumed
+    return response
+
+def send_layout(layout, filename):
+    """Stream an indexed archive from its files, answering Range, If-Range and If-None-Match"""
+    headers = {'Content-Disposition': f'attachment; filename={filename}', 'Accept-Ranges': 'bytes',
+               'ETag': f'"{layout.etag}"'}
+    if request.if_none_match.contains(layout.etag):
+        return Response(status=304, headers=headers)
+    
+    start, stop, status = 0, layout.size, 200
+    ranges = request.range
+    if_range = request.if_range
+    # A range of an older version of the archive (If-Range with another ETag or a date) gets the whole archive
+    if ranges and len(ranges.ranges) == 1 and (if_range.etag or if_range.date) in (None, layout.etag):
+        span = ranges.range_for_length(layout.size)
+        if span is None:
+            return Response(status=416, headers={'Content-Range': f'bytes */{layout.size}'})
+        (start, stop), status = span, 206
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{layout.size}'
+    headers['Content-Length'] = str(stop - start)
+    return Response(layout.read(start, stop), status=status, mimetype='application/zip', headers=headers,
+                    direct_passthrough=True)
+
+def send_streamed_archive(files, filename):
+    """Zip files on the fly; no prebuilt archive, so no resume support"""
+    return Response(
+        (chunk for chunk in stream_zip(files) if chunk),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename={filename}', 'Accept-Ranges': 'none'},
+        direct_passthrough=True
+    )
 
 @app.route('/')
 def index():
@@ -373,15 +1997,9 @@ def index():
     return render_template('index.html')
 
 @app.route('/download', methods=['POST'])
+@rate_limit(SUBMIT_RATE_LIMIT)
 def start_download():
     """Start a new download task"""
-    # Apply rate limiting in production
-    if limiter and os.getenv('FLASK_ENV') == 'production':
-        try:
-            limiter.limit("5 per minute")(lambda: None)()
-        except Exception as e:
-            return jsonify({'error': 'Rate limit exceeded. Please wait before starting another download.'}), 429
-    
     try:
         data = request.get_json()
         
@@ -389,13 +2007,14 @@ def start_download():
             return jsonify({'error': 'No data provided'}), 400
         
         url = data.get('url', '').strip()
-        format_type = data.get('format', 'mp3').lower()
+        formats = parse_formats(data)
+        format_type = '+'.join(formats)  # e.g. 'flac+mp3' for one download in several formats
         
         # Validate inputs
         if not validate_url(url):
             return jsonify({'error': 'Invalid or unsupported URL. Please provide a Spotify or YouTube URL.'}), 400
         
-        if not validate_format(format_type):
+        if not formats or not all(validate_format(fmt) for fmt in formats):
             return jsonify({'error': 'Invalid format. Supported formats: wav, flac, mp3'}), 400
         
         # Check for Spotify URL and warn about rate limiting if no auth
@@ -406,14 +2025,35 @@ def start_download():
                 logger.warning("Spotify URL detected but no authentication configured. This may cause rate limiting.")
         
         # Generate unique task ID
-        task_id = f"{int(time.time())}_{len(download_tasks)}"
+        task_id = f"{int(time.time())}_{secrets.token_hex(4)}"
         
-        # Create download task
+        # Create download task, or attach to an identical running/recent one (single flight)
         task = DownloadTask(task_id, url, format_type)
-        download_tasks[task_id] = task
+        task.dedupe_key = f"{normalize_url(url)}|{format_type}"
+        task.profile = profiling_requested()
+        existing = task_store.add_or_attach(task, RESULT_REUSE_TTL)
+        
+        if existing is not task:
+            logger.info(f"Request for {task.dedupe_key} attached to task {existing.task_id}")
+            return jsonify({
+                'task_id': existing.task_id,
+                'status': 'attached',
+                'message': 'Download already in progress' if existing.status in ACTIVE_STATUSES else 'Download already available',
+                'warning': None
+            })
         
-        # Start download in background
-        executor.submit(download_playlist, task_id, url, format_type)
+        # Queue the download; admission control rejects it when the queue is full
+        try:
+            scheduler.submit(task, request_client(), estimate_track_count(url))
+            metrics_registry.inc('jobs_submitted_total')
+        except QueueFull as e:
+            task.status = 'error'
+            task.error = str(e)
+            task.message = 'Server busy, please retry later'
+            task.finished_at = time.time()
+            response = jsonify({'error': f'{e}. Please retry in {e.retry_after} seconds.'})
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, 429 if e.per_client else 503
         
         return jsonify({
             'task_id': task_id,
@@ -426,27 +2066,217 @@ def start_download():
         logger.error(f"Error starting download: {e}")
         return jsonify({'error': f'Internal server error: {str(e)}'}), 500
 
+def task_status(task):
+    """Public status payload of a task, shared by /status and /events"""
+    return {
+        'task_id': task.task_id,
+        'status': task.status,
+        'progress': task.progress,
+        'message': task.message,
+        'error': task.error,
+        'queue_position': scheduler.position(task),
+        'tracks_total': task.tracks_total,
+        'tracks_done': task.tracks_done,
+        'tracks_failed': task.tracks_failed,
+        'bytes_downloaded': task.bytes_downloaded,
+        'tracks': task.tracks,
+        'created_at': task.created_at.isoformat()
+    }
+
+def task_events(task_ids, hold=True):
+    """Yield SSE messages whenever one of the tasks changes, until all of them have finished.
+
+    The first status event of a task carries the full payload. After that, changed tracks
+    are sent as a `tracks` event ({index: track}) and the status event leaves the tracks
+    out, so a long playlist is not sent again on every change. The task store is checked
+    every SSE_POLL_INTERVAL seconds, skipping tasks whose row was not rewritten since;
+    idle streams get a comment as keep-alive. Without hold, the current state is sent once
+    and the client comes back after the retry delay.
+    """
+    sent_status = {}  # task_id -> status payload without tracks, as sent
+    sent_tracks = {}  # task_id -> JSON of every track entry, as sent
+    versions = {}
+    statuses = {}
+    remaining = list(task_ids)
+    started = last_write = time.monotonic()
+    yield f"retry: {int(SSE_POLL_INTERVAL * 4000)}\n\n"
+    while remaining and time.monotonic() - started < SSE_MAX_DURATION:
+        for task_id in list(remaining):
+            # Queue positions change without the task being written, keep reading queued tasks
+            version = task_store.version(task_id)
+            if version is not None and version == versions.get(task_id) and statuses[task_id] != 'pending':
+                continue
+            versions[task_id] = version
+            task = task_store.get(task_id)
+            if task is None:
+                remaining.remove(task_id)
+                yield f"event: not_found\ndata: {json.dumps({'task_id': task_id, 'error': 'Task not found'})}\n\n"
+                continue
+            statuses[task_id] = task.status
+            payload = task_status(task)
+            entries = payload.pop('tracks')
+            tracks = [json.dumps(entry, sort_keys=True) for entry in entries]
+            previous = sent_tracks.get(task_id)
+            if previous is None or len(tracks) < len(previous):
+                # First event of the stream, or the track list was rebuilt (resumed task)
+                data = json.dumps({**payload, 'tracks': entries})
+                sent_tracks[task_id] = tracks
+                sent_status[task_id] = json.dumps(payload)
+                last_write = time.monotonic()
+                yield f"event: status\ndata: {data}\n\n"
+            else:
+                changed = {index: entries[index] for index, entry in enumerate(tracks)
+                           if index >= len(previous) or entry != previous[index]}
+                if changed:
+                    sent_tracks[task_id] = tracks
+                    last_write = time.monotonic()
+                    yield f"event: tracks\ndata: {json.dumps({'task_id': task_id, 'tracks': changed})}\n\n"
+                data = json.dumps(payload)
+                if data != sent_status[task_id]:
+                    sent_status[task_id] = data
+                    last_write = time.monotonic()
+                    yield f"event: status\ndata: {data}\n\n"
+            if task.status not in ACTIVE_STATUSES:
+                remaining.remove(task_id)
+        if not remaining or not hold:
+            break
+        if time.monotonic() - last_write >= SSE_KEEPALIVE_INTERVAL:
+            last_write = time.monotonic()
+            yield ": keep-alive\n\n"
+        time.sleep(SSE_POLL_INTERVAL)
+
+def event_stream(task_ids):
+    return Response(
+        task_events(task_ids, hold=gevent_patched()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/status/<task_id>')
 def get_status(task_id):
     """Get download status for a specific task"""
-    task = download_tasks.get(task_id)
+    task = task_store.get(task_id)
+    
+    if not task:
+        return jsonify({'error': 'Task not found'}), 404
+    
+    return jsonify(task_status(task))
+
+@app.route('/tasks/<task_id>/timeline')
+def task_timeline(task_id):
+    """Spans of a task: resolution, spotDL runs, rate limiter waits, backoffs, transcoding and archiving"""
+    if not profile_token_valid():
+        return jsonify({'error': 'A valid X-Profile-Token header is required'}), 403
+    
+    task = task_store.get(task_id)
     
     if not task:
         return jsonify({'error': 'Task not found'}), 404
     
     return jsonify({
-        'task_id': task_id,
+        'task_id': task.task_id,
         'status': task.status,
-        'progress': task.progress,
-        'message': task.message,
-        'error': task.error,
-        'created_at': task.created_at.isoformat()
+        'profiled': task.profile,
+        'spans': task.timeline
     })
 
+@app.route('/tasks/<task_id>/profile')
+def task_profile(task_id):
+    """cProfile statistics of a profiled task, sorted by cumulative time"""
+    if not profile_token_valid():
+        return jsonify({'error': 'A valid X-Profile-Token header is required'}), 403
+    
+    path = PROFILE_DIR / f"task_{secure_filename(task_id)}.prof"
+    if not path.exists():
+        return jsonify({'error': 'No profile for this task'}), 404
+    
+    import pstats
+    sort = request.args.get('sort') if request.args.get('sort') in ('cumulative', 'tottime', 'calls') else 'cumulative'
+    summary = io.StringIO()
+    pstats.Stats(str(path), stream=summary).sort_stats(sort).print_stats(50)
+    return Response(summary.getvalue(), mimetype='text/plain')
+
+def published_files(task):
+    """Files of a task that can be downloaded individually, relative to its output directory"""
+    files = [path for entry in task.tracks for path in entry.get('files', [])]
+    if task.status == 'completed' and task.output_dir and Path(task.output_dir).exists():
+        # Also whatever spotDL wrote without a track list
+        listed = set(files)
+        files.extend(arcname for _, arcname in archive_files(task.output_dir) if arcname not in listed)
+    return files
+
+def file_url(task_id, path):
+    return f"/tasks/{task_id}/files/{quote(path)}"
+
+@app.route('/tasks/<task_id>/manifest')
+def task_manifest(task_id):
+    """Tracks of a task with a download URL for every file that is ready, while the task is still running"""
+    task = task_store.get(task_id)
+    
+    if not task:
+        return jsonify({'error': 'Task not found'}), 404
+    
+    files = published_files(task) if task.output_dir else []
+    return jsonify({
+        'task_id': task.task_id,
+        'status': task.status,
+        'complete': task.status not in ACTIVE_STATUSES,
+        'tracks_total': task.tracks_total,
+        'tracks_done': task.tracks_done,
+        'tracks_failed': task.tracks_failed,
+        'tracks': [
+            {'name': entry['name'], 'status': entry['status'], 'error': entry['error'],
+             'files': [{'path': path, 'url': file_url(task.task_id, path)} for path in entry.get('files', [])]}
+            for entry in task.tracks
+        ],
+        'files': [{'path': path, 'url': file_url(task.task_id, path)} for path in files],
+        'archive_url': f"/download/{task.task_id}" if task.status == 'completed' else None
+    })
+
+@app.route('/tasks/<task_id>/files/<path:filename>')
+def download_track_file(task_id, filename):
+    """Download a single finished file of a task, also while the rest is still downloading"""
+    task = task_store.get(task_id)
+    
+    if not task:
+        return jsonify({'error': 'Task not found'}), 404
+    
+    # A running job only serves the files it has published; anything else may still be written
+    published = task.status == 'completed' or any(filename in entry.get('files', []) for entry in task.tracks)
+    path = safe_join(task.output_dir, filename) if task.output_dir else None
+    if path is None or not published or not os.path.isfile(path):
+        return jsonify({'error': 'File not available'}), 404
+    
+    response = send_file(Path(path).resolve(), as_attachment=True, download_name=Path(path).name,
+                         conditional=True, etag=True)
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+@app.route('/events/<task_id>')
+def task_event_stream(task_id):
+    """Stream status changes of a single task as Server-Sent Events"""
+    if not task_store.get(task_id):
+        return jsonify({'error': 'Task not found'}), 404
+    
+    return event_stream([task_id])
+
+@app.route('/events')
+def multi_task_event_stream():
+    """Stream status changes of several tasks (?tasks=id1,id2) over one connection"""
+    task_ids = [task_id for task_id in request.args.get('tasks', '').split(',') if task_id]
+    
+    if not task_ids:
+        return jsonify({'error': 'No task IDs provided'}), 400
+    
+    if len(task_ids) > SSE_MAX_TASKS:
+        return jsonify({'error': f'At most {SSE_MAX_TASKS} tasks per stream'}), 400
+    
+    return event_stream(task_ids)
+
 @app.route('/download/<task_id>')
 def download_file(task_id):
     """Download the completed file"""
-    task = download_tasks.get(task_id)
+    task = task_store.get(task_id)
     
     if not task:
         return jsonify({'error': 'Task not found'}), 404
@@ -454,103 +2284,376 @@ def download_file(task_id):
     if task.status != 'completed':
         return jsonify({'error': 'Download not completed yet'}), 400
     
-    if not task.output_file or not Path(task.output_file).exists():
+    if not task.output_dir or not Path(task.output_dir).exists():
         return jsonify({'error': 'Output file not found'}), 404
     
     try:
-        return send_file(
-            task.output_file,
-            as_attachment=True,
-            download_name=f'playlist_{task.format_type}.zip',
-            mimetype='application/zip'
-        )
+        filename = f'playlist_{task.format_type}.zip'
+        archive = archive_path(task.output_dir)
+        if DOWNLOAD_ARCHIVE == 'file' and archive.exists():
+            return send_archive(archive, filename)
+        entries = load_index(archive_index_path(task.output_dir))
+        if entries is not None:
+            return send_layout(ZipLayout(entries), filename)
+        
+        # Neither prebuilt nor indexed: stream it, without resume support
+        return send_streamed_archive(archive_files(task.output_dir), filename)
     except Exception as e:
         logger.error(f"Error sending file: {e}")
         return jsonify({'error': 'Error sending file'}), 500
 
+def playlist_folder(index, url):
+    """Folder of a playlist in a combined batch archive, e.g. 001_37i9dQZF1DXcBWIGoYBM5M"""
+    parsed = urlparse(url)
+    query = parse_qs(parsed.query)
+    ident = (query.get('list') or query.get('v') or [parsed.path.rstrip('/').rsplit('/', 1)[-1]])[0]
+    return f"{index:03d}_{secure_filename(ident) or 'playlist'}"
+
+def batch_status(batch):
+    """Aggregate status of a batch and the status of each of its playlists"""
+    tasks = {task_id: task_store.get(task_id) for task_id in batch.task_ids()}
+    statuses = [task.status if task else 'error' for task in tasks.values()]
+    if any(status in ACTIVE_STATUSES for status in statuses):
+        status = 'pending' if all(status == 'pending' for status in statuses) else 'downloading'
+    elif all(status == 'completed' for status in statuses):
+        status = 'completed'
+    else:
+        status = 'partial' if 'completed' in statuses else 'error'
+    
+    playlists = []
+    for playlist in batch.playlists:
+        task = tasks[playlist['task_id']]
+        entry = {'url': playlist['url'], 'task_id': playlist['task_id'], 'status': task.status if task else 'error'}
+        if task is None:
+            entry['error'] = 'Task expired'
+        else:
+            entry.update(progress=task.progress, tracks_total=task.tracks_total, tracks_done=task.tracks_done,
+                         tracks_failed=task.tracks_failed, error=task.error)
+            if batch.archive == 'playlist' and task.status == 'completed':
+                entry['download_url'] = f"/download/{task.task_id}"
+        playlists.append(entry)
+    
+    live = [task for task in tasks.values() if task]
+    return {
+        'batch_id': batch.batch_id,
+        'status': status,
+        'progress': sum(task.progress for task in live) // len(tasks) if tasks else 0,
+        'playlists_total': len(tasks),
+        'playlists_done': statuses.count('completed'),
+        'playlists_failed': statuses.count('error'),
+        'tracks_total': sum(task.tracks_total for task in live),
+        'tracks_done': sum(task.tracks_done for task in live),
+        'tracks_failed': sum(task.tracks_failed for task in live),
+        'archive': batch.archive,
+        'download_url': f"/batch/{batch.batch_id}/download"
+            if batch.archive == 'combined' and status in ('completed', 'partial') else None,
+        'playlists': playlists,
+        'created_at': batch.created_at.isoformat()
+    }
+
+@app.route('/batch', methods=['POST'])
+@rate_limit(SUBMIT_RATE_LIMIT)
+def start_batch():
+    """Start downloads for many playlists at once, tracked under one batch ID"""
+    try:
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({'error': 'No data provided'}), 400
+        
+        urls = [str(url).strip() for url in data.get('urls') or []]
+        formats = parse_formats(data)
+        format_type = '+'.join(formats)
+        archive = data.get('archive', 'combined')
+        
+        # Validate inputs
+        if not urls:
+            return jsonify({'error': 'No URLs provided'}), 400
+        
+        if len(urls) > MAX_BATCH_SIZE:
+            return jsonify({'error': f'At most {MAX_BATCH_SIZE} URLs per batch'}), 400
+        
+        invalid = [url for url in urls if not validate_url(url)]
+        if invalid:
+            return jsonify({'error': 'Invalid or unsupported URLs. Please provide Spotify or YouTube URLs.', 'invalid_urls': invalid}), 400
+        
+        if not formats or not all(validate_format(fmt) for fmt in formats):
+            return jsonify({'error': 'Invalid format. Supported formats: wav, flac, mp3'}), 400
+        
+        if archive not in ('combined', 'playlist'):
+            return jsonify({'error': "Invalid archive. Use 'combined' or 'playlist'"}), 400
+        
+        batch_id = f"{int(time.time())}_{secrets.token_hex(4)}"
+        client = request_client()
+        profile = profiling_requested()
+        playlists = []
+        new_jobs = []
+        attached = 0
+        for url in urls:
+            # Every playlist is a task of its own; repeated and already running URLs share one (single flight)
+            task = DownloadTask(f"{int(time.time())}_{secrets.token_hex(4)}", url, format_type)
+            task.dedupe_key = f"{normalize_url(url)}|{format_type}"
+            task.profile = profile
+            task.archive = archive == 'playlist'
+            existing = task_store.add_or_attach(task, RESULT_REUSE_TTL)
+            playlists.append({'url': url, 'task_id': existing.task_id})
+            if existing is not task:
+                attached += 1
+                continue
+            new_jobs.append((task, estimate_track_count(url)))
+        
+        # The new playlists are admitted together as one place in the queue and this client's share,
+        # then enter the queue one by one; as the client's requests they only get its fair share of workers
+        try:
+            if new_jobs:
+                scheduler.submit_all(new_jobs, client, batch=batch_id)
+        except QueueFull as e:
+            for task, _ in new_jobs:
+                task.status = 'error'
+                task.error = str(e)
+                task.message = 'Server busy, please retry later'
+                task.finished_at = time.time()
+            response = jsonify({'error': f'{e}. Please retry in {e.retry_after} seconds.'})
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, 429 if e.per_client else 503
+        metrics_registry.inc('jobs_submitted_total', len(new_jobs))
+        started = len(new_jobs)
+        
+        batch = DownloadBatch(batch_id, format_type, archive, playlists)
+        task_store.add_batch(batch)
+        metrics_registry.inc('batches_submitted_total')
+        logger.info(f"Batch {batch_id}: {started} downloads started, {attached} attached to existing tasks")
+        
+        return jsonify({
+            'batch_id': batch_id,
+            'status': 'started',
+            'message': f'{started} downloads started, {attached} already in progress or available',
+            'playlists': playlists
+        })
+        
+    except Exception as e:
+        logger.error(f"Error starting batch: {e}")
+        return jsonify({'error': f'Internal server error: {str(e)}'}), 500
+
+@app.route('/batch/<batch_id>')
+def get_batch_status(batch_id):
+    """Aggregate progress of a batch"""
+    batch = task_store.get_batch(batch_id)
+    
+    if not batch:
+        return jsonify({'error': 'Batch not found'}), 404
+    
+    return jsonify(batch_status(batch))
+
+@app.route('/batch/<batch_id>/download')
+def download_batch(batch_id):
+    """Download every completed playlist of a batch as one archive, a folder per playlist"""
+    batch = task_store.get_batch(batch_id)
+    
+    if not batch:
+        return jsonify({'error': 'Batch not found'}), 404
+    
+    tasks = {task_id: task_store.get(task_id) for task_id in batch.task_ids()}
+    if any(task and task.status in ACTIVE_STATUSES for task in tasks.values()):
+        return jsonify({'error': 'Batch not completed yet'}), 400
+    
+    files = []
+    entries = []
+    for index, task_id in enumerate(tasks, 1):
+        task = tasks[task_id]
+        if task and task.status == 'completed' and task.output_dir and Path(task.output_dir).exists():
+            folder = playlist_folder(index, task.url)
+            files.extend((path, f"{folder}/{arcname}") for path, arcname in archive_files(task.output_dir))
+            indexed = load_index(archive_index_path(task.output_dir)) if entries is not None else None
+            entries = None if indexed is None else entries + [
+                {**entry, 'arcname': f"{folder}/{entry['arcname']}"} for entry in indexed
+            ]
+    if not files:
+        return jsonify({'error': 'No completed playlists in this batch'}), 404
+    
+    try:
+        filename = f'batch_{batch.format_type}.zip'
+        # Streamed from the playlists' indexes, so nothing is written while the request waits
+        if entries is not None:
+            return send_layout(ZipLayout(entries), filename)
+        return send_streamed_archive(files, filename)
+    except Exception as e:
+        logger.error(f"Error sending batch archive: {e}")
+        return jsonify({'error': 'Error sending file'}), 500
+
 @app.route('/health')
 def health_check():
     """Health check endpoint"""
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
-        'active_tasks': len([t for t in download_tasks.values() if t.status in ['pending', 'downloading', 'processing']])
+        'active_tasks': task_store.count(*ACTIVE_STATUSES)
     })
 
-@app.route('/metrics')
-def metrics():
-    """Metrics endpoint for monitoring"""
-    if os.getenv('FLASK_ENV') != 'production':
-        return jsonify({'error': 'Metrics only available in production'}), 404
-    
+metrics_registry.gauge('queue_depth', 'Download jobs waiting in the queue', lambda: scheduler.snapshot()['depth'])
+metrics_registry.gauge('queue_max_depth', 'Queued jobs at which new downloads are rejected', lambda: scheduler.max_depth)
+metrics_registry.gauge('queue_clients_waiting', 'Clients with queued jobs', lambda: scheduler.snapshot()['clients_waiting'])
+metrics_registry.gauge('active_jobs', 'Download jobs currently running', lambda: scheduler.snapshot()['running'])
+metrics_registry.gauge('download_workers', 'Processes holding job leases (durable queue only)',
+                       lambda: scheduler.snapshot().get('workers'))
+metrics_registry.gauge('job_duration_average_seconds', 'Moving average job duration seen by the process serving the scrape',
+                       lambda: scheduler.snapshot()['avg_job_seconds'])
+
+# Adaptive concurrency is controlled per process, these describe the process serving the scrape
+metrics_registry.gauge('concurrency_job_limit', 'Concurrent jobs currently allowed', lambda: concurrency.job_limit)
+metrics_registry.gauge('concurrency_track_threads', 'spotDL threads per job currently used', lambda: concurrency.track_threads)
+metrics_registry.gauge('concurrency_track_latency_seconds', 'Moving average seconds per track and thread',
+                       lambda: concurrency.snapshot()['track_latency_seconds'])
+metrics_registry.gauge('concurrency_rate_limit_events', 'Upstream rate limits that reduced concurrency',
+                       lambda: concurrency.rate_limit_events)
+
+metrics_registry.gauge('metadata_cache_entries', 'Entries in the metadata cache per kind', lambda: {
+    (('kind', kind),): stats['entries'] for kind, stats in metadata_cache.stats().items()
+})
+metrics_registry.gauge('metadata_cache_bytes', 'Size of the metadata cache per kind', lambda: {
+    (('kind', kind),): stats['bytes'] for kind, stats in metadata_cache.stats().items()
+})
+metrics_registry.gauge('disk_usage_bytes', 'Disk space used per area', lambda: {
+    (('area', area),): size for area, size in {**disk_usage.usage(), 'cache': track_cache.usage()}.items()
+})
+
+def process_stat(name):
+    """Resource usage of the process answering the scrape (None without psutil)"""
     try:
         import psutil
-        process = psutil.Process()
-        memory_info = process.memory_info()
-        
-        return jsonify({
-            'active_downloads': len([t for t in download_tasks.values() if t.status in ['downloading', 'processing']]),
-            'completed_downloads': len([t for t in download_tasks.values() if t.status == 'completed']),
-            'failed_downloads': len([t for t in download_tasks.values() if t.status == 'error']),
-            'total_tasks': len(download_tasks),
-            'uptime_seconds': int(time.time() - app.start_time),
-            'memory_usage_mb': memory_info.rss / 1024 / 1024,
-            'cpu_percent': process.cpu_percent(),
-            'disk_usage': {
-                'downloads': get_directory_size(DOWNLOADS_DIR),
-                'output': get_directory_size(OUTPUT_DIR),
-                'temp': get_directory_size(TEMP_DIR)
-            }
-        })
     except ImportError:
-        return jsonify({
-            'active_downloads': len([t for t in download_tasks.values() if t.status in ['downloading', 'processing']]),
-            'completed_downloads': len([t for t in download_tasks.values() if t.status == 'completed']),
-            'failed_downloads': len([t for t in download_tasks.values() if t.status == 'error']),
-            'uptime_seconds': int(time.time() - app.start_time),
-            'note': 'psutil not available, limited metrics'
-        })
+        return None
+    process = psutil.Process()
+    return process.memory_info().rss if name == 'memory' else process.cpu_times().user + process.cpu_times().system
 
-def get_directory_size(path):
-    """Get directory size in MB"""
-    try:
-        total_size = 0
-        for dirpath, dirnames, filenames in os.walk(path):
-            for f in filenames:
-                fp = os.path.join(dirpath, f)
-                if os.path.exists(fp):
-                    total_size += os.path.getsize(fp)
-        return round(total_size / 1024 / 1024, 2)  # MB
-    except Exception:
-        return 0
+metrics_registry.gauge('process_resident_memory_bytes', 'Resident memory of the process serving the scrape',
+                       lambda: process_stat('memory'))
+metrics_registry.gauge('process_cpu_seconds', 'CPU time used by the process serving the scrape',
+                       lambda: process_stat('cpu'))
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics of the whole deployment; all workers record into the shared metrics database"""
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
 
 @app.errorhandler(413)
 def too_large(e):
     return jsonify({'error': 'File too large'}), 413
 
+@app.errorhandler(429)
+def rate_limited(e):
+    return jsonify({'error': 'Rate limit exceeded. Please wait before starting another download.'}), 429
+
 @app.errorhandler(500)
 def internal_error(e):
     return jsonify({'error': 'Internal server error'}), 500
 
-# Clean up old files on startup
-clean_old_files()
-
-# Schedule periodic cleanup
+# Schedule cleanup: wake up when the next output expires (at most CLEANUP_INTERVAL apart)
+# and walk the directories only once a day to pick up files no job registered
 def periodic_cleanup():
+    last_reconcile = 0
     while True:
-        time.sleep(3600)  # Run every hour
+        if time.time() - last_reconcile > DISK_RECONCILE_INTERVAL:
+            try:
+                registered = disk_usage.reconcile(DISK_AREAS, OUTPUT_TTL, skip=in_progress)
+                if registered:
+                    logger.info(f"Registered {registered} untracked files and directories for cleanup")
+            except Exception as e:
+                logger.error(f"Error reconciling disk usage: {e}")
+            last_reconcile = time.time()
         clean_old_files()
+        next_expiry = disk_usage.next_expiry() or float('inf')
+        time.sleep(min(max(next_expiry - time.time(), 1), CLEANUP_INTERVAL))
+
+class CleanupService:
+    """periodic_cleanup in a single process per data directory.
+
+    Every web and worker process starts a standby thread once it is running (after
+    gunicorn forked it, never in the preloading master). The thread that gets the
+    exclusive lock on lock_path cleans up; the others retry every standby_interval and
+    take over when the holder exits, since the lock goes away with its process.
+    """
+    def __init__(self, lock_path, standby_interval):
+        self.lock_path = Path(lock_path)
+        self.standby_interval = standby_interval
+        self._pid = None
+        self._lock = threading.Lock()
+        self._lock_file = None
+
+    def start(self):
+        """Start this process's cleanup thread; a no-op if it is already running"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, daemon=True).start()
 
-cleanup_thread = threading.Thread(target=periodic_cleanup, daemon=True)
-cleanup_thread.start()
+    def _acquire(self):
+        if fcntl is None:
+            return True
+        self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+        lock_file = open(self.lock_path, 'a')
+        try:
+            # Non-blocking, a blocking flock would stall a whole gevent worker
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file  # held until this process exits
+        return True
+
+    def _run(self):
+        while not self._acquire():
+            time.sleep(self.standby_interval)
+        logger.info(f"Cleanup service running in {worker_id()}")
+        periodic_cleanup()
+
+cleanup_service = CleanupService(CLEANUP_LOCK_PATH, CLEANUP_STANDBY_INTERVAL)
+
+@app.before_request
+def start_cleanup_service():
+    cleanup_service.start()
+
+_app_started = threading.Lock()
+
+def create_app():
+    """Application factory (`gunicorn 'app:create_app()'`): logging and rate limiting, then the app.
+
+    Importing this module only defines the app. Background work starts lazily in each
+    process: download dispatchers and the cleanup standby thread on its first request.
+    """
+    if _app_started.acquire(blocking=False):
+        configure_logging()
+        check_ffmpeg()
+        if os.getenv('FLASK_ENV') == 'production':
+            init_rate_limiting()
+    return app
+
+def run_worker():
+    """Standalone download worker (`python app.py worker`) fed by the durable job queue"""
+    if not scheduler.durable:
+        sys.exit("Worker mode needs the SQLite job queue (TASK_STORE=sqlite, JOB_QUEUE=sqlite)")
+    stop = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stop.set())
+    scheduler.start_dispatchers()
+    cleanup_service.start()
+    logger.info(f"Download worker {worker_id()} started with up to {scheduler.workers} concurrent jobs")
+    while not stop.wait(1):
+        pass
+    # Finish running jobs; anything still running afterwards is re-queued when its lease expires
+    logger.info(f"Download worker {worker_id()} stopping, waiting for running jobs")
+    scheduler.stop()
+    if not scheduler.wait_idle(WORKER_SHUTDOWN_TIMEOUT):
+        logger.warning("Running jobs did not finish in time, they will be picked up by another worker")
 
 if __name__ == '__main__':
-    # Check if spotDL is installed
-    try:
-        subprocess.run([sys.executable, '-m', 'spotdl', '--help'], 
-                      capture_output=True, check=True)
+    # Check if spotDL is installed (without paying for a spotDL start-up)
+    if importlib.util.find_spec('spotdl') is not None:
         print("✅ spotDL is installed and ready")
-    except (subprocess.CalledProcessError, FileNotFoundError):
+    else:
         print("❌ spotDL is not installed. Please install it with: pip install spotdl")
         sys.exit(1)
     
@@ -564,6 +2667,11 @@ if __name__ == '__main__':
         print("   This may cause rate limiting for Spotify URLs")
         print("   See SPOTIFY_SETUP.md for setup instructions")
     
+    create_app()
+    if sys.argv[1:2] == ['worker']:
+        run_worker()
+        sys.exit(0)
+    
     app.run(
         host=os.getenv('HOST', '0.0.0.0'),
         port=int(os.getenv('PORT', 5000)),
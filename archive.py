@@ -0,0 +1,150 @@
+"""
+Archive
+Stored (uncompressed) ZIP archives laid out from an index of their files. The
+bytes at every offset follow from the index alone, so an archive can be served
+with Range and ETag support straight from the job files, without writing it.
+"""
+
+import hashlib
+import json
+import os
+import struct
+import time
+import zlib
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+UTF8_FLAG = 0x800
+
+def file_crc(path, chunk_size=1024 * 1024):
+    """CRC-32 of a file, read in chunks"""
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return crc
+            crc = zlib.crc32(chunk, crc)
+
+def index_files(files):
+    """Index entries {path, arcname, size, mtime, crc} of (path, arcname) pairs"""
+    entries = []
+    for path, arcname in files:
+        stat = os.stat(path)
+        entries.append({'path': str(path), 'arcname': arcname, 'size': stat.st_size,
+                        'mtime': int(stat.st_mtime), 'crc': file_crc(path)})
+    return entries
+
+def save_index(entries, target):
+    """Write an index atomically"""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    partial = target.with_name(f"{target.name}.{os.getpid()}.part")
+    partial.write_text(json.dumps(entries))
+    os.replace(partial, target)
+    return target
+
+def load_index(path):
+    """Entries of a saved index, or None when it is missing or a file changed since it was made"""
+    try:
+        entries = json.loads(path.read_text())
+        for entry in entries:
+            stat = os.stat(entry['path'])
+            if stat.st_size != entry['size'] or int(stat.st_mtime) != entry['mtime']:
+                return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return entries
+
+def dos_datetime(timestamp):
+    """(time, date) fields of a ZIP header for a Unix timestamp"""
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1  # 1980-01-01 00:00
+    return (
+        (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    )
+
+class ZipLayout:
+    """Byte layout of a stored ZIP archive of indexed files.
+
+    The archive is a list of segments, either header bytes or the contents of a file.
+    Local headers carry the CRC and sizes, so there are no data descriptors, and ZIP64
+    records are used for entries and offsets past 4GB, like zipfile writes them.
+    """
+    def __init__(self, entries):
+        self.segments = []  # (offset, length, bytes or path)
+        central = []
+        offset = 0
+        for entry in entries:
+            name = entry['arcname'].encode('utf-8')
+            flags = UTF8_FLAG if not entry['arcname'].isascii() else 0
+            dostime, dosdate = dos_datetime(entry['mtime'])
+            size = entry['size']
+
+            large = size >= ZIP64_LIMIT
+            extra = struct.pack('<HHQQ', 1, 16, size, size) if large else b''
+            version = 45 if large else 20
+            header = struct.pack(
+                '<IHHHHHIIIHH', 0x04034b50, version, flags, 0, dostime, dosdate, entry['crc'],
+                ZIP64_LIMIT if large else size, ZIP64_LIMIT if large else size, len(name), len(extra)
+            ) + name + extra
+            self._add(offset, header)
+            self._add(offset + len(header), entry['path'], size)
+
+            # The central directory entry also moves the local header offset into the ZIP64 extra
+            zip64 = [size, size] if large else []
+            if offset >= ZIP64_LIMIT:
+                zip64.append(offset)
+            cd_extra = struct.pack(f'<HH{len(zip64)}Q', 1, 8 * len(zip64), *zip64) if zip64 else b''
+            cd_version = 45 if zip64 else 20
+            central.append(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, cd_version, cd_version, flags, 0, dostime, dosdate,
+                entry['crc'], ZIP64_LIMIT if large else size, ZIP64_LIMIT if large else size,
+                len(name), len(cd_extra), 0, 0, 0, 0o100644 << 16, min(offset, ZIP64_LIMIT)
+            ) + name + cd_extra)
+            offset += len(header) + size
+
+        directory = b''.join(central)
+        cd_offset, cd_size, count = offset, len(directory), len(central)
+        end = b''
+        if count >= ZIP_FILECOUNT_LIMIT or cd_offset >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+            zip64_end = cd_offset + cd_size
+            end += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, cd_size, cd_offset)
+            end += struct.pack('<IIQI', 0x07064b50, 0, zip64_end, 1)
+        end += struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, min(count, ZIP_FILECOUNT_LIMIT), min(count, ZIP_FILECOUNT_LIMIT),
+            min(cd_size, ZIP64_LIMIT), min(cd_offset, ZIP64_LIMIT), 0
+        )
+        self._add(offset, directory + end)
+        self.size = offset + len(directory) + len(end)
+        self.etag = hashlib.sha256(json.dumps(
+            [[entry['arcname'], entry['size'], entry['mtime'], entry['crc']] for entry in entries]
+        ).encode()).hexdigest()[:32]
+
+    def _add(self, offset, data, length=None):
+        length = len(data) if length is None else length
+        if length:
+            self.segments.append((offset, length, data))
+
+    def read(self, start=0, stop=None, chunk_size=1024 * 1024):
+        """Yield the archive bytes in [start, stop)"""
+        stop = self.size if stop is None else stop
+        for offset, length, data in self.segments:
+            if offset + length <= start:
+                continue
+            if offset >= stop:
+                break
+            begin, end = max(start, offset) - offset, min(stop, offset + length) - offset
+            if isinstance(data, bytes):
+                yield data[begin:end]
+                continue
+            with open(data, 'rb') as f:
+                f.seek(begin)
+                remaining = end - begin
+                while remaining > 0:
+                    chunk = f.read(min(chunk_size, remaining))
+                    if not chunk:
+                        raise OSError(f"{data} is shorter than when it was indexed")
+                    remaining -= len(chunk)
+                    yield chunk
@@ -0,0 +1,155 @@
+"""
+Fake spotDL
+Local stand-in for the spotDL command line (and the Spotify/YouTube upstreams behind
+it) used by the benchmark. It understands the `save` and download invocations the app
+makes, prints the lines spotDL prints at INFO level and writes dummy audio files. Like
+spotDL, a failing track only logs a bare 'XError: message' while the run goes on; the
+'{song url} - XError: message' lines follow at the end with --print-errors.
+
+Behaviour is configured through the environment:
+    FAKE_SPOTDL_TRACKS           tracks per playlist or album URL (default 20)
+    FAKE_SPOTDL_LATENCY          mean seconds per track download (default 0.5)
+    FAKE_SPOTDL_JITTER           +/- fraction applied to the latency (default 0.3)
+    FAKE_SPOTDL_RESOLVE_LATENCY  seconds for `spotdl save` (default 0.2)
+    FAKE_SPOTDL_TRACK_BYTES      size of each written file (default 1000000)
+    FAKE_SPOTDL_CATALOG          draw playlist tracks from this many songs, so playlists
+                                 overlap (default 0: every playlist has its own tracks)
+    FAKE_SPOTDL_FAIL_RATE        probability a track is not found (default 0)
+    FAKE_SPOTDL_429_RATE         probability a track is rate limited (default 0); like
+                                 spotDL, the run still exits with status 0
+    FAKE_SPOTDL_HANG_RATE        probability a track hangs until the run is killed (default 0)
+    FAKE_SPOTDL_SEED             seed for the random draws (default 0)
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+def env_float(name, default):
+    return float(os.getenv(name, str(default)))
+
+TRACKS = int(os.getenv('FAKE_SPOTDL_TRACKS', '20'))
+LATENCY = env_float('FAKE_SPOTDL_LATENCY', 0.5)
+JITTER = env_float('FAKE_SPOTDL_JITTER', 0.3)
+RESOLVE_LATENCY = env_float('FAKE_SPOTDL_RESOLVE_LATENCY', 0.2)
+TRACK_BYTES = int(os.getenv('FAKE_SPOTDL_TRACK_BYTES', '1000000'))
+CATALOG = int(os.getenv('FAKE_SPOTDL_CATALOG', '0'))
+FAIL_RATE = env_float('FAKE_SPOTDL_FAIL_RATE', 0)
+RATE_LIMIT_RATE = env_float('FAKE_SPOTDL_429_RATE', 0)
+HANG_RATE = env_float('FAKE_SPOTDL_HANG_RATE', 0)
+SEED = os.getenv('FAKE_SPOTDL_SEED', '0')
+
+BLOCK = random.Random(SEED).randbytes(64 * 1024)
+print_lock = threading.Lock()
+
+def emit(line):
+    with print_lock:
+        print(line, flush=True)
+
+def songs_for(url):
+    """Deterministic track list for a URL, so repeated runs hit the same cache keys"""
+    count = 1 if '/track/' in url or 'watch?v=' in url else TRACKS
+    if CATALOG:
+        numbers = random.Random(url).sample(range(CATALOG), min(count, CATALOG))
+        ids = [f"catalog:{number}" for number in numbers]
+    else:
+        numbers = range(count)
+        ids = [f"{url}:{index}" for index in numbers]
+    songs = []
+    for number, ident in zip(numbers, ids):
+        song_id = hashlib.sha1(ident.encode()).hexdigest()[:22]
+        songs.append({
+            'name': f'Track {number + 1}',
+            # Every other track has a featured artist, which spotDL leaves out of its track lines
+            'artists': ['Bench Artist'] + (['Featured Artist'] if number % 2 else []),
+            'artist': 'Bench Artist',
+            'song_id': song_id,
+            'url': f'https://open.spotify.com/track/{song_id}',
+        })
+    return songs
+
+def save(args):
+    time.sleep(RESOLVE_LATENCY)
+    songs = songs_for(args.query)
+    with open(args.save_file, 'w') as f:
+        json.dump(songs, f)
+    emit(f"Saved {len(songs)} songs to {args.save_file}")
+    return 0
+
+def download_track(song, args, rng, errors):
+    """Download one song; its error is added to errors for the --print-errors summary"""
+    # spotDL's Song.display_name has the main artist only, its file names all artists
+    name = f"{song['artist']} - {song['name']}"
+    filename = f"{', '.join(song['artists'])} - {song['name']}"
+    roll = rng.random()
+    if roll < HANG_RATE:
+        while True:
+            time.sleep(3600)
+    time.sleep(max(LATENCY * (1 + rng.uniform(-JITTER, JITTER)), 0))
+    # spotDL logs the exception without the track, and keeps '{song url} - {exception}' for the summary
+    if roll < HANG_RATE + RATE_LIMIT_RATE:
+        error = 'AudioProviderError: YT-DLP download error - HTTP Error 429: Too Many Requests'
+    elif roll < HANG_RATE + RATE_LIMIT_RATE + FAIL_RATE:
+        error = f'LookupError: No results found for song: {name}'
+    else:
+        error = None
+    if error:
+        emit(error)
+        errors.append(f"{song['url']} - {error}")
+        return
+
+    if '{' in args.output:
+        path = args.output.replace('{track-id}', song['song_id']).replace('{output-ext}', args.format)
+    else:
+        path = os.path.join(args.output, f"{filename}.{args.format}")
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        remaining = TRACK_BYTES
+        while remaining > 0:
+            f.write(BLOCK[:remaining])
+            remaining -= len(BLOCK)
+    emit(f'Downloaded "{name}": {song.get("download_url") or "https://music.youtube.com/watch?v=" + song["song_id"][:11]}')
+
+def download(args):
+    if args.query.endswith('.spotdl'):
+        with open(args.query) as f:
+            songs = json.load(f)
+    else:
+        songs = songs_for(args.query)
+        emit(f"Found {len(songs)} songs in {args.query}")
+    rng = random.Random(f"{SEED}:{args.query}:{os.getpid()}")
+    seeds = [rng.random() for _ in songs]
+    errors = []
+    with ThreadPoolExecutor(max(args.threads, 1)) as pool:
+        list(pool.map(lambda item: download_track(item[0], args, random.Random(item[1]), errors), zip(songs, seeds)))
+    if args.print_errors:
+        for error in errors:
+            emit(error)
+    # spotDL catches errors per song, a run with failed tracks still succeeds
+    return 0
+
+def main():
+    argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(prog='spotdl')
+    parser.add_argument('query')
+    parser.add_argument('--save-file')
+    parser.add_argument('--format', default='mp3')
+    parser.add_argument('--output', default='.')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--print-errors', action='store_true')
+    if argv and argv[0] == 'save':
+        args, _ = parser.parse_known_args(argv[1:])
+        sys.exit(save(args))
+    if argv and argv[0] == 'download':
+        argv = argv[1:]
+    args, _ = parser.parse_known_args(argv)
+    sys.exit(download(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+"""
+Benchmark
+Starts the app in a scratch directory with spotDL replaced by bench/fake_spotdl.py,
+drives it through /download, /status and /download/<id> at a chosen concurrency and
+reports throughput, end-to-end latency, time to the first downloadable track, peak
+memory and disk use.
+
+    python bench/run_benchmark.py --jobs 40 --concurrency 8 --tracks 10 --json result.json
+    python bench/run_benchmark.py --jobs 40 --concurrency 8 --tracks 10 --compare result.json
+
+With --compare the run fails (exit status 1) when jobs/minute, p95 latency, p95 time
+to the first track or peak memory are worse than the baseline by more than --tolerance.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def percentile(values, fraction):
+    """Nearest-rank percentile, None for no values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+def request(method, url, body=None, timeout=30):
+    """(status, headers, body bytes) of an HTTP request; HTTP errors are returned, not raised"""
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, method=method, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+def download_size(url):
+    """Stream a download to nowhere and return its size in bytes"""
+    with urllib.request.urlopen(url, timeout=300) as response:
+        size = 0
+        while True:
+            chunk = response.read(1024 * 1024)
+            if not chunk:
+                return size
+            size += len(chunk)
+
+def process_tree_rss(pid):
+    """Resident memory of a process and its descendants in bytes, from /proc (Linux)"""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            continue
+    return total
+
+def disk_usage(path):
+    """Bytes under path, counting hard-linked files (cache and job directories) once"""
+    seen = set()
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                stat = os.lstat(os.path.join(dirpath, name))
+            except FileNotFoundError:
+                continue
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_size
+    return total
+
+class Sampler(threading.Thread):
+    """Records peak memory of the server process tree and peak disk use of the scratch directory"""
+    def __init__(self, pid, directory, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.directory = directory
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, process_tree_rss(self.pid))
+            self.peak_disk = max(self.peak_disk, disk_usage(self.directory))
+
+def start_server(args, workdir, port):
+    env = {
+        **os.environ,
+        'PYTHONPATH': str(REPO_DIR),
+        'SPOTDL_COMMAND': f'"{sys.executable}" "{BENCH_DIR / "fake_spotdl.py"}"',
+        'SPOTDL_ENGINE': 'subprocess',
+        'SPOTDL_TRACK_TIMEOUT': str(args.track_timeout),
+        'FAKE_SPOTDL_TRACKS': str(args.tracks),
+        'FAKE_SPOTDL_LATENCY': str(args.latency),
+        'FAKE_SPOTDL_JITTER': str(args.jitter),
+        'FAKE_SPOTDL_TRACK_BYTES': str(args.track_bytes),
+        'FAKE_SPOTDL_CATALOG': str(args.catalog),
+        'FAKE_SPOTDL_FAIL_RATE': str(args.fail_rate),
+        'FAKE_SPOTDL_429_RATE': str(args.rate_limit_rate),
+        'FAKE_SPOTDL_HANG_RATE': str(args.hang_rate),
+        'FAKE_SPOTDL_SEED': str(args.seed),
+        'SPOTIFY_CLIENT_ID': '',
+        'SPOTIFY_CLIENT_SECRET': '',
+    }
+    env.update(item.split('=', 1) for item in args.env)
+    if args.server == 'gunicorn':
+        cmd = [sys.executable, '-m', 'gunicorn', '--pythonpath', str(REPO_DIR), '-b', f'127.0.0.1:{port}',
+               '-w', str(args.workers), '-k', 'gthread', '--threads', '16', '--timeout', '300', 'app:create_app()']
+    else:
+        cmd = [sys.executable, '-c',
+               f'from app import create_app; create_app().run(host="127.0.0.1", port={port}, threaded=True, use_reloader=False)']
+    log = open(workdir / 'server.log', 'w')
+    process = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"Server exited with status {process.returncode}, see {workdir / 'server.log'}")
+        try:
+            if request('GET', f'{base}/health', timeout=2)[0] == 200:
+                return process, base
+        except OSError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    sys.exit(f"Server did not become healthy, see {workdir / 'server.log'}")
+
+def run_job(base, index, args, run_id):
+    """Submit one download, wait for it and fetch its archive; returns a result dict"""
+    playlist = 'shared' if args.reuse_playlists else f'{run_id}{index:05d}'
+    body = {'url': f'https://open.spotify.com/playlist/bench{playlist}', 'formats': args.format.split(',')}
+    started = time.monotonic()
+    rejected = 0
+    while True:
+        status, headers, data = request('POST', f'{base}/download', body)
+        if status not in (429, 503):
+            break
+        rejected += 1
+        time.sleep(float(headers.get('Retry-After') or 1))
+    if status != 200:
+        return {'ok': False, 'error': f'submit failed with {status}: {data[:200]!r}', 'rejected': rejected}
+    task_id = json.loads(data)['task_id']
+
+    first_file = None
+    while True:
+        status, _, data = request('GET', f'{base}/status/{task_id}')
+        state = json.loads(data)
+        if first_file is None and any(track.get('files') for track in state.get('tracks') or []):
+            # Finished tracks are downloadable individually from here on
+            first_file = time.monotonic() - started
+        if state.get('status') in ('completed', 'error') or status != 200:
+            break
+        time.sleep(args.poll_interval)
+    if state.get('status') != 'completed':
+        return {'ok': False, 'error': state.get('error') or f'status {status}', 'rejected': rejected}
+
+    size = download_size(f'{base}/download/{task_id}')
+    return {
+        'ok': True,
+        'latency': time.monotonic() - started,
+        'first_file': first_file,
+        'bytes': size,
+        'tracks_failed': state.get('tracks_failed', 0),
+        'rejected': rejected,
+    }
+
+def stage_averages(text):
+    """Average seconds per stage from the app's Prometheus histograms"""
+    sums, counts = {}, {}
+    for line in text.splitlines():
+        if line.startswith('playlist_downloader_') and ('_seconds_sum' in line or '_seconds_count' in line):
+            name, value = line.rsplit(' ', 1)
+            stage = name[len('playlist_downloader_'):].split('_seconds_')[0]
+            (sums if name.endswith('_sum') else counts)[stage] = float(value)
+    return {stage: round(sums[stage] / counts[stage], 3) for stage in sums if counts.get(stage)}
+
+def compare(result, baseline, tolerance):
+    """Regression messages for metrics worse than the baseline by more than tolerance"""
+    checks = [
+        ('jobs_per_minute', -1),
+        ('latency_p95', 1),
+        ('first_file_p95', 1),
+        ('peak_rss_mb', 1),
+    ]
+    regressions = []
+    for name, direction in checks:
+        old, new = baseline.get(name), result.get(name)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        if change * direction > tolerance:
+            regressions.append(f"{name}: {old} -> {new} ({change:+.0%})")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=20, help='downloads to run')
+    parser.add_argument('--concurrency', type=int, default=4, help='clients submitting at the same time')
+    parser.add_argument('--tracks', type=int, default=10, help='tracks per playlist')
+    parser.add_argument('--format', default='mp3', help='format, or several separated by commas')
+    parser.add_argument('--latency', type=float, default=0.5, help='mean seconds per track')
+    parser.add_argument('--jitter', type=float, default=0.3, help='+/- fraction of the track latency')
+    parser.add_argument('--track-bytes', type=int, default=1000000, help='size of each fake track')
+    parser.add_argument('--fail-rate', type=float, default=0, help='probability a track is not found')
+    parser.add_argument('--rate-limit-rate', type=float, default=0, help='probability a track gets HTTP 429')
+    parser.add_argument('--hang-rate', type=float, default=0, help='probability a track hangs')
+    parser.add_argument('--track-timeout', type=int, default=15, help='SPOTDL_TRACK_TIMEOUT for hung tracks')
+    parser.add_argument('--reuse-playlists', action='store_true', help='every job asks for the same playlist')
+    parser.add_argument('--catalog', type=int, default=0, help='songs all playlists draw from, so they share tracks')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--server', choices=['werkzeug', 'gunicorn'], default='werkzeug')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='extra app setting')
+    parser.add_argument('--poll-interval', type=float, default=0.2)
+    parser.add_argument('--json', help='write the result to this file')
+    parser.add_argument('--compare', help='baseline result to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed relative regression')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory')
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix='playlist-bench-'))
+    process, base = start_server(args, workdir, free_port())
+    sampler = Sampler(process.pid, workdir)
+    sampler.start()
+    run_id = format(int(time.time()), 'x')
+    try:
+        started = time.monotonic()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            results = list(pool.map(lambda index: run_job(base, index, args, run_id), range(args.jobs)))
+        elapsed = time.monotonic() - started
+        stages = stage_averages(request('GET', f'{base}/metrics')[2].decode())
+    finally:
+        sampler.stopped.set()
+        sampler.join()
+        process.terminate()
+        process.wait(timeout=30)
+
+    latencies = [result['latency'] for result in results if result['ok']]
+    first_files = [result['first_file'] for result in results if result['ok'] and result['first_file'] is not None]
+    errors = [result['error'] for result in results if not result['ok']]
+    result = {
+        'jobs': args.jobs,
+        'completed': len(latencies),
+        'failed': len(errors),
+        'rejected_submissions': sum(result['rejected'] for result in results),
+        'tracks_failed': sum(result.get('tracks_failed', 0) for result in results),
+        'elapsed_seconds': round(elapsed, 2),
+        'jobs_per_minute': round(len(latencies) / elapsed * 60, 2),
+        'latency_p50': round(percentile(latencies, 0.50), 3) if latencies else None,
+        'latency_p95': round(percentile(latencies, 0.95), 3) if latencies else None,
+        'latency_p99': round(percentile(latencies, 0.99), 3) if latencies else None,
+        'first_file_p50': round(percentile(first_files, 0.50), 3) if first_files else None,
+        'first_file_p95': round(percentile(first_files, 0.95), 3) if first_files else None,
+        'peak_rss_mb': round(sampler.peak_rss / 1024 ** 2, 1),
+        'peak_disk_mb': round(sampler.peak_disk / 1024 ** 2, 1),
+        'archive_mb': round(sum(result.get('bytes', 0) for result in results) / 1024 ** 2, 1),
+        'stage_avg_seconds': stages,
+        'settings': {key: value for key, value in vars(args).items() if key not in ('json', 'compare', 'keep')},
+    }
+
+    print(json.dumps(result, indent=2))
+    for error in errors[:5]:
+        print(f"error: {error}", file=sys.stderr)
+    if args.json:
+        Path(args.json).write_text(json.dumps(result, indent=2))
+    if args.keep:
+        print(f"Scratch directory kept at {workdir}", file=sys.stderr)
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.compare:
+        regressions = compare(result, json.loads(Path(args.compare).read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+Disk usage
+Sizes and expiry times of job outputs in a SQLite index, so cleanup and the disk
+budget never walk the file system.
+"""
+
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+from storage import sqlite_connection
+
+def unshared_size(files):
+    """Bytes that removing the files would free.
+
+    Tracks in a job directory are hard links into the track cache, those stay on disk
+    until the cache evicts them, so files with more than one link are not counted.
+    """
+    total = 0
+    for file in files:
+        try:
+            stat = os.stat(file)
+        except OSError:
+            continue
+        if stat.st_nlink == 1:
+            total += stat.st_size
+    return total
+
+def path_size(path):
+    """Bytes used by a file or a directory tree, not counting files shared with the track cache"""
+    path = Path(path)
+    if path.is_file():
+        return unshared_size([path])
+    return unshared_size(
+        os.path.join(dirpath, name) for dirpath, _, filenames in os.walk(path) for name in filenames
+    )
+
+class DiskUsageIndex:
+    """Sizes and expiry times of job outputs, maintained as they are created and removed.
+
+    Triggers keep a running total per area (downloads, output, temp), so usage reads
+    are O(1). Cleanup pops expired entries in expiry order and budget enforcement
+    removes the entries closest to expiry first, neither walks the file system.
+    reconcile() registers whatever is on disk but not in the index (left behind by a
+    crashed worker) and forgets entries that no longer exist.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self._local = threading.local()
+
+    def _create_tables(self, conn):
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS artifacts (
+                path TEXT PRIMARY KEY,
+                area TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_artifacts_expires ON artifacts (expires_at);
+            CREATE TABLE IF NOT EXISTS usage (
+                area TEXT PRIMARY KEY,
+                size INTEGER NOT NULL
+            );
+            CREATE TRIGGER IF NOT EXISTS artifacts_insert AFTER INSERT ON artifacts BEGIN
+                INSERT INTO usage VALUES (NEW.area, NEW.size)
+                    ON CONFLICT (area) DO UPDATE SET size = size + NEW.size;
+            END;
+            CREATE TRIGGER IF NOT EXISTS artifacts_update AFTER UPDATE OF size ON artifacts BEGIN
+                UPDATE usage SET size = size - OLD.size + NEW.size WHERE area = NEW.area;
+            END;
+            CREATE TRIGGER IF NOT EXISTS artifacts_delete AFTER DELETE ON artifacts BEGIN
+                UPDATE usage SET size = size - OLD.size WHERE area = OLD.area;
+            END;
+        """)
+
+    def _connect(self):
+        return sqlite_connection(self._local, self.path, self._create_tables)
+
+    def add(self, path, area, ttl, size=None, created_at=None):
+        """Register a finished output; size is measured when not given"""
+        size = path_size(path) if size is None else size
+        created_at = created_at or time.time()
+        self._connect().execute(
+            "INSERT INTO artifacts VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (path) DO UPDATE SET size = excluded.size, expires_at = excluded.expires_at",
+            (str(path), area, size, created_at, created_at + ttl)
+        )
+
+    def touch(self, path, ttl):
+        """Push back the expiry of an output that is being reused"""
+        self._connect().execute(
+            "UPDATE artifacts SET expires_at = MAX(expires_at, ?) WHERE path = ?", (time.time() + ttl, str(path))
+        )
+
+    def remove(self, path):
+        path = Path(path)
+        if path.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            path.unlink(missing_ok=True)
+        self._connect().execute("DELETE FROM artifacts WHERE path = ?", (str(path),))
+
+    def pop_expired(self):
+        """Remove every expired output; returns how many were removed"""
+        rows = self._connect().execute(
+            "SELECT path FROM artifacts WHERE expires_at < ? ORDER BY expires_at", (time.time(),)
+        ).fetchall()
+        for (path,) in rows:
+            self.remove(path)
+        return len(rows)
+
+    def enforce_budget(self, max_bytes, min_age=0):
+        """Remove the outputs closest to expiry until total usage fits max_bytes.
+
+        Outputs younger than min_age are kept, so a job is never removed as soon as it finished.
+        """
+        conn = self._connect()
+        excess = self.total() - max_bytes
+        removed = 0
+        while excess > 0:
+            row = conn.execute(
+                "SELECT path, size FROM artifacts WHERE created_at < ? ORDER BY expires_at LIMIT 1",
+                (time.time() - min_age,)
+            ).fetchone()
+            if row is None:
+                break
+            self.remove(row[0])
+            excess -= row[1]
+            removed += 1
+        return removed
+
+    def usage(self):
+        return dict(self._connect().execute("SELECT area, size FROM usage").fetchall())
+
+    def total(self):
+        return self._connect().execute("SELECT COALESCE(SUM(size), 0) FROM usage").fetchone()[0]
+
+    def next_expiry(self):
+        return self._connect().execute("SELECT MIN(expires_at) FROM artifacts").fetchone()[0]
+
+    def reconcile(self, areas, ttl, skip=lambda path: False):
+        """Sync the index with the top-level entries of each area directory"""
+        conn = self._connect()
+        known = {row[0] for row in conn.execute("SELECT path FROM artifacts").fetchall()}
+        for path in known:
+            if not Path(path).exists():
+                conn.execute("DELETE FROM artifacts WHERE path = ?", (path,))
+        registered = 0
+        for area, directory in areas.items():
+            if not directory.is_dir():
+                continue
+            for path in directory.iterdir():
+                if str(path) in known or skip(path):
+                    continue
+                try:
+                    self.add(path, area, ttl, created_at=path.stat().st_mtime)
+                    registered += 1
+                except FileNotFoundError:
+                    pass
+        return registered
@@ -0,0 +1,491 @@
+"""
+Job queue
+Bounded download queues with per-client fairness: JobScheduler keeps the jobs of
+one process in memory, SQLiteJobQueue shares durable, leased jobs between the web
+and worker processes through a SQLite database in WAL mode.
+"""
+
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from pathlib import Path
+
+from storage import sqlite_connection
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 1.0  # idle dispatchers check the durable queue this often at first,
+POLL_MAX_INTERVAL = 5.0  # backing off to this while it stays empty
+
+class QueueFull(Exception):
+    """Raised when a job cannot be admitted; carries a Retry-After hint in seconds"""
+    def __init__(self, message, retry_after, per_client=False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.per_client = per_client
+
+class LeaseLost(Exception):
+    """This process's lease on a job ran out and another worker may have taken the job over"""
+
+class QueuedJob:
+    def __init__(self, task_id, url, format_type, client, size, seq, enqueued_at=None, batch=None):
+        self.task_id = task_id
+        self.url = url
+        self.format_type = format_type
+        self.client = client
+        self.size = size
+        self.seq = seq
+        self.enqueued_at = enqueued_at or time.time()
+        self.batch = batch
+
+class JobScheduler:
+    """Bounded job queue in front of the download workers with per-client fairness.
+
+    Whenever a download slot frees up, the next job comes from the client with the
+    fewest running jobs; ties go to the smaller size class (1 track, up to 20, more),
+    then to the client served least recently. Within a client, smaller jobs go first.
+    Jobs age one size class every aging_seconds so large playlists still start.
+    A batch takes one place in the queue: its playlists wait outside it and the next
+    one enters the queue when the one before it is dispatched.
+
+    Queued tasks are looked up in tasks (the task store) to publish their positions,
+    run(job) does the work of a dispatched job in a slot taken from concurrency, and
+    the time jobs waited is observed in metrics.
+    """
+    durable = False
+
+    def __init__(self, max_depth, max_per_client, workers, tasks, run, concurrency, metrics, aging_seconds=300):
+        self.max_depth = max_depth
+        self.max_per_client = max_per_client
+        self.workers = workers
+        self.tasks = tasks
+        self.run = run
+        self.concurrency = concurrency
+        self.metrics = metrics
+        self.aging_seconds = aging_seconds
+        self.avg_job_seconds = 60.0
+        self._queued = defaultdict(list)  # client -> [QueuedJob]
+        self._held = {}  # batch -> deque of QueuedJob not in the queue yet
+        self._running = defaultdict(int)
+        self._served_at = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._dispatcher_pid = None
+        self._active = 0
+        self._stopping = False
+
+    def depth(self):
+        return sum(len(jobs) for jobs in self._queued.values())
+
+    def retry_after(self):
+        """Seconds until roughly one queue's worth of work has drained"""
+        return max(1, math.ceil(self.depth() * self.avg_job_seconds / max(self.concurrency.job_limit, 1)))
+
+    def admit(self, depth, queued_by_client, count):
+        """Raise QueueFull unless count more jobs of a client fit in the queue and in its share"""
+        if depth + count > self.max_depth:
+            raise QueueFull('Download queue is full', self.retry_after())
+        if queued_by_client + count > self.max_per_client:
+            raise QueueFull('Too many queued downloads for this client', self.retry_after(), per_client=True)
+
+    def submit(self, task, client, size, force=False):
+        """Queue a task; force skips admission control for work that was already accepted"""
+        self.submit_all([(task, size)], client, force)
+
+    def submit_all(self, jobs, client, force=False, batch=None):
+        """Queue (task, size) pairs of one client, all of them or none; the jobs of a batch count as one"""
+        with self._cond:
+            if not force:
+                self.admit(self.depth(), len(self._queued[client]), 1 if batch else len(jobs))
+            queued = [QueuedJob(task.task_id, task.url, task.format_type, client, size, next(self._seq), batch=batch)
+                      for task, size in jobs]
+            if batch and len(queued) > 1:
+                queued, self._held[batch] = queued[:1], deque(queued[1:])
+                for task, _ in jobs[1:]:
+                    task.message = 'Waiting for earlier playlists of the batch...'
+            self._queued[client].extend(queued)
+            self._publish_positions()
+            self._cond.notify_all()
+
+    def _rank(self, job, running, served_at, now):
+        size_class = 0 if job.size <= 1 else 1 if job.size <= 20 else 2
+        size_class -= int((now - job.enqueued_at) // self.aging_seconds)
+        return (running[job.client], size_class, served_at.get(job.client, 0), job.size, job.seq)
+
+    def _pick(self, queued, running, served_at, now):
+        rank = lambda job: self._rank(job, running, served_at, now)
+        heads = [min(jobs, key=rank) for jobs in queued.values() if jobs]
+        return min(heads, key=rank) if heads else None
+
+    def _dispatch_order(self, queued, running, served_at):
+        """Yield the queued jobs in the order they would be dispatched"""
+        queued = {client: list(jobs) for client, jobs in queued.items()}
+        running = defaultdict(int, running)
+        now = time.time()
+        while True:
+            job = self._pick(queued, running, served_at, now)
+            if job is None:
+                return
+            queued[job.client].remove(job)
+            running[job.client] += 1
+            yield job
+
+    def _publish_positions(self):
+        """Write each waiting task's position, simulating the order jobs would be dispatched in"""
+        for position, job in enumerate(self._dispatch_order(self._queued, self._running, self._served_at), 1):
+            task = self.tasks.get(job.task_id)
+            if task is not None:
+                task.queue_position = position
+                task.message = f'Queued for download (position {position})...'
+
+    def position(self, task):
+        """1-based queue position of a waiting task, None once it has started"""
+        return task.queue_position
+
+    def check_lease(self, task_id):
+        """Raise LeaseLost if this process may no longer work on the job (jobs in memory never expire)"""
+
+    def get(self):
+        """Block until a job is queued and return the fairest one; None when stopping"""
+        with self._cond:
+            while not self.depth() and not self._stopping:
+                self._cond.wait()
+            if self._stopping:
+                return None
+            job = self._pick(self._queued, self._running, self._served_at, time.time())
+            self._queued[job.client].remove(job)
+            if job.batch in self._held:
+                following = self._held[job.batch].popleft()
+                following.enqueued_at = time.time()
+                self._queued[job.client].append(following)
+                if not self._held[job.batch]:
+                    del self._held[job.batch]
+            if not self._queued[job.client]:
+                del self._queued[job.client]
+            self._running[job.client] += 1
+            self._served_at[job.client] = time.time()
+            self._publish_positions()
+        task = self.tasks.get(job.task_id)
+        if task is not None:
+            task.queue_position = None
+        return job
+
+    def done(self, job, seconds):
+        with self._cond:
+            self._running[job.client] -= 1
+            if not self._running[job.client]:
+                del self._running[job.client]
+            self.avg_job_seconds = 0.8 * self.avg_job_seconds + 0.2 * seconds
+            if self.depth():
+                self._publish_positions()
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                'depth': self.depth(),
+                'max_depth': self.max_depth,
+                'running': sum(self._running.values()),
+                'clients_waiting': len(self._queued),
+                'avg_job_seconds': round(self.avg_job_seconds, 1)
+            }
+
+    def start_dispatchers(self):
+        """Start this process's dispatcher threads; a no-op if they are already running"""
+        # Started lazily so each forked worker gets its own
+        if self._dispatcher_pid == os.getpid():
+            return
+        with self._cond:
+            if self._dispatcher_pid == os.getpid():
+                return
+            self._dispatcher_pid = os.getpid()
+            for _ in range(self.workers):
+                threading.Thread(target=self._dispatch_loop, daemon=True).start()
+
+    def stop(self):
+        """Stop taking new jobs; running ones carry on"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+    def wait_idle(self, timeout):
+        """Wait for this process's running jobs to finish; False on timeout"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._active, timeout)
+
+    def _dispatch_loop(self):
+        while not self._stopping:
+            # Take a slot from the adaptive controller first, then the fairest job at that moment
+            with self.concurrency.job_slot():
+                job = self.get()
+                if job is None:
+                    return
+                with self._cond:
+                    self._active += 1
+                self.metrics.observe('queue_wait_seconds', max(time.time() - job.enqueued_at, 0))
+                started = time.monotonic()
+                try:
+                    self.run(job)
+                except Exception as e:
+                    logger.error(f"Unhandled error in download job {job.task_id}: {e}")
+                finally:
+                    self.done(job, time.monotonic() - started)
+                    with self._cond:
+                        self._active -= 1
+                        self._cond.notify_all()
+
+class SQLiteJobQueue(JobScheduler):
+    """Durable job queue shared by the web processes and `python app.py worker` processes.
+
+    Jobs live in SQLite next to the task store, so any process can pick them up. A
+    claimed job is leased to its worker for JOB_LEASE_SECONDS and a heartbeat thread
+    renews the lease while the download runs. If the worker dies, the lease runs out,
+    the job goes back to the queue and the next worker resumes it from the task
+    manifest; after MAX_JOB_ATTEMPTS leases the task is failed instead. Jobs are
+    picked with the same fairness rules as the in-memory scheduler.
+
+    owner() names the calling process in leases; fail(task_id, error) is called for a
+    task whose job was dropped after max_attempts leases.
+    """
+    durable = True
+
+    def __init__(self, path, max_depth, max_per_client, workers, tasks, run, concurrency, metrics,
+                 lease_seconds, max_attempts, owner, fail, aging_seconds=300):
+        super().__init__(max_depth, max_per_client, workers, tasks, run, concurrency, metrics, aging_seconds)
+        self.path = Path(path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.owner = owner
+        self.fail = fail
+        self._local = threading.local()
+        self._positions = ({}, 0)
+        self._leases = set()  # jobs this process is running
+        self._lost = set()  # of those, the ones whose lease ran out
+
+    def _create_tables(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                task_id TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                format_type TEXT NOT NULL,
+                client TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                enqueued_at REAL NOT NULL,
+                state TEXT NOT NULL,
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                batch TEXT
+            )
+        """)
+        if 'batch' not in {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}:
+            conn.execute("ALTER TABLE jobs ADD COLUMN batch TEXT")  # queues created before batches were held
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, lease_expires)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs (batch, state)")
+        conn.execute("CREATE TABLE IF NOT EXISTS job_clients (client TEXT PRIMARY KEY, served_at REAL NOT NULL)")
+
+    def _connect(self):
+        return sqlite_connection(self._local, self.path, self._create_tables)
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _load(self, conn):
+        """Queued jobs per client, running jobs per client and last service times"""
+        queued = defaultdict(list)
+        rows = conn.execute(
+            "SELECT task_id, url, format_type, client, size, enqueued_at, batch FROM jobs WHERE state = 'queued'"
+        ).fetchall()
+        for task_id, url, format_type, client, size, enqueued_at, batch in rows:
+            queued[client].append(QueuedJob(task_id, url, format_type, client, size, enqueued_at, enqueued_at, batch))
+        running = defaultdict(int, conn.execute(
+            "SELECT client, COUNT(*) FROM jobs WHERE state = 'leased' GROUP BY client"
+        ).fetchall())
+        served_at = dict(conn.execute("SELECT client, served_at FROM job_clients").fetchall())
+        return queued, running, served_at
+
+    def depth(self):
+        return self._connect().execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+
+    def submit_all(self, jobs, client, force=False, batch=None):
+        """Queue tasks and hand them over to whichever processes claim the jobs, all or none.
+
+        The jobs of a batch after the first are held and count as one with it.
+        """
+        for index, (task, _) in enumerate(jobs):
+            task.message = 'Waiting for earlier playlists of the batch...' if batch and index else 'Queued for download...'
+            self.tasks.release(task)
+        try:
+            with self._transaction() as conn:
+                if not force:
+                    depth = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+                    mine = conn.execute(
+                        "SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND client = ?", (client,)
+                    ).fetchone()[0]
+                    self.admit(depth, mine, 1 if batch else len(jobs))
+                now = time.time()
+                conn.executemany(
+                    "INSERT OR REPLACE INTO jobs (task_id, url, format_type, client, size, enqueued_at, state, batch) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(task.task_id, task.url, task.format_type, client, size, now,
+                      'held' if batch and index else 'queued', batch)
+                     for index, (task, size) in enumerate(jobs)]
+                )
+        except QueueFull:
+            # Not queued after all, take the tasks back so the caller can fail them
+            for task, _ in jobs:
+                self.tasks.adopt(task, self.owner())
+            raise
+        with self._cond:
+            self._cond.notify_all()
+
+    def _claim(self):
+        """Re-queue expired leases and lease the fairest queued job to this process"""
+        now = time.time()
+        owner = self.owner()
+        with self._transaction() as conn:
+            expired = conn.execute(
+                "SELECT task_id, worker, attempts FROM jobs WHERE state = 'leased' AND lease_expires < ?", (now,)
+            ).fetchall()
+            abandoned = [task_id for task_id, _, attempts in expired if attempts >= self.max_attempts]
+            for task_id, worker, attempts in expired:
+                logger.warning(f"Lease of job {task_id} held by {worker} expired (attempt {attempts})")
+            conn.executemany("DELETE FROM jobs WHERE task_id = ?", [(task_id,) for task_id in abandoned])
+            conn.execute(
+                "UPDATE jobs SET state = 'queued', worker = NULL, lease_expires = NULL "
+                "WHERE state = 'leased' AND lease_expires < ?", (now,)
+            )
+            job = self._pick(*self._load(conn), now)
+            if job is not None:
+                conn.execute(
+                    "UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                    "WHERE task_id = ?", (owner, now + self.lease_seconds, job.task_id)
+                )
+                conn.execute("INSERT OR REPLACE INTO job_clients VALUES (?, ?)", (job.client, now))
+                if job.batch:
+                    # The batch keeps its place in the queue with its next playlist
+                    conn.execute(
+                        "UPDATE jobs SET state = 'queued', enqueued_at = ? WHERE task_id = "
+                        "(SELECT task_id FROM jobs WHERE batch = ? AND state = 'held' ORDER BY rowid LIMIT 1)",
+                        (now, job.batch)
+                    )
+        for task_id in abandoned:
+            self.fail(task_id, 'Download worker stopped repeatedly while running this task')
+        return job
+
+    def _claimable(self):
+        """Whether a job is queued or a lease expired; a plain read, so idle polls never take the write lock"""
+        return self._connect().execute(
+            "SELECT 1 FROM jobs WHERE state = 'queued' OR (state = 'leased' AND lease_expires < ?) LIMIT 1",
+            (time.time(),)
+        ).fetchone() is not None
+
+    def get(self):
+        """Lease the fairest job, polling the queue until one is available; None when stopping"""
+        interval = POLL_INTERVAL
+        while not self._stopping:
+            job = self._claim() if self._claimable() else None
+            if job is not None:
+                interval = POLL_INTERVAL
+                task = self.tasks.get(job.task_id)
+                if task is not None and self.tasks.adopt(task, self.owner()):
+                    with self._cond:
+                        self._leases.add(job.task_id)
+                    return job
+                logger.error(f"Dropping job {job.task_id}: task is missing or owned elsewhere")
+                self.done(job, 0)
+                continue
+            # Jobs submitted by this process wake the dispatchers right away, others are seen
+            # on the next poll, which backs off while the queue stays empty
+            with self._cond:
+                self._cond.wait(interval)
+            interval = min(interval * 2, POLL_MAX_INTERVAL)
+        return None
+
+    def done(self, job, seconds):
+        self._connect().execute("DELETE FROM jobs WHERE task_id = ? AND worker = ?", (job.task_id, self.owner()))
+        with self._cond:
+            self._leases.discard(job.task_id)
+            self._lost.discard(job.task_id)
+            if seconds:
+                self.avg_job_seconds = 0.8 * self.avg_job_seconds + 0.2 * seconds
+
+    def check_lease(self, task_id):
+        if task_id in self._lost:
+            raise LeaseLost(f"Lease on job {task_id} was lost")
+
+    def position(self, task):
+        if task.status != 'pending':
+            return None
+        positions, computed = self._positions
+        if time.monotonic() - computed > 1:
+            order = self._dispatch_order(*self._load(self._connect()))
+            positions = {job.task_id: position for position, job in enumerate(order, 1)}
+            self._positions = (positions, time.monotonic())
+        return positions.get(task.task_id)
+
+    def snapshot(self):
+        conn = self._connect()
+        counts = dict(conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        return {
+            'depth': counts.get('queued', 0),
+            'max_depth': self.max_depth,
+            'running': counts.get('leased', 0),
+            'clients_waiting': conn.execute(
+                "SELECT COUNT(DISTINCT client) FROM jobs WHERE state = 'queued'"
+            ).fetchone()[0],
+            'workers': conn.execute(
+                "SELECT COUNT(DISTINCT worker) FROM jobs WHERE state = 'leased'"
+            ).fetchone()[0],
+            'avg_job_seconds': round(self.avg_job_seconds, 1)
+        }
+
+    def start_dispatchers(self):
+        if self._dispatcher_pid == os.getpid():
+            return
+        super().start_dispatchers()
+        threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+
+    def _heartbeat_loop(self):
+        # Renew every lease this process holds well before it can expire
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            try:
+                self._renew_leases()
+            except Exception as e:
+                logger.error(f"Error renewing job leases: {e}")
+
+    def _renew_leases(self):
+        """Extend the leases of running jobs; a job whose lease is gone is stopped here"""
+        with self._cond:
+            running = self._leases - self._lost
+        if not running:
+            return
+        lost = []
+        with self._transaction() as conn:
+            for task_id in running:
+                cursor = conn.execute(
+                    "UPDATE jobs SET lease_expires = ? WHERE task_id = ? AND state = 'leased' AND worker = ?",
+                    (time.time() + self.lease_seconds, task_id, self.owner())
+                )
+                if cursor.rowcount == 0:
+                    lost.append(task_id)
+        for task_id in lost:
+            # The lease expired (e.g. this process stalled) and the job was re-queued: stop writing
+            # the task at once, the download thread stops at its next check
+            logger.error(f"Lease on job {task_id} was lost, stopping it in {self.owner()}")
+            with self._cond:
+                self._lost.add(task_id)
+            self.tasks.disown(task_id)
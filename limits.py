@@ -0,0 +1,133 @@
+"""
+Limits
+Upstream rate limits and download concurrency: token buckets shared by every
+process through a SQLite database in WAL mode, and the AIMD controller that sizes
+job and spotDL thread parallelism from rate limits and track latency.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from storage import sqlite_connection
+
+logger = logging.getLogger(__name__)
+
+class TokenBucketLimiter:
+    """Token buckets per upstream, shared by every thread and worker process.
+
+    Bucket state lives in a small SQLite database; each acquire is one write
+    transaction, which serializes callers across processes. Callers reserve their
+    tokens up front (the balance may go negative) and then sleep exactly once until
+    the reservation is covered, so waiting jobs queue in order without polling.
+    """
+    def __init__(self, path, limits):
+        self.path = Path(path)
+        self.limits = limits
+        self._local = threading.local()
+
+    def _create_tables(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS buckets (
+                name TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+
+    def _connect(self):
+        return sqlite_connection(self._local, self.path, self._create_tables)
+
+    def reserve(self, *names, tokens=1):
+        """Take tokens from each named bucket and return how long to wait before using them"""
+        conn = self._connect()
+        wait = 0.0
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            for name in names:
+                rate, burst = self.limits[name]
+                row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE name = ?", (name,)).fetchone()
+                available = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+                available -= tokens
+                conn.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (name, available, now))
+                wait = max(wait, -available / rate)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def acquire(self, *names, tokens=1):
+        """Block until tokens are available in every named bucket"""
+        wait = self.reserve(*names, tokens=tokens)
+        if wait > 0:
+            log = logger.info if wait >= 1 else logger.debug
+            log(f"Rate limiter: waiting {wait:.2f}s for {tokens} {'/'.join(names)} token(s)")
+            time.sleep(wait)
+        return wait
+
+class AdaptiveConcurrency:
+    """AIMD controller for job-level and track-level parallelism.
+
+    Rate-limit errors halve both limits (multiplicative decrease). Chunks that finish
+    without throttling and within the per-track latency target add one spotDL thread,
+    and once threads are maxed out one job slot (additive increase). Per-track latency
+    above twice the target takes a thread away.
+    """
+    def __init__(self, job_bounds, thread_bounds, latency_target):
+        self.job_min, self.job_limit, self.job_max = job_bounds
+        self.thread_min, self.track_threads, self.thread_max = thread_bounds
+        self.latency_target = latency_target
+        self.active_jobs = 0
+        self.rate_limit_events = 0
+        self.track_latency = None  # moving average, seconds per track per thread slot
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def job_slot(self):
+        """Hold one of the currently allowed job slots while a download runs"""
+        with self._cond:
+            while self.active_jobs >= self.job_limit:
+                self._cond.wait()
+            self.active_jobs += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.active_jobs -= 1
+                self._cond.notify_all()
+
+    def on_rate_limited(self):
+        with self._cond:
+            self.rate_limit_events += 1
+            self.job_limit = max(self.job_min, self.job_limit // 2)
+            self.track_threads = max(self.thread_min, self.track_threads // 2)
+        logger.warning(f"Rate limited upstream, concurrency reduced to {self.job_limit} jobs x {self.track_threads} threads")
+
+    def on_chunk(self, tracks, seconds, threads):
+        """Feed back the duration of a spotDL run that finished without throttling"""
+        latency = seconds * threads / max(tracks, 1)
+        with self._cond:
+            self.track_latency = latency if self.track_latency is None else 0.8 * self.track_latency + 0.2 * latency
+            if self.track_latency > 2 * self.latency_target:
+                self.track_threads = max(self.thread_min, self.track_threads - 1)
+            elif self.track_latency > self.latency_target:
+                pass
+            elif self.track_threads < self.thread_max:
+                self.track_threads += 1
+            elif self.job_limit < self.job_max:
+                self.job_limit += 1
+                self._cond.notify_all()
+
+    def snapshot(self):
+        return {
+            'job_limit': self.job_limit,
+            'job_limit_bounds': [self.job_min, self.job_max],
+            'track_threads': self.track_threads,
+            'track_threads_bounds': [self.thread_min, self.thread_max],
+            'track_latency_seconds': round(self.track_latency, 2) if self.track_latency is not None else None,
+            'rate_limit_events': self.rate_limit_events
+        }
@@ -0,0 +1,110 @@
+"""
+Metadata cache
+Resolved track lists, track -> audio source matches and lyrics, shared by all
+workers and engine processes through a SQLite database in WAL mode.
+"""
+
+import json
+import time
+import threading
+from pathlib import Path
+
+from storage import sqlite_connection
+
+def track_ref(song):
+    """Provider-qualified identity of a spotDL song dict, e.g. spotify:<track id>"""
+    provider = 'spotify' if 'spotify.com' in (song.get('url') or '').lower() else 'youtube'
+    return f"{provider}:{song.get('song_id') or song.get('url')}"
+
+class MetadataCache:
+    """Key/value cache with a TTL per entry and least-recently-used eviction above max_bytes.
+
+    Entries are JSON values grouped by kind ('tracks', 'match', 'lyrics'). Expired entries
+    read as missing and are deleted by evict(), which then drops the least recently used
+    entries until the cache fits its size budget.
+    """
+    TOUCH_INTERVAL = 60  # only record reads this far apart to keep hits read-only
+    EVICT_EVERY = 200  # puts between size checks
+
+    def __init__(self, path, max_bytes):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._puts = 0
+
+    def _create_tables(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS metadata (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (kind, key)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_metadata_expires ON metadata (expires_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_metadata_accessed ON metadata (accessed_at)")
+
+    def _connect(self):
+        return sqlite_connection(self._local, self.path, self._create_tables)
+
+    def get(self, kind, key):
+        """Cached value, or None when missing or expired"""
+        now = time.time()
+        row = self._connect().execute(
+            "SELECT value, expires_at, accessed_at FROM metadata WHERE kind = ? AND key = ?", (kind, key)
+        ).fetchone()
+        if row is None or row[1] < now:
+            return None
+        if now - row[2] > self.TOUCH_INTERVAL:
+            self._connect().execute(
+                "UPDATE metadata SET accessed_at = ? WHERE kind = ? AND key = ?", (now, kind, key)
+            )
+        return json.loads(row[0])
+
+    def count(self, kind, key):
+        """Length of a cached list, without loading it; None when missing or expired"""
+        row = self._connect().execute(
+            "SELECT json_array_length(value) FROM metadata WHERE kind = ? AND key = ? AND expires_at >= ?",
+            (kind, key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, kind, key, value, ttl):
+        now = time.time()
+        data = json.dumps(value)
+        self._connect().execute(
+            "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)",
+            (kind, key, data, len(data), now + ttl, now)
+        )
+        self._puts += 1
+        if self._puts % self.EVICT_EVERY == 0:
+            self.evict()
+
+    def delete(self, kind, key):
+        self._connect().execute("DELETE FROM metadata WHERE kind = ? AND key = ?", (kind, key))
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones until the cache fits max_bytes"""
+        conn = self._connect()
+        conn.execute("DELETE FROM metadata WHERE expires_at < ?", (time.time(),))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM metadata").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        rows = conn.execute("SELECT kind, key, size FROM metadata ORDER BY accessed_at").fetchall()
+        victims = []
+        for kind, key, size in rows:
+            if excess <= 0:
+                break
+            victims.append((kind, key))
+            excess -= size
+        conn.executemany("DELETE FROM metadata WHERE kind = ? AND key = ?", victims)
+
+    def stats(self):
+        rows = self._connect().execute(
+            "SELECT kind, COUNT(*), COALESCE(SUM(size), 0) FROM metadata GROUP BY kind"
+        ).fetchall()
+        return {kind: {'entries': count, 'bytes': size} for kind, count, size in rows}
@@ -0,0 +1,142 @@
+"""
+Metrics
+Prometheus counters and histograms shared by all web and worker processes through
+a SQLite database in WAL mode, so any process can answer a /metrics scrape with the
+totals of the whole deployment. Gauges are read from callbacks at scrape time.
+"""
+
+import math
+import time
+import threading
+from pathlib import Path
+
+from storage import sqlite_connection
+
+DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+def format_labels(labels):
+    """Prometheus label set, sorted so equal label sets are stored as the same series"""
+    if not labels:
+        return ''
+    pairs = ','.join(f'{name}="{escape(value)}"' for name, value in sorted(labels.items()))
+    return '{' + pairs + '}'
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class MetricsRegistry:
+    """Metric definitions of this process plus the samples every process has recorded.
+
+    A scrape reads one row per series, so its cost depends on the number of metrics
+    and label values, never on how many tasks have run. Histogram buckets are stored
+    per bucket and made cumulative when rendered.
+    """
+    def __init__(self, path, namespace):
+        self.path = Path(path)
+        self.namespace = namespace
+        self._metrics = {}  # name -> (type, help, buckets or gauge callback)
+        self._local = threading.local()
+
+    def _create_tables(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS samples (
+                name TEXT NOT NULL,
+                labels TEXT NOT NULL,
+                suffix TEXT NOT NULL,
+                value REAL NOT NULL,
+                PRIMARY KEY (name, labels, suffix)
+            )
+        """)
+
+    def _connect(self):
+        return sqlite_connection(self._local, self.path, self._create_tables)
+
+    def counter(self, name, help):
+        self._metrics[f"{self.namespace}_{name}"] = ('counter', help, None)
+
+    def histogram(self, name, help, buckets=DURATION_BUCKETS):
+        self._metrics[f"{self.namespace}_{name}"] = ('histogram', help, tuple(sorted(buckets)) + (math.inf,))
+
+    def gauge(self, name, help, callback):
+        """Gauge read at scrape time; callback returns a value or a {labels dict as tuple: value} mapping"""
+        self._metrics[f"{self.namespace}_{name}"] = ('gauge', help, callback)
+
+    def inc(self, name, amount=1, **labels):
+        self._connect().execute(
+            "INSERT INTO samples VALUES (?, ?, '', ?) "
+            "ON CONFLICT (name, labels, suffix) DO UPDATE SET value = value + excluded.value",
+            (f"{self.namespace}_{name}", format_labels(labels), amount)
+        )
+
+    def observe(self, name, value, **labels):
+        name = f"{self.namespace}_{name}"
+        bucket = next(bound for bound in self._metrics[name][2] if value <= bound)
+        label_text = format_labels(labels)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO samples VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (name, labels, suffix) DO UPDATE SET value = value + excluded.value",
+                [(name, label_text, f"le:{bucket}", 1), (name, label_text, 'sum', value), (name, label_text, 'count', 1)]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def timer(self, name, **labels):
+        """Context manager observing the duration of its block in a histogram"""
+        return Timer(self, name, labels)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        samples = {}
+        for name, labels, suffix, value in self._connect().execute("SELECT * FROM samples"):
+            samples.setdefault(name, {}).setdefault(labels, {})[suffix] = value
+
+        lines = []
+        for name, (kind, help, extra) in sorted(self._metrics.items()):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                for labels, values in sorted(samples.get(name, {}).items()):
+                    lines.append(f"{name}{labels} {format_value(values[''])}")
+            elif kind == 'histogram':
+                for labels, values in sorted(samples.get(name, {}).items()):
+                    cumulative = 0
+                    for bound in extra:
+                        cumulative += values.get(f"le:{bound}", 0)
+                        le = 'le="' + format_value(bound) + '"'
+                        lines.append(f"{name}_bucket{{{labels[1:-1] + ',' if labels else ''}{le}}} {format_value(cumulative)}")
+                    lines.append(f"{name}_sum{labels} {format_value(values.get('sum', 0))}")
+                    lines.append(f"{name}_count{labels} {format_value(values.get('count', 0))}")
+            else:
+                try:
+                    value = extra()
+                except Exception:
+                    continue
+                if isinstance(value, dict):
+                    for labels, sample in sorted(value.items()):
+                        lines.append(f"{name}{format_labels(dict(labels))} {format_value(sample)}")
+                elif value is not None:
+                    lines.append(f"{name} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+class Timer:
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.observe(self.name, time.monotonic() - self.started, **self.labels)
@@ -0,0 +1,249 @@
+"""
+Warm spotDL engine
+Long-lived processes that run spotDL jobs through its Python API, so the import,
+config load, Spotify token and YouTube Music session are paid once per process
+instead of once per job.
+
+A job is the argument list the spotDL command line would get. The engine writes
+spotDL's log lines to stdout as they are produced, followed by an exit marker,
+so callers read it exactly like the output of a `python -m spotdl` subprocess.
+"""
+
+import os
+import sys
+import json
+import logging
+import threading
+import subprocess
+
+from metadata_cache import MetadataCache, track_ref
+
+ENGINE_SCRIPT = os.path.abspath(__file__)
+EXIT_MARKER = '\x00spotdl-engine-exit '
+
+# Settings that change on every job; everything else identifies a reusable Downloader
+PER_JOB_SETTINGS = ('output', 'save_file', 'threads')
+
+class EngineJob:
+    """Popen-like handle for one job running in an engine process"""
+    def __init__(self, pool, process, args):
+        self.args = args
+        self.returncode = None
+        self._pool = pool
+        self._process = process
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        process.stdin.write(json.dumps({'args': args, 'cwd': os.getcwd()}) + '\n')
+        process.stdin.flush()
+        self.stdout = self._read()
+
+    def _read(self):
+        try:
+            for line in self._process.stdout:
+                if line.startswith(EXIT_MARKER):
+                    self.returncode = int(line[len(EXIT_MARKER):])
+                    break
+                yield line
+            else:
+                # The engine process died in the middle of the job
+                self.returncode = self._process.wait()
+        finally:
+            with self._lock:
+                self._done.set()
+            self._pool._release(self._process)
+
+    def poll(self):
+        return self.returncode if self._done.is_set() else None
+
+    def wait(self):
+        self._done.wait()
+        return self.returncode
+
+    def kill(self):
+        # A job cannot be interrupted inside spotDL, so the whole engine process goes
+        with self._lock:
+            if self._done.is_set():
+                return  # finished meanwhile, the engine may already run another job
+            self._process.kill()
+            self._process.wait()
+
+class EnginePool:
+    """Up to `size` warm engine processes, started on demand and reused across jobs.
+
+    env is added to the engines' environment, e.g. METADATA_CACHE_PATH to share cached lyrics.
+    """
+    def __init__(self, size, env=None):
+        self.size = size
+        self.env = env or {}
+        self._idle = []
+        self._started = 0
+        self._cond = threading.Condition()
+        self._pid = os.getpid()
+
+    def submit(self, args):
+        """Run spotDL with args (without the `python -m spotdl` prefix) in a warm engine"""
+        while True:
+            process = self._acquire()
+            try:
+                return EngineJob(self, process, args)
+            except (BrokenPipeError, OSError):
+                # The idle engine went away since its last job; start another one
+                process.kill()
+                process.wait()
+                self._release(process)
+
+    def _acquire(self):
+        with self._cond:
+            if self._pid != os.getpid():
+                # Engines belong to the process that started them, a forked worker starts its own
+                self._pid = os.getpid()
+                self._idle = []
+                self._started = 0
+            while True:
+                while self._idle:
+                    process = self._idle.pop()
+                    if process.poll() is None:
+                        return process
+                    self._started -= 1
+                if self._started < self.size:
+                    self._started += 1
+                    break
+                self._cond.wait()
+        try:
+            return subprocess.Popen(
+                [sys.executable, ENGINE_SCRIPT],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                text=True,
+                bufsize=1,
+                env={**os.environ, **self.env}
+            )
+        except Exception:
+            with self._cond:
+                self._started -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, process):
+        with self._cond:
+            if process.poll() is None:
+                self._idle.append(process)
+            else:
+                self._started -= 1
+            self._cond.notify()
+
+    def shutdown(self):
+        with self._cond:
+            for process in self._idle:
+                process.stdin.close()
+            self._idle = []
+
+class LineHandler(logging.Handler):
+    """Writes log records as plain text lines, the way spotDL's console would show them"""
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+
+    def emit(self, record):
+        try:
+            message = self.format(record)
+            try:
+                from rich.text import Text
+                message = Text.from_markup(message).plain
+            except Exception:
+                pass
+            for line in message.splitlines():
+                self.stream.write(line + '\n')
+            self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+class Engine:
+    """spotDL state kept warm between jobs: the Spotify client and one Downloader per configuration"""
+    def __init__(self, metadata=None, lyrics_ttl=0):
+        from spotdl.console.entry_point import OPERATIONS
+        from spotdl.utils.arguments import create_parser
+        self.operations = OPERATIONS
+        self.parser = create_parser()
+        self.spotify_settings = None
+        self.downloaders = {}
+        self.metadata = metadata
+        self.lyrics_ttl = lyrics_ttl
+
+    def _spotify_client(self, settings):
+        from spotdl.utils.spotify import SpotifyClient
+        if settings == self.spotify_settings:
+            return
+        # Credentials changed (e.g. anonymous resolution, then an authenticated download)
+        SpotifyClient._instance = None
+        SpotifyClient.init(**settings)
+        self.spotify_settings = settings
+
+    def _downloader(self, settings):
+        import asyncio
+        from spotdl.download.downloader import Downloader
+        key = json.dumps({k: v for k, v in settings.items() if k not in PER_JOB_SETTINGS}, sort_keys=True, default=str)
+        downloader = self.downloaders.get(key)
+        if downloader is None:
+            downloader = self.downloaders[key] = Downloader(settings)
+            if self.metadata is not None:
+                downloader.search_lyrics = self._cached_lyrics(downloader.search_lyrics)
+        downloader.settings.update({k: settings[k] for k in PER_JOB_SETTINGS})
+        downloader.semaphore = asyncio.Semaphore(settings['threads'])
+        downloader.errors = []
+        return downloader
+
+    def _cached_lyrics(self, search_lyrics):
+        """Wrap Downloader.search_lyrics with the shared cache; misses are cached as well"""
+        def cached(song):
+            ref = track_ref(song.json)
+            lyrics = self.metadata.get('lyrics', ref)
+            if lyrics is None:
+                lyrics = search_lyrics(song) or ''
+                self.metadata.put('lyrics', ref, lyrics, self.lyrics_ttl)
+            return lyrics or None
+        return cached
+
+    def run(self, args, cwd):
+        """Run one job and return its exit code"""
+        from spotdl.utils.config import create_settings
+        logger = logging.getLogger('spotdl')
+        try:
+            os.chdir(cwd)
+            arguments = self.parser.parse_args(args)
+            spotify_settings, downloader_settings, _ = create_settings(arguments)
+            logger.setLevel(downloader_settings['log_level'])
+            self._spotify_client(dict(spotify_settings))
+            downloader = self._downloader(downloader_settings)
+            self.operations[arguments.operation](query=arguments.query, downloader=downloader)
+            return 0
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            logger.error(f"{type(e).__name__}: {e}")
+            return 1
+
+def main():
+    """Engine process: read one job per line on stdin, stream its output to stdout"""
+    out = os.fdopen(os.dup(1), 'w', buffering=1)
+    # Keep stray prints (and ffmpeg children) off the line protocol
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    handler = LineHandler(out)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.getLogger().addHandler(handler)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    metadata = None
+    if os.getenv('METADATA_CACHE_PATH'):
+        metadata = MetadataCache(os.environ['METADATA_CACHE_PATH'], int(os.getenv('METADATA_CACHE_MAX_BYTES', str(256 * 1024 ** 2))))
+    engine = Engine(metadata, int(os.getenv('METADATA_LYRICS_TTL', str(30 * 86400))))
+    for line in sys.stdin:
+        job = json.loads(line)
+        code = engine.run(job['args'], job['cwd'])
+        out.write(f"{EXIT_MARKER}{code}\n")
+        out.flush()
+
+if __name__ == '__main__':
+    main()
@@ -16,10 +16,10 @@ pip install -r requirements-production.txt
 
 # Create necessary directories
 echo "📁 Creating directories..."
-mkdir -p downloads temp output logs
+mkdir -p downloads temp output logs data cache
 
 # Set proper permissions
-chmod 755 downloads temp output logs
+chmod 755 downloads temp output logs data cache
 
 # Generate secret key if not provided
 if [ -z "$SECRET_KEY" ] || [ "$SECRET_KEY" = "CHANGE-THIS-TO-A-STRONG-SECRET-KEY-FOR-PRODUCTION" ]; then
@@ -33,11 +33,32 @@ if [ -z "$SPOTIFY_CLIENT_ID" ] || [ -z "$SPOTIFY_CLIENT_SECRET" ]; then
     echo "   Set SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET environment variables."
 fi
 
+# Run a standalone download worker: ./start.sh worker
+if [ "$1" = "worker" ]; then
+    echo "🌟 Starting download worker..."
+    exec python app.py worker
+fi
+
+# gevent keeps idle event streams cheap, but downloads, archive building and SQLite waits
+# block its event loop: it is only used when downloads run in separate workers
+if [ "${DOWNLOAD_MODE:-inline}" = "external" ]; then
+    WORKER_CLASS=${WORKER_CLASS:-gevent}
+else
+    WORKER_CLASS=${WORKER_CLASS:-gthread}
+    if [ "$WORKER_CLASS" = "gevent" ]; then
+        echo "❌ WORKER_CLASS=gevent needs DOWNLOAD_MODE=external and separate download workers (./start.sh worker)"
+        exit 1
+    fi
+fi
+
 # Start the application with Gunicorn
 echo "🌟 Starting application..."
 exec gunicorn \
     --bind 0.0.0.0:${PORT:-8080} \
     --workers ${WORKERS:-2} \
+    --worker-class ${WORKER_CLASS} \
+    --threads ${WORKER_THREADS:-32} \
+    --worker-connections ${WORKER_CONNECTIONS:-1000} \
     --timeout ${WORKER_TIMEOUT:-300} \
     --keep-alive 2 \
     --max-requests 1000 \
@@ -46,4 +67,4 @@ exec gunicorn \
     --access-logfile - \
     --error-logfile - \
     --log-level info \
-    app:app
+    'app:create_app()'
@@ -7,6 +7,7 @@ class PlaylistDownloader {
     constructor() {
         this.currentTaskId = null;
         this.pollInterval = null;
+        this.eventSource = null;
         this.initializeElements();
         this.bindEvents();
         this.resetForm();
@@ -114,7 +115,7 @@ class PlaylistDownloader {
             }
 
             this.currentTaskId = data.task_id;
-            this.startProgressPolling();
+            this.startProgressUpdates();
 
             // Show warning if Spotify auth not configured
             if (data.warning) {
@@ -128,6 +129,48 @@ class PlaylistDownloader {
         }
     }
 
+    startProgressUpdates() {
+        // Prefer server-pushed updates, fall back to polling when SSE is unavailable
+        if (window.EventSource) {
+            this.startEventStream();
+        } else {
+            this.startProgressPolling();
+        }
+    }
+
+    startEventStream() {
+        this.stopProgressPolling();
+
+        let receivedEvent = false;
+        this.eventSource = new EventSource(`/events/${this.currentTaskId}`);
+
+        this.eventSource.addEventListener('status', (event) => {
+            receivedEvent = true;
+            this.handleStatus(JSON.parse(event.data));
+        });
+
+        this.eventSource.addEventListener('not_found', () => {
+            this.stopProgressPolling();
+            this.showError('Download task not found');
+        });
+
+        this.eventSource.onerror = () => {
+            // EventSource reconnects by itself; give up on SSE only if it never worked
+            if (!receivedEvent || this.eventSource.readyState === EventSource.CLOSED) {
+                console.warn('Event stream unavailable, falling back to polling');
+                this.closeEventStream();
+                this.startProgressPolling();
+            }
+        };
+    }
+
+    closeEventStream() {
+        if (this.eventSource) {
+            this.eventSource.close();
+            this.eventSource = null;
+        }
+    }
+
     startProgressPolling() {
         if (this.pollInterval) {
             clearInterval(this.pollInterval);
@@ -145,6 +188,7 @@ class PlaylistDownloader {
     }
 
     stopProgressPolling() {
+        this.closeEventStream();
         if (this.pollInterval) {
             clearInterval(this.pollInterval);
             this.pollInterval = null;
@@ -161,6 +205,10 @@ class PlaylistDownloader {
             throw new Error(data.error || 'Failed to get status');
         }
 
+        this.handleStatus(data);
+    }
+
+    handleStatus(data) {
         this.updateProgress(data.progress, data.message);
 
         if (data.status === 'completed') {
@@ -185,27 +233,26 @@ class PlaylistDownloader {
         }
 
         try {
-            const response = await fetch(`/download/${this.currentTaskId}`);
+            const downloadUrl = `/download/${this.currentTaskId}`;
+            // Check availability without fetching the body; errors come back as JSON
+            const response = await fetch(downloadUrl, { method: 'HEAD' });
             
             if (!response.ok) {
-                const errorData = await response.json();
+                const errorResponse = await fetch(downloadUrl);
+                const errorData = await errorResponse.json().catch(() => ({}));
                 throw new Error(errorData.error || 'Download failed');
             }
 
-            const blob = await response.blob();
-            const downloadUrl = window.URL.createObjectURL(blob);
-            
+            // Let the browser stream the archive to disk (it can pause and resume large files)
             const a = document.createElement('a');
             a.href = downloadUrl;
-            a.download = `playlist_${this.formatSelect.value}.zip`;
+            a.download = '';
             document.body.appendChild(a);
             a.click();
             document.body.removeChild(a);
-            
-            window.URL.revokeObjectURL(downloadUrl);
 
-            // Show download success message
-            this.showNotification('File downloaded successfully!', 'success');
+            // Show download started message
+            this.showNotification('Download started!', 'success');
 
         } catch (error) {
             console.error('File download error:', error);
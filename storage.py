@@ -0,0 +1,28 @@
+"""
+Storage
+SQLite helpers shared by the task store, caches, job queue and metrics: every
+process and thread gets its own connection to the shared database files.
+"""
+
+import os
+import sqlite3
+from pathlib import Path
+
+def sqlite_connection(local, path, setup=None):
+    """Return the calling thread's WAL-mode connection to path, reopening it after a fork.
+
+    Nothing touches the disk until the first connection: it creates the parent directory
+    and passes the new connection to setup, which creates the tables it needs.
+    """
+    conn = getattr(local, 'conn', None)
+    if conn is None or local.pid != os.getpid():
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(path), timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA mmap_size=67108864")
+        if setup is not None:
+            setup(conn)
+        local.conn = conn
+        local.pid = os.getpid()
+    return conn
@@ -0,0 +1,47 @@
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from limits import AdaptiveConcurrency
+from metrics import MetricsRegistry
+
+class Tasks:
+    """Task store stand-in: tasks by ID and the process each one is owned by"""
+    def __init__(self):
+        self.tasks = {}
+        self.owners = {}
+
+    def add(self, task_id, url='https://open.spotify.com/playlist/x'):
+        task = SimpleNamespace(task_id=task_id, url=url, format_type='mp3', status='pending',
+                               message='', queue_position=None)
+        self.tasks[task_id] = task
+        return task
+
+    def get(self, task_id):
+        return self.tasks.get(task_id)
+
+    def release(self, task):
+        self.owners.pop(task.task_id, None)
+
+    def adopt(self, task, owner):
+        self.owners[task.task_id] = owner
+        return True
+
+    def disown(self, task_id):
+        self.owners.pop(task_id, None)
+
+@pytest.fixture
+def tasks():
+    return Tasks()
+
+@pytest.fixture
+def concurrency():
+    return AdaptiveConcurrency((1, 2, 4), (1, 1, 1), 10)
+
+@pytest.fixture
+def metrics(tmp_path):
+    return MetricsRegistry(tmp_path / 'metrics.db', 'test')
@@ -0,0 +1,156 @@
+import time
+
+import pytest
+
+from job_queue import JobScheduler, SQLiteJobQueue, QueueFull, LeaseLost
+
+def scheduler(tasks, concurrency, metrics, max_depth=10, max_per_client=10):
+    return JobScheduler(max_depth, max_per_client, 1, tasks, lambda job: None, concurrency, metrics)
+
+def sqlite_queue(tmp_path, tasks, concurrency, metrics, owner, failed, lease_seconds=0.2, max_attempts=3):
+    return SQLiteJobQueue(tmp_path / 'jobs.db', 10, 10, 1, tasks, lambda job: None, concurrency, metrics,
+                          lease_seconds, max_attempts, lambda: owner['id'],
+                          lambda task_id, error: failed.append(task_id))
+
+def submit(queue, tasks, client, *jobs, batch=None):
+    queue.submit_all([(tasks.add(task_id), size) for task_id, size in jobs], client, batch=batch)
+
+# Fairness
+
+def test_clients_take_turns(tasks, concurrency, metrics):
+    queue = scheduler(tasks, concurrency, metrics)
+    submit(queue, tasks, 'a', ('a1', 100), ('a2', 100), ('a3', 100))
+    submit(queue, tasks, 'b', ('b1', 100))
+    assert [queue.get().task_id for _ in range(4)] == ['a1', 'b1', 'a2', 'a3']
+
+def test_finished_jobs_give_the_client_its_turn_back(tasks, concurrency, metrics):
+    queue = scheduler(tasks, concurrency, metrics)
+    submit(queue, tasks, 'a', ('a1', 100), ('a2', 100))
+    submit(queue, tasks, 'b', ('b1', 100), ('b2', 100))
+    first = queue.get()
+    assert queue.get().task_id == 'b1'
+    queue.done(first, 1)
+    # a has nothing running again, b has one job running
+    assert queue.get().task_id == 'a2'
+
+def test_smaller_jobs_of_a_client_go_first(tasks, concurrency, metrics):
+    queue = scheduler(tasks, concurrency, metrics)
+    submit(queue, tasks, 'a', ('playlist', 100), ('album', 15), ('track', 1))
+    assert [queue.get().task_id for _ in range(3)] == ['track', 'album', 'playlist']
+
+def test_waiting_jobs_age_into_a_smaller_size_class(tasks, concurrency, metrics):
+    queue = scheduler(tasks, concurrency, metrics)
+    queue.aging_seconds = 60
+    submit(queue, tasks, 'a', ('playlist', 100))
+    submit(queue, tasks, 'b', ('track', 1))
+    queue._queued['a'][0].enqueued_at -= 180
+    assert queue.get().task_id == 'playlist'
+
+def test_positions_follow_dispatch_order(tasks, concurrency, metrics):
+    queue = scheduler(tasks, concurrency, metrics)
+    submit(queue, tasks, 'a', ('a1', 100), ('a2', 100))
+    submit(queue, tasks, 'b', ('b1', 100))
+    assert [tasks.get(task_id).queue_position for task_id in ('a1', 'b1', 'a2')] == [1, 2, 3]
+
+# Admission
+
+def test_client_share_is_enforced(tasks, concurrency, metrics):
+    queue = scheduler(tasks, concurrency, metrics, max_per_client=2)
+    submit(queue, tasks, 'a', ('a1', 1), ('a2', 1))
+    with pytest.raises(QueueFull) as error:
+        submit(queue, tasks, 'a', ('a3', 1))
+    assert error.value.per_client
+    submit(queue, tasks, 'b', ('b1', 1))
+
+def test_full_queue_rejects_everyone(tasks, concurrency, metrics):
+    queue = scheduler(tasks, concurrency, metrics, max_depth=1)
+    submit(queue, tasks, 'a', ('a1', 1))
+    with pytest.raises(QueueFull) as error:
+        submit(queue, tasks, 'b', ('b1', 1))
+    assert not error.value.per_client
+
+def test_batch_takes_one_place_and_feeds_its_jobs_in(tasks, concurrency, metrics):
+    queue = scheduler(tasks, concurrency, metrics, max_per_client=1)
+    submit(queue, tasks, 'a', ('p1', 10), ('p2', 10), ('p3', 10), batch='batch')
+    assert queue.depth() == 1
+    assert [queue.get().task_id for _ in range(3)] == ['p1', 'p2', 'p3']
+    assert queue.depth() == 0
+
+# Leases of the durable queue
+
+@pytest.fixture
+def owner():
+    return {'id': 'worker-a'}
+
+@pytest.fixture
+def failed():
+    return []
+
+def test_expired_lease_is_requeued_to_another_worker(tmp_path, tasks, concurrency, metrics, owner, failed):
+    queue = sqlite_queue(tmp_path, tasks, concurrency, metrics, owner, failed)
+    submit(queue, tasks, 'a', ('job', 10))
+    assert queue.get().task_id == 'job'
+    assert queue._claim() is None
+
+    time.sleep(0.3)
+    owner['id'] = 'worker-b'
+    job = queue._claim()
+    assert job.task_id == 'job'
+    worker, attempts = queue._connect().execute("SELECT worker, attempts FROM jobs").fetchone()
+    assert (worker, attempts) == ('worker-b', 2)
+    assert not failed
+
+def test_renewed_lease_is_kept(tmp_path, tasks, concurrency, metrics, owner, failed):
+    queue = sqlite_queue(tmp_path, tasks, concurrency, metrics, owner, failed)
+    submit(queue, tasks, 'a', ('job', 10))
+    queue.get()
+    for _ in range(3):
+        time.sleep(0.1)
+        queue._renew_leases()
+    owner['id'] = 'worker-b'
+    assert queue._claim() is None
+
+def test_worker_that_lost_its_lease_stops(tmp_path, tasks, concurrency, metrics, owner, failed):
+    queue = sqlite_queue(tmp_path, tasks, concurrency, metrics, owner, failed)
+    submit(queue, tasks, 'a', ('job', 10))
+    queue.get()
+    time.sleep(0.3)
+    owner['id'] = 'worker-b'
+    queue._claim()
+
+    owner['id'] = 'worker-a'
+    queue._renew_leases()
+    with pytest.raises(LeaseLost):
+        queue.check_lease('job')
+    assert 'job' not in tasks.owners
+
+def test_job_is_failed_after_max_attempts(tmp_path, tasks, concurrency, metrics, owner, failed):
+    queue = sqlite_queue(tmp_path, tasks, concurrency, metrics, owner, failed, max_attempts=1)
+    submit(queue, tasks, 'a', ('job', 10))
+    queue.get()
+    time.sleep(0.3)
+    owner['id'] = 'worker-b'
+    assert queue._claim() is None
+    assert failed == ['job']
+    assert queue.depth() == 0
+
+def test_done_removes_the_job(tmp_path, tasks, concurrency, metrics, owner, failed):
+    queue = sqlite_queue(tmp_path, tasks, concurrency, metrics, owner, failed)
+    submit(queue, tasks, 'a', ('job', 10))
+    job = queue.get()
+    queue.done(job, 1)
+    assert queue.snapshot()['running'] == 0
+    assert not queue._claimable()
+
+def test_durable_batch_feeds_held_jobs_on_claim(tmp_path, tasks, concurrency, metrics, owner, failed):
+    queue = sqlite_queue(tmp_path, tasks, concurrency, metrics, owner, failed)
+    submit(queue, tasks, 'a', ('p1', 10), ('p2', 10), ('p3', 10), batch='batch')
+    assert queue.depth() == 1
+    assert [queue._claim().task_id for _ in range(3)] == ['p1', 'p2', 'p3']
+    assert queue._claim() is None
+
+def test_durable_queue_is_fair_between_clients(tmp_path, tasks, concurrency, metrics, owner, failed):
+    queue = sqlite_queue(tmp_path, tasks, concurrency, metrics, owner, failed)
+    submit(queue, tasks, 'a', ('a1', 100), ('a2', 100))
+    submit(queue, tasks, 'b', ('b1', 100))
+    assert [queue._claim().task_id for _ in range(3)] == ['a1', 'b1', 'a2']
@@ -0,0 +1,42 @@
+import time
+
+from track_cache import TrackCache
+
+def test_claim_is_exclusive_until_released(tmp_path):
+    cache = TrackCache(tmp_path / 'cache', 1024)
+    assert cache.claim('track', 'job-a', 60)
+    assert not cache.claim('track', 'job-b', 60)
+    cache.release('job-a', ['track'])
+    assert cache.claim('track', 'job-b', 60)
+
+def test_owner_can_renew_its_claim(tmp_path):
+    cache = TrackCache(tmp_path / 'cache', 1024)
+    assert cache.claim('track', 'job-a', 60)
+    assert cache.claim('track', 'job-a', 60)
+
+def test_expired_claim_is_handed_over(tmp_path):
+    cache = TrackCache(tmp_path / 'cache', 1024)
+    assert cache.claim('track', 'job-a', 0.1)
+    time.sleep(0.2)
+    assert cache.claim('track', 'job-b', 60)
+    assert not cache.claim('track', 'job-a', 60)
+
+def test_release_drops_every_claim_of_an_owner(tmp_path):
+    cache = TrackCache(tmp_path / 'cache', 1024)
+    cache.claim('one', 'job-a', 60)
+    cache.claim('two', 'job-a', 60)
+    cache.release('job-a')
+    assert cache.claim('one', 'job-b', 60) and cache.claim('two', 'job-b', 60)
+
+def test_stored_track_is_found_until_evicted(tmp_path):
+    cache = TrackCache(tmp_path / 'cache', 1500)
+    for name in ('old', 'new'):
+        source = tmp_path / f'{name}.mp3'
+        source.write_bytes(b'x' * 1000)
+        cache.store(name, source)
+        time.sleep(0.01)
+    assert cache.lookup('old').read_bytes() == b'x' * 1000
+    cache.evict()
+    # 'old' was read last, so the least recently used one is 'new'
+    assert cache.lookup('new') is None
+    assert cache.lookup('old') is not None
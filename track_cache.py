@@ -0,0 +1,121 @@
+"""
+Track cache
+Converted tracks shared by all jobs and workers, stored once under a content
+address and indexed in a SQLite database in WAL mode, with the claims that let
+concurrent jobs wait for a track another job is downloading.
+"""
+
+import hashlib
+import logging
+import shutil
+import threading
+import time
+from pathlib import Path
+
+from metadata_cache import track_ref
+from storage import sqlite_connection
+
+logger = logging.getLogger(__name__)
+
+class TrackCache:
+    """Content-addressed cache of converted tracks shared by all workers.
+
+    Files live under cache/<xx>/<sha256>.<ext>, where the hash covers the provider
+    track ID, format and bitrate. A SQLite index keeps sizes and last access times
+    so eviction drops the least recently used tracks until the cache fits its budget.
+    """
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.path = self.root / 'index.db'
+        self._local = threading.local()
+
+    def _create_tables(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS tracks (
+                key TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tracks_last_access ON tracks (last_access)")
+        # Tracks a job is downloading right now, so concurrent jobs wait for them instead
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS claims (
+                key TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+
+    def _connect(self):
+        return sqlite_connection(self._local, self.path, self._create_tables)
+
+    def claim(self, key, owner, ttl):
+        """Claim a track for download; False while another owner holds an unexpired claim"""
+        now = time.time()
+        cursor = self._connect().execute(
+            "INSERT INTO claims VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE "
+            "SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE claims.owner = excluded.owner OR claims.expires_at < ?",
+            (key, owner, now + ttl, now)
+        )
+        return cursor.rowcount == 1
+
+    def release(self, owner, keys=None):
+        """Drop the claims of an owner, all of them or only the given keys"""
+        conn = self._connect()
+        if keys is None:
+            conn.execute("DELETE FROM claims WHERE owner = ?", (owner,))
+        else:
+            conn.executemany("DELETE FROM claims WHERE owner = ? AND key = ?", [(owner, key) for key in keys])
+
+    @staticmethod
+    def key(song, format_type, bitrate):
+        """Cache key for a resolved spotDL song"""
+        return hashlib.sha256(f"{track_ref(song)}:{format_type}:{bitrate}".encode()).hexdigest()
+
+    def lookup(self, key):
+        """Return the cached file for key, refreshing its LRU position"""
+        conn = self._connect()
+        row = conn.execute("SELECT path FROM tracks WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None
+        path = Path(row[0])
+        if not path.exists():
+            conn.execute("DELETE FROM tracks WHERE key = ?", (key,))
+            return None
+        conn.execute("UPDATE tracks SET last_access = ? WHERE key = ?", (time.time(), key))
+        return path
+
+    def store(self, key, source):
+        """Move a freshly downloaded file into the cache and return its cached path"""
+        source = Path(source)
+        path = self.root / key[:2] / f"{key}{source.suffix.lower()}"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(str(source), str(path))
+        self._connect().execute(
+            "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?)",
+            (key, str(path), path.stat().st_size, time.time())
+        )
+        return path
+
+    def usage(self):
+        return self._connect().execute("SELECT COALESCE(SUM(size), 0) FROM tracks").fetchone()[0]
+
+    def evict(self):
+        """Drop least recently used tracks until the cache fits within max_bytes"""
+        conn = self._connect()
+        excess = self.usage() - self.max_bytes
+        if excess <= 0:
+            return
+        evicted = 0
+        for key, path, size in conn.execute("SELECT key, path, size FROM tracks ORDER BY last_access").fetchall():
+            if excess <= 0:
+                break
+            Path(path).unlink(missing_ok=True)
+            conn.execute("DELETE FROM tracks WHERE key = ?", (key,))
+            excess -= size
+            evicted += 1
+        logger.info(f"Evicted {evicted} tracks from cache")